@@ -0,0 +1,480 @@
+"""Conversation affinity across worker processes.
+
+`python -m app.affinity` starts AFFINITY_WORKERS processes of the app, each
+listening on a Unix socket, behind a dispatcher on HOST:PORT. The dispatcher
+sends every request of a conversation to the same worker, so the state kept
+in process (verdict cache, conversation filter, debate sessions, jobs) is
+reused by its following turns.
+
+The worker of a conversation is chosen with rendezvous hashing over the
+live workers: when a worker stops only its conversations move, spread over
+the others, and they go back to it once it is restarted. Requests without a
+conversation, like the first turn, go to the workers in turn, and the jobs
+are sent to the worker that queued them, whose index is in the job id.
+"""
+
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import os
+import sys
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Optional, Sequence
+from urllib.parse import parse_qs
+
+import httpx
+import uvicorn
+from starlette.datastructures import Headers
+from starlette.types import Message, Receive, Scope, Send
+
+from app.configuration import get_configuration
+from app.jobs import job_worker_index
+from app.metrics import Metrics, metrics
+from app.utils import configure_logger
+
+try:
+    import websockets
+except ImportError:  # pragma: no cover - the WebSockets are not forwarded
+    websockets = None  # type: ignore[assignment]
+
+log = logging.getLogger(__name__)
+
+CONVERSATION_PATH_PREFIX = "/api/conversations/"
+CHAT_PATH = "/api/chat/"
+JOBS_PATH = "/api/chat/jobs"
+# Only the bodies of these routes carry a conversation id and are parsed
+BODY_CONVERSATION_PATHS = {CHAT_PATH, JOBS_PATH}
+METRICS_PATH = "/api/dispatcher/metrics"
+# Conversations whose last worker is remembered
+MAX_TRACKED_KEYS = 100_000
+# Same default as MAX_REQUEST_BYTES of the workers
+DEFAULT_MAX_BODY_BYTES = 256 * 1024
+# Headers of the connection between two hops, not forwarded
+HOP_HEADERS = {
+    b"connection",
+    b"keep-alive",
+    b"transfer-encoding",
+    b"upgrade",
+    b"proxy-connection",
+    b"te",
+    b"trailer",
+}
+WEBSOCKET_HEADERS = {b"x-forwarded-for", b"x-api-key"}
+
+
+def rendezvous_owner(key: str, workers: Sequence[str]) -> Optional[str]:
+    """Worker with the highest weight for the key, None without workers."""
+    if not workers:
+        return None
+    return max(workers, key=lambda worker: _weight(key, worker))
+
+
+def _weight(key: str, worker: str) -> int:
+    digest = hashlib.blake2b(f"{worker}:{key}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def conversation_key(scope: Scope, body: bytes) -> Optional[str]:
+    """Conversation of a request: in its path, its query or, for the chat
+    routes, its JSON body."""
+    path: str = scope["path"]
+    if path.startswith(CONVERSATION_PATH_PREFIX):
+        return _valid_uuid(path[len(CONVERSATION_PATH_PREFIX) :].split("/")[0])
+    query = parse_qs(scope.get("query_string", b"").decode())
+    if "conversation_id" in query:
+        return _valid_uuid(query["conversation_id"][0])
+    if path in BODY_CONVERSATION_PATHS and body[:1] == b"{":
+        try:
+            conversation_id = json.loads(body).get("conversation_id")
+        except ValueError:
+            return None
+        if isinstance(conversation_id, str):
+            return _valid_uuid(conversation_id)
+    return None
+
+
+def _valid_uuid(value: str) -> Optional[str]:
+    try:
+        return str(uuid.UUID(value))
+    except ValueError:
+        return None
+
+
+def _job_id(path: str) -> Optional[uuid.UUID]:
+    if not path.startswith(JOBS_PATH + "/"):
+        return None
+    try:
+        return uuid.UUID(path[len(JOBS_PATH) + 1 :].split("/")[0])
+    except ValueError:
+        return None
+
+
+@dataclass(eq=False)
+class Worker:
+    name: str
+    socket_path: str
+    client: httpx.AsyncClient = field(repr=False)
+    alive: bool = False
+    process: Optional[asyncio.subprocess.Process] = field(default=None, repr=False)
+
+    @classmethod
+    def on_socket(cls, name: str, socket_path: str) -> "Worker":
+        transport = httpx.AsyncHTTPTransport(uds=socket_path)
+        client = httpx.AsyncClient(
+            transport=transport, base_url="http://worker", timeout=None
+        )
+        return cls(name=name, socket_path=socket_path, client=client)
+
+
+class WorkerPool:
+    """Worker processes of the app, restarted when they exit."""
+
+    def __init__(
+        self,
+        workers: list[Worker],
+        restart_delay_seconds: float = 1.0,
+        health_interval_seconds: float = 0.2,
+        registry: Metrics = metrics,
+    ):
+        self.workers = workers
+        self.restart_delay_seconds = restart_delay_seconds
+        self.health_interval_seconds = health_interval_seconds
+        self.metrics = registry
+        self._supervisors: list[asyncio.Task] = []
+        self._turn = itertools.count()
+
+    @classmethod
+    def on_sockets(cls, count: int, socket_dir: str, **kwargs: Any) -> "WorkerPool":
+        Path(socket_dir).mkdir(parents=True, exist_ok=True)
+        return cls(
+            [
+                Worker.on_socket(f"worker-{index}", f"{socket_dir}/worker-{index}.sock")
+                for index in range(count)
+            ],
+            **kwargs,
+        )
+
+    @property
+    def alive(self) -> list[Worker]:
+        return [worker for worker in self.workers if worker.alive]
+
+    def route(self, key: Optional[str]) -> Optional[Worker]:
+        """Worker of a key among the live ones, in turn without a key."""
+        alive = self.alive
+        if not alive:
+            return None
+        if key is None:
+            return alive[next(self._turn) % len(alive)]
+        by_name = {worker.name: worker for worker in alive}
+        return by_name[rendezvous_owner(key, list(by_name))]  # type: ignore[index]
+
+    async def start(self) -> None:
+        self._supervisors = [
+            asyncio.create_task(self._supervise(worker)) for worker in self.workers
+        ]
+
+    async def stop(self) -> None:
+        for supervisor in self._supervisors:
+            supervisor.cancel()
+        await asyncio.gather(*self._supervisors, return_exceptions=True)
+        for worker in self.workers:
+            if worker.process is not None and worker.process.returncode is None:
+                worker.process.terminate()
+                await worker.process.wait()
+            await worker.client.aclose()
+
+    async def _supervise(self, worker: Worker) -> None:
+        # Written by the worker in the ids of its jobs, which are routed by it
+        env = {**os.environ, "AFFINITY_WORKER_INDEX": str(self.workers.index(worker))}
+        while True:
+            Path(worker.socket_path).unlink(missing_ok=True)
+            worker.process = await asyncio.create_subprocess_exec(
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "app.main:app",
+                "--uds",
+                worker.socket_path,
+                # The client address is taken from X-Forwarded-For
+                "--proxy-headers",
+                "--forwarded-allow-ips",
+                "*",
+                env=env,
+            )
+            if await self._wait_healthy(worker):
+                worker.alive = True
+                self._report()
+                log.info("Worker %s ready", worker.name)
+            await worker.process.wait()
+            # Its conversations move to the other workers until it is back
+            worker.alive = False
+            self.metrics.increment("affinity.worker_restarts")
+            self._report()
+            log.warning(
+                "Worker %s exited with %s, restarting",
+                worker.name,
+                worker.process.returncode,
+            )
+            await asyncio.sleep(self.restart_delay_seconds)
+
+    async def _wait_healthy(self, worker: Worker) -> bool:
+        while worker.process is not None and worker.process.returncode is None:
+            try:
+                response = await worker.client.get("/api/health")
+                if response.status_code == 200:
+                    return True
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(self.health_interval_seconds)
+        return False
+
+    def _report(self) -> None:
+        self.metrics.set_gauge("affinity.workers_alive", len(self.alive))
+
+
+class AffinityDispatcher:
+    """ASGI app that forwards the requests to the worker of their conversation.
+
+    A conversation served by another worker than its previous request, after
+    a worker stopped or came back, counts as a hop: its state in process is
+    rebuilt by the new worker.
+    """
+
+    def __init__(
+        self,
+        pool: WorkerPool,
+        max_body_bytes: int = DEFAULT_MAX_BODY_BYTES,
+        registry: Metrics = metrics,
+    ):
+        self.pool = pool
+        self.max_body_bytes = max_body_bytes
+        self.metrics = registry
+        self._last_worker: OrderedDict[str, str] = OrderedDict()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+        elif scope["type"] == "websocket":
+            await self._websocket(scope, receive, send)
+
+    async def _lifespan(self, receive: Receive, send: Send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.pool.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.pool.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope: Scope, receive: Receive, send: Send) -> None:
+        body = await self._read_body(scope, receive)
+        if body is None:
+            self.metrics.increment("affinity.too_large")
+            await _send_response(send, 413, b'{"detail":"Request Entity Too Large"}')
+            return
+        if scope["path"] == METRICS_PATH:
+            payload = json.dumps(self.metrics.snapshot()).encode()
+            await _send_response(send, 200, payload, b"application/json")
+            return
+        worker = self._select(scope, body)
+        if worker is None:
+            self.metrics.increment("affinity.unavailable")
+            await _send_response(send, 503, b'{"detail":"No worker available"}')
+            return
+        request = worker.client.build_request(
+            scope["method"],
+            _target(scope),
+            headers=_forwarded_headers(scope),
+            content=body,
+        )
+        try:
+            response = await worker.client.send(request, stream=True)
+        except httpx.TransportError as e:
+            log.error(f"Error on forwarding to {worker.name}: {e!r}")
+            self.metrics.increment("affinity.forward_errors")
+            await _send_response(send, 502, b'{"detail":"Worker unavailable"}')
+            return
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": response.status_code,
+                    "headers": [
+                        (name, value)
+                        for name, value in response.headers.raw
+                        if name.lower() not in HOP_HEADERS
+                    ],
+                }
+            )
+            # Raw so the responses compressed by the worker are not decoded
+            async for chunk in response.aiter_raw():
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            await response.aclose()
+
+    async def _read_body(self, scope: Scope, receive: Receive) -> Optional[bytes]:
+        """Body of the request, None when it is bigger than max_body_bytes,
+        which is known from Content-Length or while it is received."""
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length is not None and content_length.isdigit():
+            if int(content_length) > self.max_body_bytes:
+                return None
+        chunks: list[bytes] = []
+        received = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunk = message.get("body", b"")
+            received += len(chunk)
+            if received > self.max_body_bytes:
+                return None
+            chunks.append(chunk)
+            more_body = message.get("more_body", False)
+        return b"".join(chunks)
+
+    async def _websocket(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await receive()  # websocket.connect
+        worker = self._select(scope, b"")
+        if worker is None or websockets is None:
+            self.metrics.increment("affinity.unavailable")
+            await send({"type": "websocket.close", "code": 1013})
+            return
+        uri = "ws://worker" + _target(scope)
+        try:
+            async with websockets.unix_connect(
+                worker.socket_path,
+                uri,
+                additional_headers=_websocket_headers(scope),
+            ) as upstream:
+                await send({"type": "websocket.accept"})
+                await _pump_websocket(receive, send, upstream)
+        except (OSError, websockets.WebSocketException) as e:
+            log.error(f"Error on forwarding WebSocket to {worker.name}: {e!r}")
+            await send({"type": "websocket.close", "code": 1011})
+
+    def _select(self, scope: Scope, body: bytes) -> Optional[Worker]:
+        job_id = _job_id(scope["path"])
+        if job_id is not None:
+            index = job_worker_index(job_id)
+            if index < len(self.pool.workers):
+                # The jobs are kept by the worker that queued them
+                owner = self.pool.workers[index]
+                return owner if owner.alive else None
+        key = conversation_key(scope, body)
+        worker = self.pool.route(key)
+        if worker is None:
+            return None
+        self.metrics.increment(f"affinity.requests.{worker.name}")
+        if key is None:
+            self.metrics.increment("affinity.unrouted")
+            return worker
+        self.metrics.increment("affinity.routed")
+        previous = self._last_worker.get(key)
+        if previous is not None and previous != worker.name:
+            self.metrics.increment("affinity.hops")
+        _remember(self._last_worker, key, worker.name)
+        return worker
+
+
+def _remember(keys: OrderedDict[str, str], key: str, worker: str) -> None:
+    keys[key] = worker
+    keys.move_to_end(key)
+    while len(keys) > MAX_TRACKED_KEYS:
+        keys.popitem(last=False)
+
+
+def _target(scope: Scope) -> str:
+    path: str = scope["path"]
+    query = scope.get("query_string", b"")
+    return path + ("?" + query.decode() if query else "")
+
+
+def _forwarded_headers(scope: Scope) -> list[tuple[bytes, bytes]]:
+    # The X-Forwarded-For of the client is dropped, the workers would
+    # otherwise trust an address it made up
+    headers = [
+        (name, value)
+        for name, value in scope["headers"]
+        if name.lower() not in HOP_HEADERS
+        and name.lower() not in (b"host", b"x-forwarded-for")
+    ]
+    client = scope.get("client")
+    if client:
+        headers.append((b"x-forwarded-for", client[0].encode()))
+    return headers
+
+
+def _websocket_headers(scope: Scope) -> list[tuple[str, str]]:
+    # websockets sets the handshake headers, only the ones identifying the
+    # client are passed on
+    return [
+        (name.decode("latin-1"), value.decode("latin-1"))
+        for name, value in _forwarded_headers(scope)
+        if name.lower() in WEBSOCKET_HEADERS
+    ]
+
+
+async def _send_response(
+    send: Send, status: int, body: bytes, media_type: bytes = b"application/json"
+) -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", media_type)],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _pump_websocket(receive: Receive, send: Send, upstream: Any) -> None:
+    """Relay the frames both ways until one of the sides closes."""
+
+    async def from_client() -> None:
+        while True:
+            message: Message = await receive()
+            if message["type"] == "websocket.disconnect":
+                await upstream.close(message.get("code", 1000))
+                return
+            data = message.get("text")
+            await upstream.send(data if data is not None else message.get("bytes"))
+
+    async def from_worker() -> None:
+        async for data in upstream:
+            if isinstance(data, str):
+                await send({"type": "websocket.send", "text": data})
+            else:
+                await send({"type": "websocket.send", "bytes": data})
+        await send({"type": "websocket.close", "code": upstream.close_code or 1000})
+
+    tasks = [asyncio.create_task(from_client()), asyncio.create_task(from_worker())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    conf = get_configuration()
+    configure_logger()
+    pool = WorkerPool.on_sockets(
+        conf.affinity_workers,
+        conf.affinity_socket_dir,
+        restart_delay_seconds=conf.affinity_restart_delay_seconds,
+    )
+    dispatcher = AffinityDispatcher(pool, max_body_bytes=conf.max_request_bytes)
+    uvicorn.run(dispatcher, port=conf.port, host=conf.host)
@@ -0,0 +1,83 @@
+import asyncio
+import contextvars
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+from app.metrics import Metrics, metrics
+
+log = logging.getLogger(__name__)
+
+ClassifyBatch = Callable[[list[str]], Awaitable[list[str]]]
+
+
+class ClassificationBatcher:
+    """Group concurrent classifications in a single request to the agent.
+
+    Classifications are collected during a window of time or until max_items
+    are pending, then they are sent in one multi-item prompt and the
+    verdicts are split back to every caller.
+    """
+
+    def __init__(
+        self,
+        classify_batch: ClassifyBatch,
+        window_seconds: float,
+        max_items: int,
+        instruction_tokens: int = 0,
+        registry: Metrics = metrics,
+    ):
+        self.classify_batch = classify_batch
+        self.window_seconds = window_seconds
+        self.max_items = max_items
+        self.instruction_tokens = instruction_tokens
+        self.metrics = registry
+        self._pending: list[tuple[str, asyncio.Future[str], float]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    async def classify(self, content: str) -> str:
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[str] = loop.create_future()
+        self._pending.append((content, future, time.perf_counter()))
+        if len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_seconds, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        # The batch belongs to every caller, it does not run in the context
+        # of the one that flushed it
+        task = asyncio.get_running_loop().create_task(
+            self._run(batch), context=contextvars.Context()
+        )
+        # Keep a reference so the task is not garbage collected
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list[tuple[str, asyncio.Future[str], float]]) -> None:
+        started = time.perf_counter()
+        for _, _, enqueued in batch:
+            self.metrics.observe("proxy.batch.wait_seconds", started - enqueued)
+        self.metrics.observe("proxy.batch.size", len(batch))
+        # Every item after the first one does not pay for the instructions
+        self.metrics.increment(
+            "proxy.batch.tokens_saved", (len(batch) - 1) * self.instruction_tokens
+        )
+        try:
+            actions = await self.classify_batch([content for content, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _), action in zip(batch, actions):
+            if not future.done():
+                future.set_result(action)
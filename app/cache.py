@@ -0,0 +1,318 @@
+"""Caches shared between the processes and nodes of a deployment.
+
+A TieredCache reads from an LRU of the process and then from a shared
+backend, so a value computed by one node, like the verdict of the proxy
+agent for a message, is reused by the others instead of being computed N
+times. The shared backend is the database, sqlite stands in for it locally.
+Values are encoded as JSON, compressed with zlib when they are large.
+
+Concurrent misses of a key are computed once: in a process they share the
+computation and between nodes the first one takes a lock entry in the shared
+backend while the others wait for its value.
+"""
+
+import asyncio
+import logging
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, Protocol
+
+import pydantic_core
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.metrics import Metrics, metrics
+from app.singleflight import SingleFlight
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LOCAL_ENTRIES = 10_000
+DEFAULT_LOCAL_TTL_SECONDS = 60.0
+DEFAULT_SHARED_TTL_SECONDS = 60 * 60.0
+DEFAULT_LOCK_TTL_SECONDS = 10.0
+# Seconds between the reads of a node waiting for the value of another one
+LOCK_POLL_SECONDS = 0.05
+COMPRESS_MIN_BYTES = 512
+JSON_ENCODING = b"j"
+ZLIB_ENCODING = b"z"
+LOCAL_TIER = "local"
+SHARED_TIER = "shared"
+
+
+def encode(value: Any) -> bytes:
+    """Compact JSON, compressed when large, with a byte for the encoding."""
+    data = pydantic_core.to_json(value)
+    if len(data) >= COMPRESS_MIN_BYTES:
+        return ZLIB_ENCODING + zlib.compress(data)
+    return JSON_ENCODING + data
+
+
+def decode(data: bytes) -> Any:
+    if data[:1] == ZLIB_ENCODING:
+        return pydantic_core.from_json(zlib.decompress(data[1:]))
+    return pydantic_core.from_json(data[1:])
+
+
+class CacheBackend(Protocol):
+    async def get(self, key: str) -> Optional[bytes]: ...
+
+    async def set(self, key: str, value: bytes, ttl_seconds: float) -> None: ...
+
+    async def add(self, key: str, value: bytes, ttl_seconds: float) -> bool:
+        """Set the key only if it is missing or expired, True if it was set."""
+        ...
+
+    async def delete(self, key: str) -> None: ...
+
+
+class InMemoryCacheBackend:
+    """LRU of this process with a time to live per entry.
+
+    Also the local tier of TieredCache, which keeps the decoded values in it:
+    the cached values must not be modified.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_LOCAL_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[Any, float]] = OrderedDict()
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any, ttl_seconds: float) -> None:
+        self._entries[key] = (value, time.monotonic() + ttl_seconds)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def add(self, key: str, value: Any, ttl_seconds: float) -> bool:
+        if await self.get(key) is not None:
+            return False
+        await self.set(key, value, ttl_seconds)
+        return True
+
+    async def delete(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Supported by postgres and sqlite so sqlite can stand in for the shared
+# database locally
+GET_QUERY = """
+SELECT value FROM cache_entries WHERE cache_key = :key AND expires_at > :now
+"""
+SET_QUERY = """
+INSERT INTO cache_entries (cache_key, value, expires_at)
+VALUES (:key, :value, :expires_at)
+ON CONFLICT (cache_key) DO UPDATE SET
+    value = excluded.value,
+    expires_at = excluded.expires_at
+"""
+# Only returns the key when the entry was missing or expired
+ADD_QUERY = """
+INSERT INTO cache_entries (cache_key, value, expires_at)
+VALUES (:key, :value, :expires_at)
+ON CONFLICT (cache_key) DO UPDATE SET
+    value = excluded.value,
+    expires_at = excluded.expires_at
+WHERE cache_entries.expires_at <= :now
+RETURNING cache_key
+"""
+DELETE_QUERY = "DELETE FROM cache_entries WHERE cache_key = :key"
+PURGE_QUERY = "DELETE FROM cache_entries WHERE expires_at <= :now"
+
+
+class DatabaseCacheBackend:
+    """Entries shared by every node in the cache_entries table.
+
+    A read is one round trip, the local tier of TieredCache keeps the hot
+    keys so most reads do not reach it. Expired entries are ignored and
+    deleted by purge_expired.
+    """
+
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+
+    async def get(self, key: str) -> Optional[bytes]:
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                text(GET_QUERY), {"key": key, "now": time.time()}
+            )
+            row = result.first()
+        return bytes(row[0]) if row is not None else None
+
+    async def set(self, key: str, value: bytes, ttl_seconds: float) -> None:
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                text(SET_QUERY),
+                {"key": key, "value": value, "expires_at": time.time() + ttl_seconds},
+            )
+
+    async def add(self, key: str, value: bytes, ttl_seconds: float) -> bool:
+        now = time.time()
+        async with self.engine.begin() as conn:
+            result = await conn.execute(
+                text(ADD_QUERY),
+                {
+                    "key": key,
+                    "value": value,
+                    "expires_at": now + ttl_seconds,
+                    "now": now,
+                },
+            )
+            return result.first() is not None
+
+    async def delete(self, key: str) -> None:
+        async with self.engine.begin() as conn:
+            await conn.execute(text(DELETE_QUERY), {"key": key})
+
+    async def purge_expired(self) -> int:
+        async with self.engine.begin() as conn:
+            result = await conn.execute(text(PURGE_QUERY), {"now": time.time()})
+            return result.rowcount
+
+
+class TieredCache:
+    """Values of a namespace in the process LRU and in a shared backend.
+
+    The local copies live local_ttl_seconds, shorter than the shared ones,
+    so a value updated by another node is seen soon. The hits, misses and
+    lookup time of each tier are reported under cache.<namespace>. Errors of
+    the shared backend are logged and count as misses.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        shared: Optional[CacheBackend] = None,
+        local_entries: int = DEFAULT_LOCAL_ENTRIES,
+        local_ttl_seconds: float = DEFAULT_LOCAL_TTL_SECONDS,
+        shared_ttl_seconds: float = DEFAULT_SHARED_TTL_SECONDS,
+        lock_ttl_seconds: float = DEFAULT_LOCK_TTL_SECONDS,
+        registry: Metrics = metrics,
+    ):
+        self.namespace = namespace
+        self.local = InMemoryCacheBackend(local_entries)
+        self.shared = shared
+        self.local_ttl_seconds = local_ttl_seconds
+        self.shared_ttl_seconds = shared_ttl_seconds
+        self.lock_ttl_seconds = lock_ttl_seconds
+        self.metrics = registry
+        self._flights: SingleFlight[Any] = SingleFlight(
+            f"cache.{namespace}.singleflight", registry
+        )
+        self._lookups = {LOCAL_TIER: [0, 0], SHARED_TIER: [0, 0]}
+
+    async def get(self, key: str) -> Optional[Any]:
+        start = time.perf_counter()
+        value = await self.local.get(key)
+        self._record(LOCAL_TIER, value is not None, start)
+        if value is not None or self.shared is None:
+            return value
+        start = time.perf_counter()
+        data = await self._shared_call(self.shared.get(self._shared_key(key)))
+        self._record(SHARED_TIER, data is not None, start)
+        if data is None:
+            return None
+        value = decode(data)
+        await self.local.set(key, value, self.local_ttl_seconds)
+        return value
+
+    async def set(self, key: str, value: Any) -> None:
+        await self.local.set(key, value, self.local_ttl_seconds)
+        if self.shared is not None:
+            await self._shared_call(
+                self.shared.set(
+                    self._shared_key(key), encode(value), self.shared_ttl_seconds
+                )
+            )
+
+    async def get_or_set(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """Cached value of the key, computed once by the deployment on a miss.
+        The computed value must not be None, errors are not cached."""
+        value = await self.get(key)
+        if value is not None:
+            return value
+        return await self._flights.do(key, lambda: self._fill(key, compute))
+
+    async def _fill(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        # Set by a computation that ended after the lookup of this call
+        value = await self.local.get(key)
+        if value is not None:
+            return value
+        shared = self.shared
+        lock_key = self._shared_key(key) + ":lock"
+        locked = None
+        if shared is not None:
+            locked = await self._shared_call(
+                shared.add(lock_key, b"1", self.lock_ttl_seconds)
+            )
+            # None when the shared backend failed, nothing to wait for then
+            if locked is False:
+                # Another node is computing it, its value is used when ready
+                self.metrics.increment(f"cache.{self.namespace}.stampede_waits")
+                value = await self._wait_shared(shared, key)
+                if value is not None:
+                    return value
+        try:
+            self.metrics.increment(f"cache.{self.namespace}.computations")
+            value = await compute()
+            await self.set(key, value)
+        finally:
+            if shared is not None and locked:
+                await self._shared_call(shared.delete(lock_key))
+        return value
+
+    async def _wait_shared(self, shared: CacheBackend, key: str) -> Optional[Any]:
+        deadline = time.monotonic() + self.lock_ttl_seconds
+        while time.monotonic() < deadline:
+            await asyncio.sleep(LOCK_POLL_SECONDS)
+            data = await self._shared_call(shared.get(self._shared_key(key)))
+            if data is not None:
+                value = decode(data)
+                await self.local.set(key, value, self.local_ttl_seconds)
+                return value
+        return None
+
+    async def _shared_call(self, call: Awaitable[Any]) -> Any:
+        try:
+            return await call
+        except Exception as e:
+            log.error(f"Error on the shared cache {self.namespace}: {e!r}")
+            self.metrics.increment(f"cache.{self.namespace}.shared.errors")
+            return None
+
+    def _shared_key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    def _record(self, tier: str, hit: bool, start: float) -> None:
+        name = f"cache.{self.namespace}.{tier}"
+        self.metrics.observe(f"{name}.seconds", time.perf_counter() - start)
+        self.metrics.increment(f"{name}.hits" if hit else f"{name}.misses")
+        lookups = self._lookups[tier]
+        lookups[0] += hit
+        lookups[1] += 1
+        self.metrics.set_gauge(f"{name}.hit_ratio", lookups[0] / lookups[1])
+
+
+async def maintain_cache(
+    backend: DatabaseCacheBackend, interval_seconds: float
+) -> None:
+    """Delete the expired entries of the shared cache periodically."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await backend.purge_expired()
+        except Exception as e:
+            log.error("Error on purging the shared cache: %s", e)
@@ -0,0 +1,246 @@
+"""Bloom filter of the existing conversation ids.
+
+A request for a conversation id that is not in the filter is rejected
+without running the proxy or querying the database. The conversations of
+other processes are only in the filter after a refresh, so a miss also
+refreshes the filter when it was not refreshed for a second, whatever the
+number of misses. A Bloom filter has no false negatives, so an existing
+conversation is never rejected, and a false positive only means the
+request takes the usual path to a 404.
+
+For n ids and a false positive rate p the filter uses
+m = -n * ln(p) / ln(2)^2 bits and k = m / n * ln(2) hash functions: with
+the defaults of 1M ids at 1% it is 9.6 bits per id, 1.14 MiB and 7 hashes.
+"""
+
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.entities import Conversations
+from app.metrics import Metrics, metrics
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 1_000_000
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+# Rows read at once when the filter is rebuilt from the database
+REBUILD_BATCH_SIZE = 10_000
+REFRESH_OVERLAP_SECONDS = 60
+# Least seconds between two refreshes done for a miss
+DEFAULT_MISS_REFRESH_SECONDS = 1.0
+
+
+class BloomFilter:
+    """Bloom filter of uuids sized for a capacity and a false positive rate."""
+
+    def __init__(self, capacity: int, false_positive_rate: float):
+        self.capacity = max(capacity, 1)
+        self.false_positive_rate = false_positive_rate
+        self.size_bits = math.ceil(
+            -self.capacity * math.log(false_positive_rate) / math.log(2) ** 2
+        )
+        self.hashes = max(1, round(self.size_bits / self.capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray(math.ceil(self.size_bits / 8))
+        # A random key per filter so the positions of an id can not be
+        # predicted to craft false positives
+        self._key = os.urandom(16)
+
+    def add(self, value: uuid.UUID) -> None:
+        added = False
+        for position in self._positions(value):
+            mask = 1 << (position & 7)
+            if not self._bits[position >> 3] & mask:
+                self._bits[position >> 3] |= mask
+                added = True
+        # Ids added again are not counted, count sizes the next rebuild
+        if added:
+            self.count += 1
+
+    def __contains__(self, value: uuid.UUID) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(value)
+        )
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self._bits)
+
+    def expected_false_positive_rate(self) -> float:
+        """False positive rate with the ids added so far."""
+        return (1 - math.exp(-self.hashes * self.count / self.size_bits)) ** self.hashes
+
+    def _positions(self, value: uuid.UUID) -> Iterable[int]:
+        # Double hashing, the k positions are derived from two 64 bit hashes
+        digest = hashlib.blake2b(value.bytes, digest_size=16, key=self._key).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return (
+            (first + index * second) % self.size_bits for index in range(self.hashes)
+        )
+
+
+class ConversationFilter:
+    """Filter of the known conversations, rebuilt from the database.
+
+    Until the first rebuild every id might exist. The new conversations of
+    this process are added on insert and the ones created by other
+    processes are loaded by refresh. A rebuild sizes the filter for twice
+    the conversations when they are over the capacity.
+    """
+
+    def __init__(
+        self,
+        capacity: int = DEFAULT_CAPACITY,
+        false_positive_rate: float = DEFAULT_FALSE_POSITIVE_RATE,
+        miss_refresh_seconds: float = DEFAULT_MISS_REFRESH_SECONDS,
+        registry: Metrics = metrics,
+    ):
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.miss_refresh_seconds = miss_refresh_seconds
+        self.metrics = registry
+        self._filter: Optional[BloomFilter] = None
+        # Filter being built, the ids added meanwhile go to both
+        self._building: Optional[BloomFilter] = None
+        self._loaded_until: Optional[datetime] = None
+        self._refreshed_at = float("-inf")
+        # The concurrent misses share a refresh
+        self._miss_refresh = asyncio.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._filter is not None
+
+    def add(self, conversation_id: uuid.UUID) -> None:
+        for bloom in (self._filter, self._building):
+            if bloom is not None:
+                bloom.add(conversation_id)
+
+    def might_exist(self, conversation_id: uuid.UUID) -> bool:
+        return self._filter is None or conversation_id in self._filter
+
+    async def exists(self, engine: AsyncEngine, conversation_id: uuid.UUID) -> bool:
+        """Whether the conversation might exist. On a miss the filter is
+        refreshed first when its last refresh is older than
+        miss_refresh_seconds, otherwise the miss is definite."""
+        if self.might_exist(conversation_id):
+            return True
+        async with self._miss_refresh:
+            if time.monotonic() - self._refreshed_at >= self.miss_refresh_seconds:
+                self.metrics.increment("conversation_filter.miss_refreshes")
+                try:
+                    await self.refresh(engine)
+                except Exception as e:
+                    log.error("Error on refreshing the conversation filter: %s", e)
+                    # Not retried by every miss while the database fails
+                    self._refreshed_at = time.monotonic()
+        if self.might_exist(conversation_id):
+            # Created by another process since the previous refresh
+            self.metrics.increment("conversation_filter.late_ids")
+            return True
+        self.metrics.increment("conversation_filter.rejected")
+        return False
+
+    async def rebuild(self, engine: AsyncEngine) -> None:
+        """Build a new filter with every conversation and swap it in."""
+        start = time.perf_counter()
+        total = await self._count(engine)
+        capacity = max(self.capacity, 2 * total)
+        self._building = BloomFilter(capacity, self.false_positive_rate)
+        try:
+            loaded_until = await self._load(engine, self._building, since=None)
+        finally:
+            bloom, self._building = self._building, None
+        self._filter = bloom
+        self._loaded_until = loaded_until
+        self._refreshed_at = time.monotonic()
+        self.capacity = capacity
+        self._report(bloom)
+        log.info(
+            "Conversation filter rebuilt with %s ids in %.3fs",
+            bloom.count,
+            time.perf_counter() - start,
+        )
+
+    async def refresh(self, engine: AsyncEngine) -> None:
+        """Add the conversations created since the last load, rebuild when
+        the filter is over its capacity."""
+        bloom = self._filter
+        if bloom is None or bloom.count >= bloom.capacity:
+            await self.rebuild(engine)
+            return
+        loaded_until = await self._load(engine, bloom, since=self._loaded_until)
+        self._loaded_until = loaded_until or self._loaded_until
+        self._refreshed_at = time.monotonic()
+        self._report(bloom)
+
+    async def _load(
+        self, engine: AsyncEngine, bloom: BloomFilter, since: Optional[datetime]
+    ) -> Optional[datetime]:
+        stmt = select(Conversations.conversation_id, Conversations.insert_datetime)
+        if since is not None:
+            # The window overlaps the previous load so the conversations
+            # committed late or by a node with a skewed clock are not missed,
+            # adding an id twice is harmless
+            stmt = stmt.where(
+                Conversations.insert_datetime
+                >= since - timedelta(seconds=REFRESH_OVERLAP_SECONDS)
+            )
+        loaded_until = since
+        async with engine.connect() as conn:
+            result = await conn.stream(
+                stmt.execution_options(yield_per=REBUILD_BATCH_SIZE)
+            )
+            async for rows in result.partitions(REBUILD_BATCH_SIZE):
+                for conversation_id, insert_datetime in rows:
+                    bloom.add(conversation_id)
+                    if loaded_until is None or insert_datetime > loaded_until:
+                        loaded_until = insert_datetime
+        return loaded_until
+
+    @staticmethod
+    async def _count(engine: AsyncEngine) -> int:
+        async with engine.connect() as conn:
+            result = await conn.execute(select(func.count()).select_from(Conversations))
+            return int(result.scalar_one())
+
+    def _report(self, bloom: BloomFilter) -> None:
+        self.metrics.set_gauge("conversation_filter.ids", bloom.count)
+        self.metrics.set_gauge("conversation_filter.bytes", bloom.size_bytes)
+        self.metrics.set_gauge(
+            "conversation_filter.false_positive_rate",
+            bloom.expected_false_positive_rate(),
+        )
+
+
+async def maintain_conversation_filter(
+    conversation_filter: ConversationFilter,
+    engine: AsyncEngine,
+    refresh_seconds: float,
+    rebuild_seconds: float,
+) -> None:
+    """Load the new conversations periodically and rebuild the whole filter
+    less often, which also resizes it."""
+    last_rebuild = time.monotonic()
+    while True:
+        await asyncio.sleep(refresh_seconds)
+        try:
+            if time.monotonic() - last_rebuild >= rebuild_seconds:
+                await conversation_filter.rebuild(engine)
+                last_rebuild = time.monotonic()
+            else:
+                await conversation_filter.refresh(engine)
+        except Exception as e:
+            log.error("Error on refreshing the conversation filter: %s", e)
@@ -1,19 +1,121 @@
-from sqlalchemy import Engine
+import asyncio
+import itertools
+import time
+import uuid
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Optional
+
+from sqlalchemy import Engine, event, text
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlmodel import SQLModel, create_engine
 
 from app import entities
-from app.configuration import Configuration
+from app.configuration import Configuration, get_configuration
+from app.metrics import metrics
+
+PRIMARY_TARGET = "primary"
+MAX_PINNED_CONVERSATIONS = 100_000
+
+
+def database_url(conf: Configuration) -> str:
+    return (
+        f"postgresql+asyncpg://{conf.db_user}:"
+        f"{conf.db_password}@{conf.db_host}:{conf.db_port}/{conf.db_name}"
+    )
+
+
+def instrument_engine(engine: AsyncEngine, target: str) -> None:
+    """Record the latency of every query executed by the engine."""
 
-conf = Configuration()
-async_url = (
-    f"postgresql+asyncpg://{conf.db_user}:"
-    f"{conf.db_password}@{conf.db_host}:{conf.db_port}/{conf.db_name}"
-)
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(*args: Any) -> None:
+        context = args[4]
+        context._query_started = time.perf_counter()
 
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(*args: Any) -> None:
+        context = args[4]
+        elapsed = time.perf_counter() - context._query_started
+        metrics.observe(f"db.query_seconds.{target}", elapsed)
 
+
+@lru_cache(maxsize=1)
 def get_async_engine() -> AsyncEngine:
-    return create_async_engine(async_url, echo=False)
+    # A single engine is shared so every session uses the same connection pool
+    engine = create_async_engine(database_url(get_configuration()), echo=False)
+    instrument_engine(engine, PRIMARY_TARGET)
+    return engine
+
+
+class ReplicaRouter:
+    """Route reads to the replicas and writes to the primary.
+
+    A conversation that wrote is pinned to the primary during pin_seconds so
+    the replication lag never hides its own writes.
+    """
+
+    def __init__(
+        self,
+        primary: AsyncEngine,
+        replicas: list[AsyncEngine],
+        pin_seconds: float,
+        max_pinned: int = MAX_PINNED_CONVERSATIONS,
+    ):
+        self.primary = primary
+        self.replicas = replicas
+        self.pin_seconds = pin_seconds
+        self.max_pinned = max_pinned
+        self._pinned: OrderedDict[uuid.UUID, float] = OrderedDict()
+        self._next_replica = itertools.cycle(range(len(replicas)))
+
+    def mark_write(self, conversation_id: uuid.UUID) -> None:
+        if not self.replicas:
+            return
+        self._pinned[conversation_id] = time.monotonic() + self.pin_seconds
+        self._pinned.move_to_end(conversation_id)
+        # Entries are ordered by deadline, the oldest ones expire first
+        while len(self._pinned) > self.max_pinned:
+            self._pinned.popitem(last=False)
+
+    def read_target(
+        self, conversation_id: Optional[uuid.UUID] = None
+    ) -> tuple[str, AsyncEngine]:
+        if not self.replicas:
+            return PRIMARY_TARGET, self.primary
+        if conversation_id is not None and self._is_pinned(conversation_id):
+            metrics.increment("db.reads.pinned_to_primary")
+            return PRIMARY_TARGET, self.primary
+        index = next(self._next_replica)
+        return f"replica_{index}", self.replicas[index]
+
+    def read_engine(self, conversation_id: Optional[uuid.UUID] = None) -> AsyncEngine:
+        return self.read_target(conversation_id)[1]
+
+    def read_session(self, conversation_id: Optional[uuid.UUID] = None) -> AsyncSession:
+        target, engine = self.read_target(conversation_id)
+        metrics.increment(f"db.reads.{target}")
+        return AsyncSession(engine, expire_on_commit=False)
+
+    def _is_pinned(self, conversation_id: uuid.UUID) -> bool:
+        deadline = self._pinned.get(conversation_id)
+        if deadline is None:
+            return False
+        if deadline < time.monotonic():
+            del self._pinned[conversation_id]
+            return False
+        return True
+
+
+@lru_cache(maxsize=1)
+def get_replica_router() -> ReplicaRouter:
+    conf = get_configuration()
+    replicas = []
+    for index, url in enumerate(conf.db_read_replica_urls):
+        replica = create_async_engine(url, echo=False)
+        instrument_engine(replica, f"replica_{index}")
+        replicas.append(replica)
+    return ReplicaRouter(get_async_engine(), replicas, conf.db_read_your_writes_seconds)
 
 
 def get_async_session() -> AsyncSession:
@@ -21,3 +123,23 @@ def get_async_session() -> AsyncSession:
     async_engine = get_async_engine()
     async_session = AsyncSession(async_engine, expire_on_commit=False)
     return async_session
+
+
+async def prewarm_pool(engine: AsyncEngine, connections: int) -> None:
+    """Open connections of the pool ahead of the first requests.
+
+    The connections are held until all of them are open so the pool keeps
+    every one instead of reusing the first, each pays its connect here.
+    """
+    all_connected = asyncio.Barrier(connections)
+
+    async def warm_connection() -> None:
+        try:
+            async with engine.connect() as connection:
+                await connection.execute(text("SELECT 1"))
+                await all_connected.wait()
+        except Exception:
+            await all_connected.abort()
+            raise
+
+    await asyncio.gather(*(warm_connection() for _ in range(connections)))
@@ -0,0 +1,323 @@
+"""Debate sessions over a WebSocket.
+
+A session keeps the parsed model history, the last messages and the topic
+of its conversation in memory for the life of the connection, so a turn
+only writes its new messages instead of reloading and parsing the history.
+The output of the agent is held while it streams and only pushed once the
+proxy validated the whole response, so a denied response never reaches the
+client, then the final message replaces the deltas.
+
+Frames are JSON objects with a "type":
+
+* client: {"type": "message", "message": "..."}, {"type": "ping"},
+  {"type": "pong"}
+* server: {"type": "session", "conversation_id": ...}, {"type": "delta",
+  "text": "..."}, {"type": "message", ...the ResponseModel fields},
+  {"type": "error", "status": 409}, {"type": "ping"}, {"type": "pong"}
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from http import HTTPStatus
+from typing import Any, Awaitable, Callable, Optional
+
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect, status
+from pydantic_ai.messages import ModelMessage
+
+from app.conversation_filter import ConversationFilter
+from app.entities import Messages
+from app.errors import DatabaseError, ModelExecutionError
+from app.messages_adapters import (
+    AGENT_ROLE,
+    DEFAULT_HISTORY_LIMIT,
+    USER_ROLE,
+    MessagesAdapters,
+)
+from app.metrics import Metrics, metrics
+from app.models import MessageModel
+from app.proxy import Proxy
+from app.usage import set_usage_conversation
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HEARTBEAT_SECONDS = 20.0
+DEFAULT_IDLE_TIMEOUT_SECONDS = 300.0
+DEFAULT_SEND_QUEUE_FRAMES = 64
+DEFAULT_SEND_TIMEOUT_SECONDS = 10.0
+DEFAULT_MAX_PENDING_TURNS = 1
+# Same context as the REST path: the agent runs within its history limit
+MODEL_HISTORY_RUNS = (DEFAULT_HISTORY_LIMIT + 1) // 2
+# Application close code of an unknown conversation
+CLOSE_NOT_FOUND = 4404
+
+Send = Callable[[dict[str, Any]], Awaitable[None]]
+TurnHandler = Callable[[str, Send], Awaitable[None]]
+
+
+class DebateSession:
+    """State of a conversation held by its connection."""
+
+    def __init__(
+        self,
+        adapters: MessagesAdapters,
+        proxy: Proxy,
+        conversations: ConversationFilter,
+    ):
+        self.adapters = adapters
+        self.proxy = proxy
+        self.conversations = conversations
+        self.conversation_id: Optional[uuid.UUID] = None
+        # Model messages of the last agent runs, in chronological order
+        self._runs: deque[list[ModelMessage]] = deque(maxlen=MODEL_HISTORY_RUNS)
+        # Last messages from the newest to the oldest, for the responses
+        self._recent: deque[Messages] = deque(maxlen=DEFAULT_HISTORY_LIMIT)
+        self._topic: Optional[str] = None
+
+    @property
+    def model_history(self) -> list[ModelMessage]:
+        return [message for run in self._runs for message in run]
+
+    async def open(self, conversation_id: Optional[uuid.UUID]) -> None:
+        """Load the history of an existing conversation, once per connection.
+        Raises NoMessagesFoundError when the conversation does not exist."""
+        if conversation_id is None:
+            return
+        history = await self.adapters.get_history_messages(conversation_id)
+        self.conversation_id = conversation_id
+        self._recent.extend(history)
+        for row in reversed(history):
+            if row.role == AGENT_ROLE:
+                self._runs.append(self.adapters.parse_model_history([row]))
+
+    async def turn(self, text: str, send: Send) -> None:
+        """Process a message like POST /api/chat/, raises HTTPException with
+        the status the REST path would answer."""
+        message = MessageModel(
+            conversation_id=self.conversation_id,
+            message=self.proxy.obfuscate(text),
+        )
+        invalid_message = not await self.proxy.valid_message(message.message)
+        if invalid_message and self.conversation_id is None:
+            raise HTTPException(status_code=HTTPStatus.CONFLICT)
+        try:
+            if self.conversation_id is None:
+                self.conversation_id = (
+                    await self.adapters.insert_first_conversation_messages(message)
+                )
+                self.conversations.add(self.conversation_id)
+                set_usage_conversation(self.conversation_id)
+            elif not invalid_message:
+                await self.adapters.insert_message(message, self.conversation_id)
+            deltas: list[str] = []
+            if invalid_message:
+                agent_response = await self._topic_response()
+            else:
+                agent_response = await self._stream_response(message.message, deltas)
+        except DatabaseError as e:
+            log.error(f"Database error on debate session turn: {e}")
+            raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR)
+        except ModelExecutionError as e:
+            log.error(f"Model execution error on debate session turn: {e}")
+            raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR)
+        if not await self.proxy.valid_response(agent_response):
+            log.error(f"Agent response not allowed: {agent_response}")
+            agent_response = await self._topic_response()
+            deltas.clear()
+        for delta in deltas:
+            await send({"type": "delta", "text": delta})
+        history = list(self._recent)
+        payload = self.adapters.build_response_payload(
+            self.conversation_id, message, agent_response, history
+        )
+        if not invalid_message:
+            self._recent.appendleft(Messages(role=USER_ROLE, content=message.message))
+            self._recent.appendleft(Messages(role=AGENT_ROLE, content=agent_response))
+        await send({"type": "message", **payload})
+
+    async def _stream_response(self, message: str, deltas: list[str]) -> str:
+        """Run the agent collecting its deltas, they are sent after the
+        response is validated."""
+
+        async def on_delta(delta: str) -> None:
+            deltas.append(delta)
+
+        agent_response, new_messages = await self.adapters.stream_response_from_agent(
+            message,
+            self.conversation_id,  # type: ignore[arg-type]
+            self.model_history,
+            on_delta,
+        )
+        self._runs.append(new_messages)
+        # The debate moved on, the topic is asked again when needed
+        self._topic = None
+        return agent_response
+
+    async def _topic_response(self) -> str:
+        if self._topic is None:
+            self._topic = await self.adapters.get_topic_from_model_history(
+                self.model_history
+            )
+        else:
+            metrics.increment("ws.topic_reused")
+        return self._topic
+
+
+class SessionConnection:
+    """Heartbeat, idle timeout and backpressure of a session WebSocket.
+
+    The frames are sent by a single writer from a bounded queue. While the
+    client reads slower than the agent streams, the deltas are coalesced
+    instead of queued, and a client that does not take a frame within the
+    send timeout is disconnected. Turns are processed one at a time, a
+    message received with max_pending_turns already waiting is answered
+    with a 429 error frame.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        heartbeat_seconds: float = DEFAULT_HEARTBEAT_SECONDS,
+        idle_timeout_seconds: float = DEFAULT_IDLE_TIMEOUT_SECONDS,
+        send_queue_frames: int = DEFAULT_SEND_QUEUE_FRAMES,
+        send_timeout_seconds: float = DEFAULT_SEND_TIMEOUT_SECONDS,
+        max_pending_turns: int = DEFAULT_MAX_PENDING_TURNS,
+        registry: Metrics = metrics,
+    ):
+        self.websocket = websocket
+        self.heartbeat_seconds = heartbeat_seconds
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.send_timeout_seconds = send_timeout_seconds
+        self.metrics = registry
+        self._outbox: asyncio.Queue[dict[str, Any]] = asyncio.Queue(send_queue_frames)
+        self._turns: asyncio.Queue[str] = asyncio.Queue(max_pending_turns)
+        # Text of the deltas not queued yet because the outbox was full
+        self._pending_delta: list[str] = []
+        # Any frame proves the client is alive, only messages are activity
+        self._last_received = self._last_activity = time.monotonic()
+        self._processing = False
+
+    async def send(self, frame: dict[str, Any]) -> None:
+        if frame["type"] == "delta":
+            self._pending_delta.append(frame["text"])
+            if self._outbox.full():
+                self.metrics.increment("ws.deltas_coalesced")
+                return
+            frame = {"type": "delta", "text": "".join(self._pending_delta)}
+            self._pending_delta.clear()
+        else:
+            await self._flush_delta()
+        await self._put(frame)
+
+    async def serve(self, handle_turn: TurnHandler) -> None:
+        """Run the connection until the client leaves or is disconnected."""
+        self.metrics.increment("ws.sessions")
+        tasks = [
+            asyncio.create_task(self._write()),
+            asyncio.create_task(self._read()),
+            asyncio.create_task(self._process(handle_turn)),
+            asyncio.create_task(self._heartbeat()),
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            # A cancelled gather raises its own CancelledError, which the
+            # cancel scope of the server would not recognize as its own
+            await asyncio.wait(tasks)
+        for task in done:
+            error = task.exception()
+            if isinstance(error, asyncio.TimeoutError):
+                log.warning("Debate session client too slow, disconnecting")
+                self.metrics.increment("ws.slow_clients")
+                await self._close(status.WS_1013_TRY_AGAIN_LATER)
+            elif error is not None and not isinstance(error, WebSocketDisconnect):
+                log.error(f"Error on debate session: {error!r}")
+                await self._close(status.WS_1011_INTERNAL_ERROR)
+
+    async def _flush_delta(self) -> None:
+        if self._pending_delta:
+            frame = {"type": "delta", "text": "".join(self._pending_delta)}
+            self._pending_delta.clear()
+            await self._put(frame)
+
+    async def _put(self, frame: dict[str, Any]) -> None:
+        # Not wait_for, which loses a cancellation arriving with the result
+        # on Python 3.11 and would leave the task running after serve
+        async with asyncio.timeout(self.send_timeout_seconds):
+            await self._outbox.put(frame)
+
+    async def _write(self) -> None:
+        while True:
+            frame = await self._outbox.get()
+            async with asyncio.timeout(self.send_timeout_seconds):
+                await self.websocket.send_text(json.dumps(frame, default=str))
+            if not self._outbox.qsize():
+                await self._flush_delta()
+
+    async def _read(self) -> None:
+        while True:
+            raw = await self.websocket.receive_text()
+            self._last_received = time.monotonic()
+            try:
+                frame = json.loads(raw)
+            except ValueError:
+                frame = None
+            frame_type = frame.get("type") if isinstance(frame, dict) else None
+            if frame_type == "ping":
+                await self.send({"type": "pong"})
+            elif frame_type == "pong":
+                continue
+            elif frame_type == "message" and isinstance(frame.get("message"), str):
+                self._last_activity = self._last_received
+                try:
+                    self._turns.put_nowait(frame["message"])
+                except asyncio.QueueFull:
+                    self.metrics.increment("ws.turns_rejected")
+                    await self.send({"type": "error", "status": 429})
+            else:
+                await self.send({"type": "error", "status": 400})
+
+    async def _process(self, handle_turn: TurnHandler) -> None:
+        while True:
+            text = await self._turns.get()
+            start = time.perf_counter()
+            self._processing = True
+            try:
+                await handle_turn(text, self.send)
+            except HTTPException as e:
+                await self.send({"type": "error", "status": e.status_code})
+            finally:
+                self._processing = False
+                self._last_activity = time.monotonic()
+            self.metrics.observe("ws.turn_seconds", time.perf_counter() - start)
+
+    async def _heartbeat(self) -> None:
+        """Ping the client, disconnect it when it stopped answering the pings
+        or sent no message within the idle timeout."""
+        while True:
+            await asyncio.sleep(min(self.heartbeat_seconds, self.idle_timeout_seconds))
+            now = time.monotonic()
+            if now - self._last_received >= 2 * self.heartbeat_seconds:
+                log.info("Debate session client stopped answering, disconnecting")
+                self.metrics.increment("ws.dead_clients")
+                await self._close(status.WS_1001_GOING_AWAY)
+                return
+            idle = now - self._last_activity
+            if not self._processing and idle >= self.idle_timeout_seconds:
+                log.info("Debate session idle, disconnecting")
+                self.metrics.increment("ws.idle_disconnects")
+                await self._close(status.WS_1000_NORMAL_CLOSURE)
+                return
+            await self.send({"type": "ping"})
+
+    async def _close(self, code: int) -> None:
+        try:
+            await self.websocket.close(code)
+        except RuntimeError:
+            # Already closed by the client
+            pass
@@ -2,7 +2,7 @@ import uuid
 from datetime import datetime
 from typing import Any, Dict, Optional
 
-from sqlalchemy import Text
+from sqlalchemy import Index, LargeBinary, Text
 from sqlmodel import Column, Field, SQLModel
 
 
@@ -14,6 +14,18 @@ class Conversations(SQLModel, table=True):
 
 class Messages(SQLModel, table=True):
     __tablename__ = "messages"  # type: ignore
+    __table_args__ = (
+        # Supports the history query and the keyset pagination of messages
+        Index(
+            "ix_messages_conversation_history",
+            "conversation_id",
+            "insert_datetime",
+            "message_id",
+        ),
+        # Ignored by other databases than postgres, partitions are managed in
+        # app.partitions
+        {"postgresql_partition_by": "RANGE (insert_datetime)"},
+    )
     message_id: uuid.UUID = Field(primary_key=True, default_factory=uuid.uuid4)
     conversation_id: uuid.UUID = Field(foreign_key="conversations.conversation_id")
     content: str
@@ -21,4 +33,50 @@ class Messages(SQLModel, table=True):
     metadata_response: Optional[Dict[str, Any]] = Field(
         default=None, sa_column=Column(Text)
     )
-    insert_datetime: datetime = Field(default_factory=datetime.now)
+    # Part of the primary key because it is the partition key
+    insert_datetime: datetime = Field(primary_key=True, default_factory=datetime.now)
+
+
+class IdempotencyKeys(SQLModel, table=True):
+    __tablename__ = "idempotency_keys"  # type: ignore
+    idempotency_key: str = Field(primary_key=True, max_length=255)
+    # Hash of the request, a key can not be reused with another request
+    fingerprint: str
+    status_code: int
+    body: str = Field(sa_column=Column(Text))
+    insert_datetime: datetime = Field(default_factory=datetime.now, index=True)
+
+
+class RateLimitBuckets(SQLModel, table=True):
+    """Token buckets of app.ratelimit shared between nodes."""
+
+    __tablename__ = "rate_limit_buckets"  # type: ignore
+    bucket_key: str = Field(primary_key=True, max_length=255)
+    tokens: float
+    # Epoch seconds of the last request
+    updated_at: float
+    allowed: int
+
+
+class UsageCounters(SQLModel, table=True):
+    """Token usage and model calls of app.usage, per conversation or client."""
+
+    __tablename__ = "usage_counters"  # type: ignore
+    scope: str = Field(primary_key=True, max_length=32)
+    usage_key: str = Field(primary_key=True, max_length=255)
+    input_tokens: int = 0
+    output_tokens: int = 0
+    main_calls: int = 0
+    proxy_calls: int = 0
+    # Epoch seconds of the last flush
+    updated_at: float
+
+
+class CacheEntries(SQLModel, table=True):
+    """Encoded values of the shared tier of app.cache."""
+
+    __tablename__ = "cache_entries"  # type: ignore
+    cache_key: str = Field(primary_key=True, max_length=255)
+    value: bytes = Field(sa_column=Column(LargeBinary, nullable=False))
+    # Epoch seconds the entry expires at
+    expires_at: float = Field(index=True)
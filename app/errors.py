@@ -14,3 +14,15 @@ class ModelExecutionError(Exception):
     """Exception raised when a model error occurs"""
 
     pass
+
+
+class IdempotencyKeyConflictError(Exception):
+    """Exception raised when an idempotency key is reused with another request"""
+
+    pass
+
+
+class JobQueueFullError(Exception):
+    """Exception raised when a job is submitted with the job queue full"""
+
+    pass
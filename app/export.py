@@ -0,0 +1,141 @@
+"""Streaming export of conversations and messages for analytics.
+
+Run with: python -m app.export --format ndjson --since 2025-01-01 > export.ndjson
+"""
+
+import argparse
+import asyncio
+import csv
+import io
+import json
+import logging
+import sys
+import time
+from datetime import datetime
+from typing import Any, AsyncGenerator, Optional, Sequence
+
+from sqlalchemy import Row, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.entities import Conversations, Messages
+from app.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ("ndjson", "csv")
+DEFAULT_CHUNK_SIZE = 1000
+EXPORT_COLUMNS = [
+    "conversation_id",
+    "conversation_insert_datetime",
+    "message_id",
+    "role",
+    "content",
+    "metadata_response",
+    "insert_datetime",
+]
+
+
+def _export_statement(since: Optional[datetime], until: Optional[datetime]) -> Any:
+    stmt = (
+        select(
+            Conversations.conversation_id,
+            Conversations.insert_datetime,
+            Messages.message_id,
+            Messages.role,
+            Messages.content,
+            Messages.metadata_response,
+            Messages.insert_datetime,
+        )
+        .join(Messages, Messages.conversation_id == Conversations.conversation_id)
+        .order_by(Messages.insert_datetime)
+    )
+    if since is not None:
+        stmt = stmt.where(Messages.insert_datetime >= since)
+    if until is not None:
+        stmt = stmt.where(Messages.insert_datetime < until)
+    return stmt
+
+
+def _to_ndjson(rows: Sequence[Row]) -> bytes:
+    lines = [
+        json.dumps(dict(zip(EXPORT_COLUMNS, row)), default=str, ensure_ascii=False)
+        for row in rows
+    ]
+    return ("\n".join(lines) + "\n").encode()
+
+
+def _to_csv(rows: Sequence[Row], header: bool) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(EXPORT_COLUMNS)
+    writer.writerows(rows)
+    return buffer.getvalue().encode()
+
+
+async def stream_export(
+    engine: AsyncEngine,
+    export_format: str = "ndjson",
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> AsyncGenerator[bytes, None]:
+    """Stream conversations with their messages in chunks of chunk_size rows.
+
+    Rows are read through a server side cursor, so memory stays constant no
+    matter the size of the tables.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    if export_format == "csv":
+        yield _to_csv([], header=True)
+    exported = 0
+    started = time.perf_counter()
+    stmt = _export_statement(since, until).execution_options(yield_per=chunk_size)
+    async with engine.connect() as conn:
+        result = await conn.stream(stmt)
+        async for rows in result.partitions(chunk_size):
+            if export_format == "csv":
+                yield _to_csv(rows, header=False)
+            else:
+                yield _to_ndjson(rows)
+            exported += len(rows)
+    elapsed = time.perf_counter() - started
+    rows_per_second = exported / elapsed if elapsed else 0.0
+    metrics.increment("export.rows", exported)
+    metrics.set_gauge("export.rows_per_second", rows_per_second)
+    log.info(
+        "Exported %s rows in %.2fs (%.0f rows/s)", exported, elapsed, rows_per_second
+    )
+
+
+async def _export_to_file(args: argparse.Namespace) -> None:
+    from app.db import get_async_engine
+
+    engine = get_async_engine()
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        async for chunk in stream_export(
+            engine, args.format, args.since, args.until, args.chunk_size
+        ):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+        await engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="ndjson")
+    parser.add_argument("--since", type=datetime.fromisoformat)
+    parser.add_argument("--until", type=datetime.fromisoformat)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--output", help="File to write, stdout by default")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    asyncio.run(_export_to_file(args))
+
+
+if __name__ == "__main__":
+    main()
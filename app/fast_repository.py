@@ -0,0 +1,127 @@
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Optional
+
+import asyncpg
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.db import ReplicaRouter
+from app.errors import DatabaseError
+
+# asyncpg prepares every query once per connection and keeps it in the
+# statement cache of the connection, later executions only send the arguments
+HISTORY_QUERY = """
+SELECT message_id, conversation_id, role, content, metadata_response, insert_datetime
+FROM messages
+WHERE conversation_id = $1
+  AND insert_datetime >= (
+    SELECT insert_datetime - interval '1 minute'
+    FROM conversations WHERE conversation_id = $1
+  )
+ORDER BY insert_datetime DESC
+LIMIT $2
+"""
+INSERT_MESSAGE_QUERY = """
+INSERT INTO messages (
+    message_id, conversation_id, role, content, metadata_response, insert_datetime
+) VALUES ($1, $2, $3, $4, $5, $6)
+"""
+INSERT_CONVERSATION_QUERY = """
+INSERT INTO conversations (conversation_id, insert_datetime) VALUES ($1, $2)
+"""
+
+
+@dataclass(slots=True)
+class MessageRow:
+    """Lightweight row of the messages table, with the attributes of Messages."""
+
+    message_id: uuid.UUID
+    conversation_id: uuid.UUID
+    role: str
+    content: str
+    metadata_response: Optional[str]
+    insert_datetime: datetime
+
+
+class AsyncpgMessagesRepository:
+    """Hot queries of the messages executed with asyncpg on the shared pool.
+
+    Skips the ORM object construction and identity map bookkeeping, the
+    connections are borrowed from the pool of the sqlalchemy engines.
+    """
+
+    def __init__(self, router: ReplicaRouter):
+        self.router = router
+
+    async def get_history(
+        self, conversation_id: uuid.UUID, limit: int
+    ) -> list[MessageRow]:
+        engine = self.router.read_engine(conversation_id)
+        records = await self._fetch(engine, HISTORY_QUERY, conversation_id, limit)
+        return [MessageRow(*record) for record in records]
+
+    async def insert_message(
+        self,
+        conversation_id: uuid.UUID,
+        role: str,
+        content: str,
+        metadata_response: Optional[str] = None,
+    ) -> None:
+        await self._execute(
+            self.router.primary,
+            INSERT_MESSAGE_QUERY,
+            uuid.uuid4(),
+            conversation_id,
+            role,
+            content,
+            metadata_response,
+            datetime.now(),
+        )
+
+    async def insert_first_conversation(self, role: str, content: str) -> uuid.UUID:
+        conversation_id = uuid.uuid4()
+        try:
+            async with self.router.primary.connect() as conn:
+                raw_connection = await self._driver_connection(conn)
+                async with raw_connection.transaction():
+                    inserted = datetime.now()
+                    await raw_connection.execute(
+                        INSERT_CONVERSATION_QUERY, conversation_id, inserted
+                    )
+                    await raw_connection.execute(
+                        INSERT_MESSAGE_QUERY,
+                        uuid.uuid4(),
+                        conversation_id,
+                        role,
+                        content,
+                        None,
+                        inserted,
+                    )
+        except (SQLAlchemyError, asyncpg.PostgresError, OSError) as e:
+            raise DatabaseError from e
+        return conversation_id
+
+    async def _fetch(self, engine: AsyncEngine, query: str, *args: Any) -> list[Any]:
+        try:
+            async with engine.connect() as conn:
+                raw_connection = await self._driver_connection(conn)
+                records: list[Any] = await raw_connection.fetch(query, *args)
+        except (SQLAlchemyError, asyncpg.PostgresError, OSError) as e:
+            raise DatabaseError from e
+        return records
+
+    async def _execute(self, engine: AsyncEngine, query: str, *args: Any) -> None:
+        try:
+            async with engine.connect() as conn:
+                raw_connection = await self._driver_connection(conn)
+                await raw_connection.execute(query, *args)
+        except (SQLAlchemyError, asyncpg.PostgresError, OSError) as e:
+            raise DatabaseError from e
+
+    @staticmethod
+    async def _driver_connection(conn: Any) -> asyncpg.Connection:
+        raw_connection = await conn.get_raw_connection()
+        driver_connection: asyncpg.Connection = raw_connection.driver_connection
+        return driver_connection
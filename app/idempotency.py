@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy import delete
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from app.entities import IdempotencyKeys
+from app.errors import IdempotencyKeyConflictError
+from app.metrics import Metrics, metrics
+
+log = logging.getLogger(__name__)
+
+MAX_KEY_LENGTH = 255
+
+
+@dataclass(slots=True)
+class StoredResponse:
+    fingerprint: str
+    status_code: int
+    body: bytes
+    expires_at: float
+
+
+def request_fingerprint(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+class IdempotencyStore:
+    """Remember the responses of the requests sent with an idempotency key.
+
+    A repeated key gets the stored response, or waits for the in-flight
+    request with the same key, so the work is done once. The responses are
+    kept in a bounded LRU and, when an engine is given, persisted in the
+    database so they survive restarts and are shared between processes.
+    Only successful responses are stored, a failed request can be retried.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: float,
+        engine: Optional[AsyncEngine] = None,
+        registry: Metrics = metrics,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.engine = engine
+        self.metrics = registry
+        self._responses: OrderedDict[str, StoredResponse] = OrderedDict()
+        self._in_flight: dict[str, tuple[str, asyncio.Future[StoredResponse]]] = {}
+
+    async def do(
+        self,
+        key: str,
+        fingerprint: str,
+        fn: Callable[[], Awaitable[tuple[int, bytes]]],
+    ) -> tuple[StoredResponse, bool]:
+        """Return the response for the key and whether it was replayed."""
+        stored = self._get(key) or await self._load(key)
+        if stored is not None:
+            self._check_fingerprint(stored.fingerprint, fingerprint)
+            self.metrics.increment("idempotency.replayed")
+            return stored, True
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self._check_fingerprint(in_flight[0], fingerprint)
+            self.metrics.increment("idempotency.attached")
+            return await asyncio.shield(in_flight[1]), True
+
+        self.metrics.increment("idempotency.executed")
+        call = asyncio.ensure_future(self._execute(key, fingerprint, fn))
+        self._in_flight[key] = (fingerprint, call)
+        call.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # A caller that is cancelled must not cancel the request of the others
+        return await asyncio.shield(call), False
+
+    async def _execute(
+        self,
+        key: str,
+        fingerprint: str,
+        fn: Callable[[], Awaitable[tuple[int, bytes]]],
+    ) -> StoredResponse:
+        status_code, body = await fn()
+        stored = StoredResponse(
+            fingerprint, status_code, body, time.monotonic() + self.ttl_seconds
+        )
+        if status_code < 400:
+            self._put(key, stored)
+            await self._save(key, stored)
+        return stored
+
+    @staticmethod
+    def _check_fingerprint(stored: str, received: str) -> None:
+        if stored != received:
+            raise IdempotencyKeyConflictError
+
+    def _get(self, key: str) -> Optional[StoredResponse]:
+        stored = self._responses.get(key)
+        if stored is None:
+            return None
+        if stored.expires_at < time.monotonic():
+            del self._responses[key]
+            return None
+        self._responses.move_to_end(key)
+        return stored
+
+    def _put(self, key: str, stored: StoredResponse) -> None:
+        self._responses[key] = stored
+        self._responses.move_to_end(key)
+        while len(self._responses) > self.max_entries:
+            self._responses.popitem(last=False)
+
+    async def _load(self, key: str) -> Optional[StoredResponse]:
+        if self.engine is None:
+            return None
+        try:
+            async with AsyncSession(self.engine, expire_on_commit=False) as session:
+                record = await session.get(IdempotencyKeys, key)
+        except SQLAlchemyError as e:
+            log.error(f"Database error on loading idempotency key: {e}")
+            return None
+        if record is None:
+            return None
+        age = (datetime.now() - record.insert_datetime).total_seconds()
+        if age > self.ttl_seconds:
+            return None
+        stored = StoredResponse(
+            record.fingerprint,
+            record.status_code,
+            record.body.encode(),
+            time.monotonic() + self.ttl_seconds - age,
+        )
+        self._put(key, stored)
+        return stored
+
+    async def _save(self, key: str, stored: StoredResponse) -> None:
+        if self.engine is None:
+            return
+        record = IdempotencyKeys(
+            idempotency_key=key,
+            fingerprint=stored.fingerprint,
+            status_code=stored.status_code,
+            body=stored.body.decode(),
+        )
+        try:
+            async with AsyncSession(self.engine, expire_on_commit=False) as session:
+                async with session.begin():
+                    await session.merge(record)
+        except SQLAlchemyError as e:
+            # The response is still kept in memory
+            log.error(f"Database error on saving idempotency key: {e}")
+
+    async def purge_expired(self) -> int:
+        """Delete the persisted keys older than the ttl, return how many."""
+        if self.engine is None:
+            return 0
+        limit = datetime.now() - timedelta(seconds=self.ttl_seconds)
+        async with AsyncSession(self.engine) as session:
+            async with session.begin():
+                result = await session.execute(
+                    delete(IdempotencyKeys).where(
+                        IdempotencyKeys.insert_datetime < limit  # type: ignore
+                    )
+                )
+        return result.rowcount
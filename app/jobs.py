@@ -0,0 +1,246 @@
+"""Chat turns run as asynchronous jobs.
+
+POST /api/chat/jobs answers 202 with the id of a job instead of holding the
+connection during the proxy and agent calls. A bounded pool of workers runs
+the queued jobs by priority, and the clients long poll the job or subscribe
+to its status changes. A job that is not finished by its deadline expires
+and a queued or running job can be cancelled.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Coroutine, Optional
+
+from app.errors import JobQueueFullError
+from app.metrics import Metrics, metrics
+
+log = logging.getLogger(__name__)
+
+JOB_PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+EXPIRED = "expired"
+FINAL_STATUSES = (SUCCEEDED, FAILED, CANCELLED, EXPIRED)
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_QUEUED = 1000
+DEFAULT_MAX_FINISHED = 10_000
+# Last bytes of a job id holding the index of the worker process that queued
+# it, so the dispatcher routes the job without remembering it
+WORKER_INDEX_BYTES = 2
+
+# Returns the status code and the body of the response of the job
+JobFunction = Callable[[], Coroutine[Any, Any, tuple[int, bytes]]]
+
+
+def new_job_id(worker_index: Optional[int] = None) -> uuid.UUID:
+    """Random job id, ending with the worker index when it is given."""
+    job_id = uuid.uuid4()
+    if worker_index is None:
+        return job_id
+    suffix = worker_index.to_bytes(WORKER_INDEX_BYTES, "big")
+    return uuid.UUID(bytes=job_id.bytes[:-WORKER_INDEX_BYTES] + suffix)
+
+
+def job_worker_index(job_id: uuid.UUID) -> int:
+    """Index of the worker written in the id by new_job_id."""
+    return int.from_bytes(job_id.bytes[-WORKER_INDEX_BYTES:], "big")
+
+
+@dataclass(eq=False)
+class Job:
+    job_id: uuid.UUID
+    priority: str
+    fn: JobFunction = field(repr=False)
+    # Monotonic time the job has to be finished by
+    deadline: float
+    status: str = QUEUED
+    status_code: Optional[int] = None
+    body: Optional[bytes] = None
+    created_at: float = field(default_factory=time.monotonic)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+    # Replaced on every status change, set to wake up the waiters
+    _changed: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINAL_STATUSES
+
+    def set_status(self, status: str) -> None:
+        self.status = status
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self, status: str, timeout: float) -> None:
+        """Wait until the status is another than the given one or the timeout
+        expires, a change made before the call is not missed."""
+        if self.status != status or timeout <= 0:
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def wait_finished(self, timeout: float) -> None:
+        end = time.monotonic() + timeout
+        while not self.finished and (remaining := end - time.monotonic()) > 0:
+            await self.wait(self.status, remaining)
+
+    def describe(self) -> dict[str, Any]:
+        description: dict[str, Any] = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "priority": self.priority,
+        }
+        if self.started_at is not None:
+            description["queued_seconds"] = self.started_at - self.created_at
+        if self.finished_at is not None:
+            description["seconds"] = self.finished_at - self.created_at
+        if self.status_code is not None:
+            description["status_code"] = self.status_code
+            description["result"] = json.loads(self.body) if self.body else None
+        return description
+
+
+class JobRunner:
+    """Priority queue of jobs processed by a fixed number of workers.
+
+    The queue is bounded, a job submitted with max_queued jobs waiting is
+    rejected. The finished jobs are kept for their clients up to
+    max_finished, the oldest ones are forgotten first.
+    """
+
+    def __init__(
+        self,
+        workers: int = DEFAULT_WORKERS,
+        max_queued: int = DEFAULT_MAX_QUEUED,
+        max_finished: int = DEFAULT_MAX_FINISHED,
+        worker_index: Optional[int] = None,
+        registry: Metrics = metrics,
+    ):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        # Index of this process among the workers of the dispatcher
+        self.worker_index = worker_index
+        self.metrics = registry
+        self._queue: asyncio.PriorityQueue[tuple[int, int, Job]] = (
+            asyncio.PriorityQueue()
+        )
+        # Same priority jobs run in the order they were submitted
+        self._sequence = itertools.count()
+        self._jobs: dict[uuid.UUID, Job] = {}
+        self._finished: OrderedDict[uuid.UUID, None] = OrderedDict()
+        self._workers: list[asyncio.Task] = []
+        self._running = 0
+
+    def start(self) -> None:
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Cancel the workers and the running jobs and wait for them to end,
+        so no job uses the database or the models after it returns."""
+        tasks = [job.task for job in self._jobs.values() if job.task is not None]
+        tasks += self._workers
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, fn: JobFunction, priority: str, deadline_seconds: float) -> Job:
+        """Queue a job, raises JobQueueFullError when the queue is full."""
+        if self._queue.qsize() >= self.max_queued:
+            self.metrics.increment("jobs.rejected")
+            raise JobQueueFullError
+        job = Job(
+            job_id=new_job_id(self.worker_index),
+            priority=priority,
+            fn=fn,
+            deadline=time.monotonic() + deadline_seconds,
+        )
+        self._jobs[job.job_id] = job
+        self._queue.put_nowait((JOB_PRIORITIES[priority], next(self._sequence), job))
+        self.metrics.increment("jobs.submitted")
+        self._report()
+        return job
+
+    def get(self, job_id: uuid.UUID) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def cancel(self, job: Job) -> bool:
+        """Cancel a queued or running job, False if it already finished."""
+        if job.finished:
+            return False
+        if job.task is not None:
+            # The worker records the cancellation when the task ends
+            job.task.cancel()
+        else:
+            # Skipped by the worker that takes it from the queue
+            self._finish(job, CANCELLED)
+        return True
+
+    async def _work(self) -> None:
+        while True:
+            _, _, job = await self._queue.get()
+            self._report()
+            if job.finished:
+                continue
+            if time.monotonic() >= job.deadline:
+                self._finish(job, EXPIRED)
+                continue
+            self._running += 1
+            self._report()
+            try:
+                await self._run(job)
+            finally:
+                self._running -= 1
+                self._report()
+
+    async def _run(self, job: Job) -> None:
+        job.started_at = time.monotonic()
+        self.metrics.observe("jobs.queued_seconds", job.started_at - job.created_at)
+        job.set_status(RUNNING)
+        job.task = asyncio.create_task(job.fn())
+        # Waiting on the task does not raise when it is cancelled or fails
+        done, _ = await asyncio.wait(
+            {job.task}, timeout=max(job.deadline - time.monotonic(), 0)
+        )
+        if not done:
+            job.task.cancel()
+            await asyncio.gather(job.task, return_exceptions=True)
+            self._finish(job, EXPIRED)
+        elif job.task.cancelled():
+            self._finish(job, CANCELLED)
+        elif job.task.exception() is not None:
+            log.error(f"Error on running job {job.job_id}: {job.task.exception()!r}")
+            job.status_code = 500
+            self._finish(job, FAILED)
+        else:
+            job.status_code, job.body = job.task.result()
+            self._finish(job, SUCCEEDED if job.status_code < 400 else FAILED)
+        self.metrics.observe("jobs.run_seconds", time.monotonic() - job.started_at)
+
+    def _finish(self, job: Job, status: str) -> None:
+        job.finished_at = time.monotonic()
+        job.task = None
+        job.set_status(status)
+        self.metrics.increment(f"jobs.{status}")
+        self.metrics.observe("jobs.latency_seconds", job.finished_at - job.created_at)
+        self._finished[job.job_id] = None
+        while len(self._finished) > self.max_finished:
+            job_id, _ = self._finished.popitem(last=False)
+            self._jobs.pop(job_id, None)
+
+    def _report(self) -> None:
+        self.metrics.set_gauge("jobs.queue_depth", self._queue.qsize())
+        self.metrics.set_gauge("jobs.running", self._running)
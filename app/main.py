@@ -1,57 +1,420 @@
+import asyncio
+import hashlib
+import json
 import logging
+import secrets
+import time
 import uuid
 from contextlib import asynccontextmanager
+from datetime import datetime
 from http import HTTPStatus
-from typing import Annotated, AsyncGenerator
+from typing import Annotated, AsyncGenerator, Optional
 
 import fastapi
+import pydantic_core
 import uvicorn
-from fastapi import Depends, HTTPException
+from fastapi import (
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    WebSocket,
+    status,
+)
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncEngine
 
-from app.configuration import Configuration
+from app.cache import maintain_cache
+from app.configuration import get_configuration
+from app.conversation_filter import (
+    ConversationFilter,
+    maintain_conversation_filter,
+)
 from app.db import SQLModel, get_async_engine
-from app.depends import MessagesAdapters, get_adapter, get_proxy
-from app.errors import DatabaseError, ModelExecutionError, NoMessagesFoundError
-from app.models import MessageModel, ResponseModel
+from app.debate_session import (
+    CLOSE_NOT_FOUND,
+    DebateSession,
+    Send,
+    SessionConnection,
+)
+from app.depends import (
+    MessagesAdapters,
+    get_adapter,
+    get_conversation_filter,
+    get_engine,
+    get_idempotency_store,
+    get_job_runner,
+    get_main_agent,
+    get_model,
+    get_model_http_client,
+    get_model_transport,
+    get_proxy,
+    get_rate_limit_backend,
+    get_rule_packs,
+    get_shared_cache_backend,
+    get_usage_tracker,
+)
+from app.errors import (
+    DatabaseError,
+    IdempotencyKeyConflictError,
+    JobQueueFullError,
+    ModelExecutionError,
+    NoMessagesFoundError,
+)
+from app.export import EXPORT_FORMATS, stream_export
+from app.idempotency import MAX_KEY_LENGTH, IdempotencyStore, request_fingerprint
+from app.jobs import JOB_PRIORITIES, JobRunner
+from app.messages_adapters import DEFAULT_MESSAGE_PAGE_FIELDS, MESSAGE_PAGE_COLUMNS
+from app.metrics import metrics
+from app.models import (
+    MessageModel,
+    MessagesPageModel,
+    ModerationBatchModel,
+    ModerationVerdictModel,
+    ResponseModel,
+)
+from app.partitions import ensure_partitions, maintain_partitions
 from app.proxy import Proxy
+from app.ratelimit import RateLimit, RateLimitMiddleware, client_key, hash_api_key
+from app.request_limits import BodySizeLimitMiddleware
+from app.responses import CompressionMiddleware, FastJSONResponse
+from app.rule_packs import RuleEngine, maintain_rule_packs
+from app.singleflight import SingleFlight
+from app.startup import warm_up
+from app.text_analysis import repetition_score
+from app.usage import (
+    USAGE_SCOPES,
+    UsageScope,
+    UsageTracker,
+    maintain_usage,
+    set_usage_conversation,
+    usage_scope,
+)
 from app.utils import configure_logger
 
 AdapterDeps = Annotated[MessagesAdapters, Depends(get_adapter)]
+EngineDeps = Annotated[AsyncEngine, Depends(get_engine)]
 ProxyDeps = Annotated[Proxy, Depends(get_proxy)]
+IdempotencyDeps = Annotated[IdempotencyStore, Depends(get_idempotency_store)]
+RulePacksDeps = Annotated[RuleEngine, Depends(get_rule_packs)]
+UsageDeps = Annotated[UsageTracker, Depends(get_usage_tracker)]
+ConversationFilterDeps = Annotated[ConversationFilter, Depends(get_conversation_filter)]
+JobsDeps = Annotated[JobRunner, Depends(get_job_runner)]
+
+CHAT_PATH = "/api/chat/"
 
 responses = {
     "400": {"description": "Problems with request"},
     "404": {"description": "Conversation not found"},
     "409": {"description": "Conflict the message received from the user"},
+    "413": {"description": "Request or message too large"},
+    "422": {"description": "Idempotency key reused with another request"},
+    "429": {"description": "Token budget of the conversation or client used up"},
     "500": {"description": "Problems with other services"},
+    "503": {"description": "Job queue full"},
 }
 
 
 @asynccontextmanager
 async def lifespan(_app: fastapi.FastAPI) -> AsyncGenerator[None, None]:
+    started = time.perf_counter()
+    conf = get_configuration()
     engine = get_async_engine()
     async with engine.begin() as conn:
         await conn.run_sync(SQLModel.metadata.create_all)
+    await ensure_partitions(engine, conf.messages_partitions_ahead)
+    partitions_task = asyncio.create_task(
+        maintain_partitions(
+            engine,
+            conf.messages_partitions_ahead,
+            conf.messages_retention_months,
+            conf.messages_archive_dir,
+            conf.messages_partitions_interval_seconds,
+        )
+    )
+    rule_packs_task = asyncio.create_task(
+        maintain_rule_packs(get_rule_packs(), conf.rule_packs_reload_interval_seconds)
+    )
+    usage_task = asyncio.create_task(
+        maintain_usage(get_usage_tracker(), conf.usage_flush_interval_seconds)
+    )
+    conversation_filter_task = None
+    if conf.conversation_filter_enabled:
+        await get_conversation_filter().rebuild(engine)
+        conversation_filter_task = asyncio.create_task(
+            maintain_conversation_filter(
+                get_conversation_filter(),
+                engine,
+                conf.conversation_filter_refresh_seconds,
+                conf.conversation_filter_rebuild_seconds,
+            )
+        )
+    cache_task = None
+    shared_cache = get_shared_cache_backend()
+    if shared_cache is not None:
+        cache_task = asyncio.create_task(
+            maintain_cache(shared_cache, conf.cache_purge_interval_seconds)
+        )
+    await get_idempotency_store().purge_expired()
+    # The agents are built and the connections opened before serving
+    get_main_agent()
+    get_proxy()
+    get_rate_limit_backend()
+    await warm_up(
+        engine,
+        [get_model()],
+        get_model_http_client(),
+        conf.db_prewarm_connections,
+        conf.startup_warm_up_timeout_seconds,
+    )
+    get_job_runner().start()
+    metrics.set_gauge("startup.seconds", time.perf_counter() - started)
     yield
+    await get_job_runner().stop()
+    partitions_task.cancel()
+    rule_packs_task.cancel()
+    usage_task.cancel()
+    if conversation_filter_task is not None:
+        conversation_filter_task.cancel()
+    if cache_task is not None:
+        cache_task.cancel()
+    await get_usage_tracker().flush()
+    await get_model_transport().aclose()
 
 
 log = logging.getLogger(__name__)
+conf = get_configuration()
+turns_singleflight: SingleFlight[Response] = SingleFlight("chat.singleflight")
+api_keys = frozenset(hash_api_key(api_key) for api_key in conf.api_keys)
 app = fastapi.FastAPI(
     lifespan=lifespan,
     description="Agent to debate with the user",
     version="0.0.1",
     openapi_url="/api/openapi.json",
 )
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=conf.response_compression_min_size,
+)
+app.add_middleware(BodySizeLimitMiddleware, max_body_bytes=conf.max_request_bytes)
+rate_limits = {
+    path: RateLimit.per_minute(requests)
+    for path, requests in conf.rate_limit_per_minute.items()
+}
+# Added last so it is the outermost middleware and rejects before any work
+app.add_middleware(
+    RateLimitMiddleware,
+    limits=rate_limits,
+    get_backend=get_rate_limit_backend,
+    api_keys=api_keys,
+)
 
 
-@app.post("/api/chat/", response_model=ResponseModel, responses=responses)
+@app.post(CHAT_PATH, response_model=ResponseModel, responses=responses)
 async def send_messages(
-    message: MessageModel, adapters: AdapterDeps, proxy: ProxyDeps
-) -> ResponseModel:
+    message: MessageModel,
+    request: Request,
+    adapters: AdapterDeps,
+    proxy: ProxyDeps,
+    store: IdempotencyDeps,
+    usage: UsageDeps,
+    conversations: ConversationFilterDeps,
+    engine: EngineDeps,
+    idempotency_key: Annotated[Optional[str], Header()] = None,
+) -> Response:
+    client = await _admit_turn(message, request, usage, conversations, engine)
+    # The agent calls of the turn are added to the conversation and client
+    usage_scope.set(UsageScope(usage, client, message.conversation_id))
+    if idempotency_key is None:
+        return await _send_turn(message, adapters, proxy, conversations)
+    if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST)
+
+    # Retries with the same key get the response of the first request
+    async def send_turn() -> tuple[int, bytes]:
+        response = await _send_turn(message, adapters, proxy, conversations)
+        return response.status_code, bytes(response.body)
+
+    fingerprint = request_fingerprint(message.model_dump_json().encode())
+    try:
+        stored, replayed = await store.do(idempotency_key, fingerprint, send_turn)
+    except IdempotencyKeyConflictError:
+        log.warning(f"Idempotency key reused with another request: {idempotency_key}")
+        raise HTTPException(status_code=HTTPStatus.UNPROCESSABLE_ENTITY)
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return Response(
+        stored.body,
+        status_code=stored.status_code,
+        media_type="application/json",
+        headers=headers,
+    )
+
+
+@app.post("/api/chat/jobs", status_code=HTTPStatus.ACCEPTED, responses=responses)
+async def submit_chat_job(
+    message: MessageModel,
+    request: Request,
+    adapters: AdapterDeps,
+    proxy: ProxyDeps,
+    usage: UsageDeps,
+    conversations: ConversationFilterDeps,
+    engine: EngineDeps,
+    jobs: JobsDeps,
+    priority: str = "normal",
+    deadline_seconds: Annotated[Optional[float], Query(gt=0)] = None,
+) -> Response:
+    """Queue a chat turn and answer with its job at once.
+    The result of the job is the response of POST /api/chat/.
+    """
+    if priority not in JOB_PRIORITIES:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST)
+    deadline_seconds = min(
+        deadline_seconds or conf.jobs_default_deadline_seconds,
+        conf.jobs_max_deadline_seconds,
+    )
+    client = await _admit_turn(message, request, usage, conversations, engine)
+
+    async def run_turn() -> tuple[int, bytes]:
+        # Runs in its own task, the usage scope is set for it
+        usage_scope.set(UsageScope(usage, client, message.conversation_id))
+        try:
+            response = await _send_turn(message, adapters, proxy, conversations)
+        except HTTPException as e:
+            return e.status_code, json.dumps({"detail": e.detail}).encode()
+        return response.status_code, bytes(response.body)
+
+    try:
+        job = jobs.submit(run_turn, priority, deadline_seconds)
+    except JobQueueFullError:
+        log.warning("Job queue full, rejecting chat job")
+        raise HTTPException(status_code=HTTPStatus.SERVICE_UNAVAILABLE)
+    return FastJSONResponse(
+        job.describe(),
+        status_code=HTTPStatus.ACCEPTED,
+        headers={"Location": f"/api/chat/jobs/{job.job_id}"},
+    )
+
+
+@app.get("/api/chat/jobs/{job_id}", responses=responses)
+async def get_chat_job(
+    job_id: uuid.UUID,
+    jobs: JobsDeps,
+    wait: Annotated[float, Query(ge=0, description="Seconds to wait for it")] = 0,
+) -> dict:
+    """Status of a job and, once finished, its result. With wait the request
+    is held until the job finishes or the seconds pass."""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND)
+    await job.wait_finished(min(wait, conf.jobs_max_wait_seconds))
+    return job.describe()
+
+
+@app.get("/api/chat/jobs/{job_id}/events", responses=responses)
+async def stream_chat_job_events(
+    job_id: uuid.UUID, jobs: JobsDeps
+) -> StreamingResponse:
+    """Stream the status changes of a job as server-sent events, the last one
+    has the result."""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND)
+
+    async def stream_events() -> AsyncGenerator[bytes, None]:
+        status = None
+        while True:
+            if job.status != status:
+                status = job.status
+                data = pydantic_core.to_json(job.describe())
+                yield f"event: {status}\ndata: ".encode() + data + b"\n\n"
+                if job.finished:
+                    return
+            else:
+                # Keeps the connection open through proxies
+                yield b": keep-alive\n\n"
+            await job.wait(status, conf.jobs_max_wait_seconds)
+
+    return StreamingResponse(stream_events(), media_type="text/event-stream")
+
+
+@app.delete(
+    "/api/chat/jobs/{job_id}", status_code=HTTPStatus.ACCEPTED, responses=responses
+)
+async def cancel_chat_job(job_id: uuid.UUID, jobs: JobsDeps) -> dict:
+    """Cancel a queued or running job, a running turn stops at its next
+    await and keeps the messages stored until then."""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND)
+    if not jobs.cancel(job):
+        raise HTTPException(status_code=HTTPStatus.CONFLICT)
+    return job.describe()
+
+
+async def _admit_turn(
+    message: MessageModel,
+    request: Request,
+    usage: UsageTracker,
+    conversations: ConversationFilter,
+    engine: AsyncEngine,
+) -> str:
+    """Reject the turns that can be rejected before any model call, return
+    the client of the request."""
+    _check_message_limits(message)
+    if message.conversation_id is not None and not await conversations.exists(
+        engine, message.conversation_id
+    ):
+        log.info(f"Unknown conversation id: {message.conversation_id}")
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND)
+    client = client_key(request.scope, api_keys)
+    exceeded = await usage.exceeded_budget(message.conversation_id, client)
+    if exceeded is not None:
+        log.warning(f"Token budget of the {exceeded} used up: {client}")
+        raise HTTPException(status_code=HTTPStatus.TOO_MANY_REQUESTS)
+    return client
+
+
+def _check_message_limits(message: MessageModel) -> None:
+    """Reject the messages that are too large or repeat themselves, checked in
+    linear time before the policies, the models or the database are used."""
+    if len(message.message) > conf.max_message_chars:
+        log.warning(f"Message too long: {len(message.message)} characters")
+        raise HTTPException(status_code=HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    if repetition_score(message.message) >= conf.max_message_repetition:
+        log.warning("Message rejected for repeating itself")
+        metrics.increment("chat.rejected.repetition")
+        raise HTTPException(status_code=HTTPStatus.CONFLICT)
+
+
+async def _send_turn(
+    message: MessageModel,
+    adapters: MessagesAdapters,
+    proxy: Proxy,
+    conversations: ConversationFilter,
+) -> Response:
+    if message.conversation_id is None:
+        return await _process_turn(message, adapters, proxy, conversations)
+    # Retries of the same turn share the in-flight processing
+    return await turns_singleflight.do(
+        (message.conversation_id, message.message),
+        lambda: _process_turn(message, adapters, proxy, conversations),
+    )
+
+
+async def _process_turn(
+    message: MessageModel,
+    adapters: MessagesAdapters,
+    proxy: Proxy,
+    conversations: ConversationFilter,
+) -> Response:
     # if conversation_id is None is first message
     conversation_id = message.conversation_id
     history = []
     invalid_message = False
+    # obfuscate PII before validating and storing the message
+    message.message = proxy.obfuscate(message.message)
     # validate message
     print(f"Message: {message}")
     if not await proxy.valid_message(message.message):
@@ -69,6 +432,8 @@ async def send_messages(
         )
         # insert first conversation
         conversation_id = await _handle_first_conversation(adapters, message)
+        conversations.add(conversation_id)
+        set_usage_conversation(conversation_id)
     elif conversation_id and invalid_message:
         log.info(
             f"Conversation id is not None and invalid message, getting topic from conversation"
@@ -98,15 +463,228 @@ async def send_messages(
             adapters, message, conversation_id, history  # type: ignore
         )
     # validate agent response
-    if not await proxy.valid_message(agent_response):
+    if not await proxy.valid_response(agent_response):
         log.error(f"Agent response not allowed: {agent_response}")
         agent_response = await adapters.get_topic_from_conversation(history)
-    # convert agent response to response model object
-    converted_response = adapters.convert_agent_model_to_response(
+    # serialize the agent response with the shape of the response model, the
+    # payload is already valid so the response model validation is skipped
+    payload = adapters.build_response_payload(
         conversation_id, message, agent_response, history, history_limit=5  # type: ignore
     )
     log.debug(f"Agent response now is stored in db")
-    return converted_response
+    return FastJSONResponse(payload)
+
+
+@app.websocket("/api/chat/ws")
+async def debate_session(
+    websocket: WebSocket,
+    adapters: AdapterDeps,
+    proxy: ProxyDeps,
+    usage: UsageDeps,
+    conversations: ConversationFilterDeps,
+    engine: EngineDeps,
+    conversation_id: Optional[uuid.UUID] = None,
+) -> None:
+    """Debate over a WebSocket, the conversation is kept in memory for the
+    life of the connection. See app.debate_session for the frames."""
+    await websocket.accept()
+    if conversation_id is not None and not await conversations.exists(
+        engine, conversation_id
+    ):
+        await websocket.close(CLOSE_NOT_FOUND)
+        return
+    session = DebateSession(adapters, proxy, conversations)
+    try:
+        await session.open(conversation_id)
+    except NoMessagesFoundError:
+        log.info(f"No messages found for conversation id: {conversation_id}")
+        await websocket.close(CLOSE_NOT_FOUND)
+        return
+    except DatabaseError as e:
+        log.error(f"Database error on opening debate session: {e}")
+        await websocket.close(status.WS_1011_INTERNAL_ERROR)
+        return
+    client = client_key(websocket.scope, api_keys)
+    # Set in the connection task, the turns run in child tasks that copy it
+    usage_scope.set(UsageScope(usage, client, conversation_id))
+
+    async def handle_turn(text: str, send: Send) -> None:
+        _check_message_limits(MessageModel(message=text))
+        # The middleware only sees the connection, every turn takes a token
+        # of the bucket of the REST turns
+        chat_limit = rate_limits.get(CHAT_PATH)
+        if chat_limit is not None:
+            decision = await get_rate_limit_backend().take(
+                f"{client}:{CHAT_PATH}", chat_limit
+            )
+            if not decision.allowed:
+                metrics.increment("ratelimit.denied")
+                raise HTTPException(status_code=HTTPStatus.TOO_MANY_REQUESTS)
+        exceeded = await usage.exceeded_budget(session.conversation_id, client)
+        if exceeded is not None:
+            log.warning(f"Token budget of the {exceeded} used up: {client}")
+            raise HTTPException(status_code=HTTPStatus.TOO_MANY_REQUESTS)
+        await session.turn(text, send)
+
+    connection = SessionConnection(
+        websocket,
+        heartbeat_seconds=conf.ws_heartbeat_seconds,
+        idle_timeout_seconds=conf.ws_idle_timeout_seconds,
+        send_queue_frames=conf.ws_send_queue_frames,
+        send_timeout_seconds=conf.ws_send_timeout_seconds,
+        max_pending_turns=conf.ws_max_pending_turns,
+    )
+    await connection.send(
+        {"type": "session", "conversation_id": session.conversation_id}
+    )
+    await connection.serve(handle_turn)
+
+
+@app.post("/api/moderate/batch", responses=responses)
+async def moderate_batch(
+    batch: ModerationBatchModel, proxy: ProxyDeps
+) -> StreamingResponse:
+    """Moderate many messages without creating conversations.
+    The verdicts are streamed as NDJSON in the order they are ready.
+    """
+    if not batch.messages:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST)
+
+    async def stream_verdicts() -> AsyncGenerator[bytes, None]:
+        async for verdict in proxy.moderate_batch(batch.messages):
+            line = ModerationVerdictModel(
+                index=verdict.position, action=verdict.action, rule=verdict.rule
+            ).model_dump_json()
+            yield line.encode() + b"\n"
+
+    return StreamingResponse(stream_verdicts(), media_type="application/x-ndjson")
+
+
+@app.get(
+    "/api/conversations/{conversation_id}/messages",
+    response_model=MessagesPageModel,
+    responses={"304": {"description": "Page not modified"}, **responses},
+)
+async def get_conversation_messages(
+    conversation_id: uuid.UUID,
+    adapters: AdapterDeps,
+    conversations: ConversationFilterDeps,
+    engine: EngineDeps,
+    response: Response,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    cursor: Optional[str] = None,
+    fields: Annotated[
+        Optional[str], Query(description="Comma separated fields to load")
+    ] = None,
+    if_none_match: Annotated[Optional[str], Header()] = None,
+) -> MessagesPageModel | Response:
+    """Get the messages of a conversation from the newest to the oldest one.
+    Use the next_cursor of a page to get the following one.
+    """
+    if not await conversations.exists(engine, conversation_id):
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND)
+    selected_fields = DEFAULT_MESSAGE_PAGE_FIELDS
+    if fields:
+        selected_fields = [field.strip() for field in fields.split(",")]
+        if any(field not in MESSAGE_PAGE_COLUMNS for field in selected_fields):
+            raise HTTPException(status_code=HTTPStatus.BAD_REQUEST)
+    try:
+        page, next_cursor = await adapters.get_messages_page(
+            conversation_id, limit, cursor, selected_fields
+        )
+    except ValueError:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST)
+    except NoMessagesFoundError:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND)
+    except DatabaseError as e:
+        log.error(f"Database error on getting messages page: {e}")
+        raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR)
+    page_model = MessagesPageModel(
+        conversation_id=conversation_id, messages=page, next_cursor=next_cursor
+    )
+    # The ETag is the hash of the page, clients can skip unchanged pages. The
+    # compression middleware makes it weak, so the comparison is weak too
+    etag = '"' + hashlib.sha256(page_model.model_dump_json().encode()).hexdigest() + '"'
+    headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+    if if_none_match is not None and etag in {
+        tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+    }:
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return page_model
+
+
+@app.get(
+    "/api/export",
+    responses={"401": {"description": "Missing or wrong admin key"}, **responses},
+)
+async def export_conversations(
+    engine: EngineDeps,
+    format: str = "ndjson",
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    x_admin_key: Annotated[Optional[str], Header()] = None,
+) -> StreamingResponse:
+    """Stream every conversation with its messages for analytics.
+    Only available with EXPORT_ADMIN_KEY set, sent in the X-Admin-Key header.
+    """
+    _check_admin_key(x_admin_key, "Export")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST)
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        stream_export(engine, format, since, until), media_type=media_type
+    )
+
+
+@app.get("/api/rule-packs")
+async def get_rule_packs_status(rule_packs: RulePacksDeps) -> list[dict]:
+    """Version of the loaded rule packs and how many messages of each language
+    were decided by the rules or fell through to the proxy agent."""
+    return rule_packs.describe()
+
+
+@app.get(
+    "/api/usage/top",
+    responses={"401": {"description": "Missing or wrong admin key"}, **responses},
+)
+async def get_top_usage(
+    usage: UsageDeps,
+    scope: str = "conversation",
+    limit: Annotated[int, Query(ge=1, le=100)] = 10,
+    x_admin_key: Annotated[Optional[str], Header()] = None,
+) -> list[dict]:
+    """Conversations, or clients per day, that used more tokens, with opaque
+    keys. Needs the admin key like GET /api/export."""
+    _check_admin_key(x_admin_key, "Usage report")
+    if scope not in USAGE_SCOPES:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST)
+    return await usage.top(scope, limit)
+
+
+@app.get("/api/health")
+async def get_health() -> dict:
+    """Readiness probe, the app only serves once the warm up finished."""
+    return {"status": "ready"}
+
+
+@app.get("/api/metrics")
+async def get_metrics() -> dict:
+    """Expose the metrics collected in this process."""
+    return metrics.snapshot()
+
+
+def _check_admin_key(x_admin_key: Optional[str], requested: str) -> None:
+    """Reject the admin requests without EXPORT_ADMIN_KEY, the routes are
+    disabled when it is not set."""
+    admin_key = get_configuration().export_admin_key
+    if not admin_key:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND)
+    if x_admin_key is None or not secrets.compare_digest(
+        x_admin_key.encode(), admin_key.encode()
+    ):
+        log.warning(f"{requested} requested without a valid admin key")
+        raise HTTPException(status_code=HTTPStatus.UNAUTHORIZED)
 
 
 async def _handle_first_conversation(
@@ -157,7 +735,7 @@ async def _handle_agent_response(
 
 
 if __name__ == "__main__":
-    conf = Configuration()
+    conf = get_configuration()
     configure_logger()
     config = uvicorn.Config(app="app.main:app", port=conf.port, host=conf.host)
     server = uvicorn.Server(config)
@@ -1,27 +1,57 @@
+import base64
 import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Optional
 
 from pydantic_ai import Agent, UnexpectedModelBehavior
 from pydantic_ai.agent import AgentRunResult
 from pydantic_ai.messages import ModelMessage, ModelMessagesTypeAdapter
-from sqlalchemy import desc, select
+from sqlalchemy import desc, func, select, tuple_
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.cache import TieredCache
+from app.db import ReplicaRouter
 from app.entities import Conversations, Messages
 from app.errors import DatabaseError, ModelExecutionError, NoMessagesFoundError
-from app.models import MessageHistoryModel, MessageModel, ResponseModel
+from app.fast_repository import AsyncpgMessagesRepository
+from app.models import MessageModel, ResponseModel
+from app.usage import MAIN_AGENT, record_run_usage
 
 USER_ROLE = "user-prompt"
 AGENT_ROLE = "agent"
 DEFAULT_HISTORY_LIMIT = 5
+# Time the first message of a conversation can precede the conversation
+CONVERSATION_START_SLACK = timedelta(minutes=1)
 DEFAULT_MESSAGE_GET_TOPIC = "Dime cual es el tema principal del debate que tenemos, no uses la palabra debate o tema, responde con 10 palabras o menos"
 DEFAULT_MESSAGE_NOT_CHANGE_TOPIC = "Volvamos al debate sobre nuestro tema principal: "
+# Fields that can be requested on the messages page, mapped to their columns
+MESSAGE_PAGE_COLUMNS = {
+    "message_id": Messages.message_id,
+    "role": Messages.role,
+    "message": Messages.content,
+    "insert_datetime": Messages.insert_datetime,
+    "metadata_response": Messages.metadata_response,
+}
+DEFAULT_MESSAGE_PAGE_FIELDS = ["message_id", "role", "message", "insert_datetime"]
 
 
 class MessagesAdapters:
-    def __init__(self, async_session: AsyncSession, agent: Agent):
+    def __init__(
+        self,
+        async_session: AsyncSession,
+        agent: Agent,
+        router: Optional[ReplicaRouter] = None,
+        repository: Optional[AsyncpgMessagesRepository] = None,
+        topic_cache: Optional[TieredCache] = None,
+    ):
         self.async_session = async_session
         self.agent = agent
+        self.router = router
+        # Fast path for the hot queries, the ORM is used when it is None
+        self.repository = repository
+        # Topics of the conversations shared with the other nodes
+        self.topic_cache = topic_cache
         self.DEFAULT_MESSAGE_GET_TOPIC = DEFAULT_MESSAGE_GET_TOPIC
         self.DEFAULT_MESSAGE_NOT_CHANGE_TOPIC = DEFAULT_MESSAGE_NOT_CHANGE_TOPIC
 
@@ -33,21 +63,41 @@ class MessagesAdapters:
         history: list[Messages],
         history_limit: int = 5,
     ) -> ResponseModel:
+        payload = self.build_response_payload(
+            conversation_id, user_message, agent_response, history, history_limit
+        )
+        return ResponseModel.model_validate(payload)
+
+    def build_response_payload(
+        self,
+        conversation_id: uuid.UUID,
+        user_message: MessageModel,
+        agent_response: str,
+        history: list[Messages],
+        history_limit: int = 5,
+    ) -> dict[str, Any]:
+        """Build the response as plain data, with the shape of ResponseModel."""
         messages_history = [
-            MessageHistoryModel(role=AGENT_ROLE, message=agent_response),
-            MessageHistoryModel(role=USER_ROLE, message=user_message.message),
+            {"role": AGENT_ROLE, "message": agent_response},
+            {"role": USER_ROLE, "message": user_message.message},
         ]
         # Reduce 2 elements from history limit
         # because we have 2 messages already (agent and user)
         history_limit = history_limit - 2
         # add the rest of the elements to the end of the history list
         for m in history[:history_limit]:
-            messages_history.append(MessageHistoryModel(role=m.role, message=m.content))
-        return ResponseModel(conversation_id=conversation_id, message=messages_history)
+            messages_history.append({"role": m.role, "message": m.content})
+        return {"conversation_id": conversation_id, "message": messages_history}
 
     async def insert_message(
         self, message: MessageModel, conversation_id: uuid.UUID
     ) -> None:
+        if self.repository is not None:
+            await self.repository.insert_message(
+                conversation_id, USER_ROLE, message.message
+            )
+            self._mark_write(conversation_id)
+            return
         formed_message = Messages(
             role=USER_ROLE,
             content=message.message,
@@ -59,11 +109,50 @@ class MessagesAdapters:
         self, message: MessageModel, conversation_id: uuid.UUID, history: list[Messages]
     ) -> str:
         agent_response = await self._get_agent_response(message.message, history)
-        metadata_response = agent_response.new_messages_json()
         str_agent_response: str = agent_response.output
+        await self._insert_agent_message(
+            conversation_id, str_agent_response, agent_response.new_messages_json()
+        )
+        return str_agent_response
+
+    async def stream_response_from_agent(
+        self,
+        message: str,
+        conversation_id: uuid.UUID,
+        model_history: list[ModelMessage],
+        on_delta: Callable[[str], Awaitable[None]],
+    ) -> tuple[str, list[ModelMessage]]:
+        """Run the agent streaming its output to on_delta, store the response
+        and return it with the new model messages of the run."""
+        try:
+            async with self.agent.run_stream(
+                message, message_history=model_history
+            ) as result:
+                chunks = []
+                async for delta in result.stream_text(delta=True):
+                    chunks.append(delta)
+                    await on_delta(delta)
+        except UnexpectedModelBehavior as e:
+            raise ModelExecutionError from e
+        record_run_usage(MAIN_AGENT, result)
+        str_agent_response = "".join(chunks)
+        await self._insert_agent_message(
+            conversation_id, str_agent_response, result.new_messages_json()
+        )
+        return str_agent_response, result.new_messages()
+
+    async def _insert_agent_message(
+        self, conversation_id: uuid.UUID, content: str, metadata_response: bytes
+    ) -> None:
+        if self.repository is not None:
+            await self.repository.insert_message(
+                conversation_id, AGENT_ROLE, content, metadata_response.decode()
+            )
+            self._mark_write(conversation_id)
+            return
         formed_message = Messages(
             role=AGENT_ROLE,
-            content=str_agent_response,
+            content=content,
             metadata_response=metadata_response.decode(),
             conversation_id=conversation_id,
         )
@@ -71,18 +160,28 @@ class MessagesAdapters:
             await self._insert_message_on_db(formed_message)
         except SQLAlchemyError as e:
             raise DatabaseError from e
-        return str_agent_response
 
     async def get_history_messages(self, conversation_id: uuid.UUID) -> list[Messages]:
+        if self.repository is not None:
+            rows = await self.repository.get_history(
+                conversation_id, DEFAULT_HISTORY_LIMIT
+            )
+            if not rows:
+                raise NoMessagesFoundError
+            # MessageRow has every attribute of Messages used by the adapter
+            return rows  # type: ignore[return-value]
         try:
-            async with self.async_session as session:
+            async with self._read_session(conversation_id) as session:
                 stmt = (
                     select(Messages)
-                    .join(
-                        Conversations,
-                        Messages.conversation_id == Conversations.conversation_id,
+                    .where(
+                        Messages.conversation_id == conversation_id,
+                        # Lets postgres prune the partitions older than the conversation
+                        Messages.insert_datetime
+                        >= conversation_start_subquery(
+                            conversation_id, self._dialect_name
+                        ),
                     )
-                    .where(Conversations.conversation_id == conversation_id)
                     .order_by(desc(Messages.insert_datetime))
                     .limit(DEFAULT_HISTORY_LIMIT)
                 )
@@ -96,10 +195,66 @@ class MessagesAdapters:
             raise NoMessagesFoundError
         return message_history
 
+    async def get_messages_page(
+        self,
+        conversation_id: uuid.UUID,
+        limit: int,
+        cursor: Optional[str] = None,
+        fields: Optional[list[str]] = None,
+    ) -> tuple[list[dict[str, Any]], Optional[str]]:
+        """Get a page of messages from the newest to the oldest one.
+
+        Uses keyset pagination on (insert_datetime, message_id), the cursor
+        returned points to the last message of the page and is None when there
+        are no more messages.
+        """
+        fields = fields or DEFAULT_MESSAGE_PAGE_FIELDS
+        # The keyset columns are always loaded to build the next cursor
+        columns = [Messages.insert_datetime, Messages.message_id] + [
+            MESSAGE_PAGE_COLUMNS[field] for field in fields
+        ]
+        stmt = (
+            select(*columns)
+            .where(
+                Messages.conversation_id == conversation_id,
+                Messages.insert_datetime
+                >= conversation_start_subquery(conversation_id, self._dialect_name),
+            )
+            .order_by(desc(Messages.insert_datetime), desc(Messages.message_id))
+            .limit(limit + 1)
+        )
+        if cursor is not None:
+            cursor_datetime, cursor_message_id = decode_cursor(cursor)
+            stmt = stmt.where(
+                tuple_(Messages.insert_datetime, Messages.message_id)
+                < tuple_(cursor_datetime, cursor_message_id)
+            )
+        try:
+            async with self._read_session(conversation_id) as session:
+                rows = (await session.execute(stmt)).all()
+                if not rows and cursor is None:
+                    conversation = await session.get(Conversations, conversation_id)
+                    if conversation is None:
+                        raise NoMessagesFoundError
+        except SQLAlchemyError as e:
+            raise DatabaseError from e
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][0], rows[-1][1])
+        page = [{field: value for field, value in zip(fields, row[2:])} for row in rows]
+        return page, next_cursor
+
     async def insert_first_conversation_messages(
         self, message: MessageModel
     ) -> uuid.UUID:
-        formed_message = Messages(role=USER_ROLE, content=message.message)
+        if self.repository is not None:
+            conversation_id = await self.repository.insert_first_conversation(
+                USER_ROLE, message.message
+            )
+            self._mark_write(conversation_id)
+            return conversation_id
         try:
             async with self.async_session as session:
                 async with session.begin():
@@ -108,7 +263,9 @@ class MessagesAdapters:
                     session.add(db_conversation)
                     await session.flush()
 
-                    # Insert first message
+                    # Insert first message, created after the conversation so
+                    # it is never older than the conversation itself
+                    formed_message = Messages(role=USER_ROLE, content=message.message)
                     formed_message.conversation_id = db_conversation.conversation_id
                     session.add(formed_message)
                     await session.flush()
@@ -117,6 +274,7 @@ class MessagesAdapters:
                     conversation_id = db_conversation.conversation_id
         except SQLAlchemyError as e:
             raise DatabaseError from e
+        self._mark_write(conversation_id)
         return conversation_id
 
     async def _insert_message_on_db(self, message: Messages) -> None:
@@ -126,18 +284,48 @@ class MessagesAdapters:
                 session.add(message)
                 await session.flush()
                 await session.commit()
+        self._mark_write(message.conversation_id)
+
+    def _read_session(self, conversation_id: uuid.UUID) -> AsyncSession:
+        if self.router is None:
+            return self.async_session
+        return self.router.read_session(conversation_id)
+
+    @property
+    def _dialect_name(self) -> str:
+        bind = self.async_session.bind
+        return bind.dialect.name if bind is not None else ""
+
+    def _mark_write(self, conversation_id: uuid.UUID) -> None:
+        if self.router is not None:
+            self.router.mark_write(conversation_id)
 
     async def get_topic_from_conversation(self, history: list[Messages]) -> str:
+        if self.topic_cache is None or not history:
+            return await self.get_topic_from_model_history(
+                self.parse_model_history(history)
+            )
+        # The newest message identifies the state of the conversation, so a
+        # cached topic is never stale
+        return await self.topic_cache.get_or_set(
+            str(history[0].message_id),
+            lambda: self.get_topic_from_model_history(
+                self.parse_model_history(history)
+            ),
+        )
+
+    async def get_topic_from_model_history(
+        self, model_history: list[ModelMessage]
+    ) -> str:
         message = self.DEFAULT_MESSAGE_GET_TOPIC
-        agent_response = await self._get_agent_response(message, history)
+        agent_response = await self._run_agent(message, model_history)
         str_agent_response: str = agent_response.output
         content = self.DEFAULT_MESSAGE_NOT_CHANGE_TOPIC + str_agent_response
 
         return content
 
-    async def _get_agent_response(
-        self, message: str, history: list[Messages]
-    ) -> AgentRunResult:
+    @staticmethod
+    def parse_model_history(history: list[Messages]) -> list[ModelMessage]:
         history_to_agent: list[ModelMessage] = []
         for row in history:
             # Look only for agent responses, cause we only store metadata_response for agent responses
@@ -145,10 +333,54 @@ class MessagesAdapters:
                 history_to_agent.extend(
                     ModelMessagesTypeAdapter.validate_json(row.metadata_response)
                 )
+        return history_to_agent
+
+    async def _get_agent_response(
+        self, message: str, history: list[Messages]
+    ) -> AgentRunResult:
+        return await self._run_agent(message, self.parse_model_history(history))
+
+    async def _run_agent(
+        self, message: str, model_history: list[ModelMessage]
+    ) -> AgentRunResult:
         try:
             agent_response = await self.agent.run(
-                message, message_history=history_to_agent
+                message, message_history=model_history
             )
         except UnexpectedModelBehavior as e:
             raise ModelExecutionError from e
+        record_run_usage(MAIN_AGENT, agent_response)
         return agent_response
+
+
+def conversation_start_subquery(conversation_id: uuid.UUID, dialect_name: str) -> Any:
+    """Insert datetime of a conversation, a lower bound for its messages.
+
+    Older conversations were inserted after their first message, the bound
+    is moved back by a slack that keeps it and still prunes the partitions.
+    """
+    start = Conversations.insert_datetime
+    if dialect_name == "sqlite":
+        bound = func.datetime(start, f"-{CONVERSATION_START_SLACK.seconds} seconds")
+    else:
+        bound = start - CONVERSATION_START_SLACK
+    return (
+        select(bound)
+        .where(Conversations.conversation_id == conversation_id)
+        .scalar_subquery()
+    )
+
+
+def encode_cursor(insert_datetime: datetime, message_id: uuid.UUID) -> str:
+    raw = f"{insert_datetime.isoformat()}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, uuid.UUID]:
+    """Decode a cursor of the messages page, raises ValueError if invalid."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        insert_datetime, message_id = raw.split("|")
+        return datetime.fromisoformat(insert_datetime), uuid.UUID(message_id)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
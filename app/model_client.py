@@ -0,0 +1,105 @@
+"""HTTP connection pool shared by the models of every agent.
+
+The pool is an httpx transport configured from the Configuration. The
+google SDK builds its own httpx client, so the transport is what the agents
+share: the connections, their keep-alive and the HTTP/2 sessions. The
+transport counts the requests and the new connections so the reuse of the
+pool can be watched in the metrics.
+"""
+
+import logging
+from typing import Any
+
+import httpx
+from pydantic_ai.models import Model
+
+from app.configuration import Configuration
+from app.metrics import Metrics, metrics
+
+log = logging.getLogger(__name__)
+
+METRICS_PREFIX = "model_http"
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Transport that records how many requests open a new connection."""
+
+    def __init__(
+        self, transport: httpx.AsyncBaseTransport, registry: Metrics = metrics
+    ):
+        self.transport = transport
+        self.metrics = registry
+        self.requests = 0
+        self.connections = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # httpcore reports the connect and TLS steps through the trace hook,
+        # they only happen when no pooled connection can be reused
+        previous_trace = request.extensions.get("trace")
+
+        async def trace(event_name: str, info: dict[str, Any]) -> None:
+            if event_name == "connection.connect_tcp.complete":
+                self.connections += 1
+                self.metrics.increment(f"{METRICS_PREFIX}.connections_opened")
+            elif event_name == "connection.start_tls.complete":
+                self.metrics.increment(f"{METRICS_PREFIX}.tls_handshakes")
+            if previous_trace is not None:
+                await previous_trace(event_name, info)
+
+        request.extensions["trace"] = trace
+        self.requests += 1
+        self.metrics.increment(f"{METRICS_PREFIX}.requests")
+        try:
+            return await self.transport.handle_async_request(request)
+        finally:
+            self.metrics.set_gauge(
+                f"{METRICS_PREFIX}.connection_reuse_ratio",
+                1 - min(self.connections, self.requests) / self.requests,
+            )
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+def build_transport(conf: Configuration) -> InstrumentedTransport:
+    limits = httpx.Limits(
+        max_connections=conf.model_http_max_connections,
+        max_keepalive_connections=conf.model_http_max_keepalive_connections,
+        keepalive_expiry=conf.model_http_keepalive_expiry_seconds,
+    )
+    http2 = conf.model_http2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            log.warning("HTTP/2 needs the h2 package, using HTTP/1.1")
+            http2 = False
+    return InstrumentedTransport(
+        httpx.AsyncHTTPTransport(limits=limits, http2=http2, retries=1)
+    )
+
+
+def build_timeout(conf: Configuration) -> httpx.Timeout:
+    return httpx.Timeout(
+        conf.model_http_read_timeout_seconds,
+        connect=conf.model_http_connect_timeout_seconds,
+    )
+
+
+def build_google_model(
+    model_name: str, conf: Configuration, transport: httpx.AsyncBaseTransport
+) -> Model:
+    """Build a gemini model that sends its requests through the transport."""
+    # The provider modules are heavy, they are imported with the first model
+    from google import genai
+    from google.genai.types import HttpOptions
+    from pydantic_ai.models.google import GoogleModel
+    from pydantic_ai.providers.google import GoogleProvider
+
+    http_options = HttpOptions(
+        # The SDK sets the timeout of each request from this one, in ms
+        timeout=int(conf.model_http_read_timeout_seconds * 1000),
+        async_client_args={"transport": transport, "timeout": build_timeout(conf)},
+    )
+    client = genai.Client(api_key=conf.google_api_key, http_options=http_options)
+    return GoogleModel(model_name, provider=GoogleProvider(client=client))
@@ -1,7 +1,9 @@
 import uuid
-from typing import Optional
+from typing import Any, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+MAX_MODERATION_BATCH_MESSAGES = 500
 
 
 class MessageModel(BaseModel):
@@ -17,3 +19,19 @@ class MessageHistoryModel(BaseModel):
 class ResponseModel(BaseModel):
     conversation_id: uuid.UUID
     message: list[MessageHistoryModel]
+
+
+class ModerationBatchModel(BaseModel):
+    messages: list[str] = Field(max_length=MAX_MODERATION_BATCH_MESSAGES)
+
+
+class ModerationVerdictModel(BaseModel):
+    index: int
+    action: str
+    rule: Optional[str] = None
+
+
+class MessagesPageModel(BaseModel):
+    conversation_id: uuid.UUID
+    messages: list[dict[str, Any]]
+    next_cursor: Optional[str] = None
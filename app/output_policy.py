@@ -0,0 +1,72 @@
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Optional
+
+from app.policies import (
+    ABUSE_PATTERNS,
+    CODE_INJECTION_PATTERNS,
+    PII_PATTERNS,
+    WARN_PATTERNS,
+)
+from app.regex_engine import compile_pattern
+from app.text_analysis import repetition_score, shingle_hashes, words
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SHINGLE_SIZE = 6
+DEFAULT_LEAK_MIN_SHINGLES = 3
+DEFAULT_REPETITION_THRESHOLD = 0.85
+
+
+def _combine(patterns: list[str]) -> re.Pattern[str]:
+    return compile_pattern("|".join(f"(?:{p})" for p in patterns))
+
+
+@dataclass
+class OutputPolicy:
+    """Validate the responses of the main agent without calling a model.
+
+    decide returns "deny" or "allow" when the response can be classified in
+    process and None when the proxy agent must be consulted.
+    """
+
+    instructions: list[str]
+    shingle_size: int = DEFAULT_SHINGLE_SIZE
+    leak_min_shingles: int = DEFAULT_LEAK_MIN_SHINGLES
+    repetition_threshold: float = DEFAULT_REPETITION_THRESHOLD
+    _instruction_shingles: set[int] = field(init=False, repr=False)
+    _deny_pattern: re.Pattern[str] = field(init=False, repr=False)
+    _undecided_pattern: re.Pattern[str] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        # Hashes are computed once, checking a response is a set lookup per shingle
+        self._instruction_shingles = set()
+        for instruction in self.instructions:
+            self._instruction_shingles |= shingle_hashes(
+                words(instruction), self.shingle_size
+            )
+        # PII and code injection are scanned in a single pass
+        self._deny_pattern = _combine(PII_PATTERNS + CODE_INJECTION_PATTERNS)
+        # Abuse or suspicious words can be part of a valid debate
+        self._undecided_pattern = _combine(ABUSE_PATTERNS + WARN_PATTERNS)
+
+    def decide(self, message: str) -> Optional[str]:
+        leaked_shingles = self.count_leaked_shingles(message)
+        if leaked_shingles >= self.leak_min_shingles:
+            log.warning("Agent response leaks %s instruction shingles", leaked_shingles)
+            return "deny"
+        content = message.lower()
+        if self._deny_pattern.search(content):
+            log.warning("Agent response contains PII or code injection")
+            return "deny"
+        if repetition_score(message) >= self.repetition_threshold:
+            log.warning("Agent response contains runaway repetition")
+            return "deny"
+        if leaked_shingles or self._undecided_pattern.search(content):
+            return None
+        return "allow"
+
+    def count_leaked_shingles(self, message: str) -> int:
+        message_shingles = shingle_hashes(words(message), self.shingle_size)
+        return len(message_shingles & self._instruction_shingles)
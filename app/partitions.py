@@ -0,0 +1,196 @@
+"""Monthly range partitions of the messages table with retention and archival.
+
+Run the retention with: python -m app.partitions --retention-months 6 --archive-dir archive
+"""
+
+import argparse
+import asyncio
+import gzip
+import logging
+import os
+import re
+from datetime import date, datetime
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from app.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+PARENT_TABLE = "messages"
+DEFAULT_PARTITION = "messages_default"
+PARTITION_PATTERN = re.compile(r"^messages_p(\d{4})(\d{2})$")
+LIST_PARTITIONS = text(
+    """
+    SELECT child.relname
+    FROM pg_inherits
+    JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+    JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+    WHERE parent.relname = :parent
+    """
+)
+
+# "p" for a partitioned table, "r" for a plain one
+TABLE_KIND = text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)")
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"messages_p{month.year:04d}{month.month:02d}"
+
+
+def partition_month(name: str) -> Optional[date]:
+    match = PARTITION_PATTERN.match(name)
+    if match is None:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def expired_partitions(
+    names: list[str], today: date, retention_months: int
+) -> list[str]:
+    """Partitions whose whole month is older than the retention period."""
+    cutoff = add_months(today.replace(day=1), -retention_months)
+    expired = []
+    for name in names:
+        month = partition_month(name)
+        if month is not None and add_months(month, 1) <= cutoff:
+            expired.append(name)
+    return sorted(expired)
+
+
+def _is_postgres(conn: AsyncConnection) -> bool:
+    return conn.dialect.name == "postgresql"
+
+
+async def ensure_partitions(engine: AsyncEngine, months_ahead: int) -> None:
+    """Create the partitions from the current month to months_ahead months.
+
+    A default partition receives the rows outside of every partition, it stays
+    empty as long as the partitions are created ahead of time. Skipped with a
+    warning when the table was created before it was partitioned.
+    """
+    first_month = date.today().replace(day=1)
+    async with engine.begin() as conn:
+        if not _is_postgres(conn):
+            return
+        kind = (await conn.execute(TABLE_KIND, {"table": PARENT_TABLE})).scalar()
+        if kind != "p":
+            # create_all does not convert the table of an existing deployment
+            log.warning(
+                "Table %s is not partitioned, partitions not created", PARENT_TABLE
+            )
+            metrics.set_gauge("partitions.unpartitioned", 1)
+            return
+        for offset in range(months_ahead + 1):
+            month = add_months(first_month, offset)
+            await conn.execute(
+                text(
+                    f"CREATE TABLE IF NOT EXISTS {partition_name(month)} "
+                    f"PARTITION OF {PARENT_TABLE} FOR VALUES "
+                    f"FROM ('{month.isoformat()}') "
+                    f"TO ('{add_months(month, 1).isoformat()}')"
+                )
+            )
+        await conn.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} "
+                f"PARTITION OF {PARENT_TABLE} DEFAULT"
+            )
+        )
+    log.debug("Partitions of %s ensured %s months ahead", PARENT_TABLE, months_ahead)
+
+
+async def apply_retention(
+    engine: AsyncEngine, retention_months: int, archive_dir: str
+) -> list[str]:
+    """Detach, archive and drop the partitions older than the retention.
+
+    Every partition is copied to a gzip compressed CSV file before dropping it.
+    """
+    async with engine.connect() as conn:
+        if not _is_postgres(conn):
+            return []
+        result = await conn.execute(LIST_PARTITIONS, {"parent": PARENT_TABLE})
+        names = [row[0] for row in result]
+    archived = []
+    os.makedirs(archive_dir, exist_ok=True)
+    for name in expired_partitions(names, date.today(), retention_months):
+        async with engine.begin() as conn:
+            await conn.execute(
+                text(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name}")
+            )
+        path = os.path.join(archive_dir, f"{name}.csv.gz")
+        await _archive_table(engine, name, path)
+        async with engine.begin() as conn:
+            await conn.execute(text(f"DROP TABLE {name}"))
+        metrics.increment("partitions.archived")
+        log.info("Partition %s archived to %s and dropped", name, path)
+        archived.append(name)
+    return archived
+
+
+async def _archive_table(engine: AsyncEngine, table: str, path: str) -> None:
+    async with engine.connect() as conn:
+        raw_connection = await conn.get_raw_connection()
+        # COPY streams the rows straight from postgres to the compressed file
+        with gzip.open(path, "wb") as archive:
+
+            async def write(chunk: bytes) -> None:
+                archive.write(chunk)
+
+            await raw_connection.driver_connection.copy_from_table(  # type: ignore
+                table, output=write, format="csv", header=True
+            )
+
+
+async def maintain_partitions(
+    engine: AsyncEngine,
+    months_ahead: int,
+    retention_months: int,
+    archive_dir: str,
+    interval_seconds: float,
+) -> None:
+    """Keep future partitions created and apply the retention periodically."""
+    while True:
+        try:
+            await ensure_partitions(engine, months_ahead)
+            if retention_months > 0:
+                await apply_retention(engine, retention_months, archive_dir)
+        except Exception as e:
+            log.error("Error on maintaining partitions: %s", e)
+        await asyncio.sleep(interval_seconds)
+
+
+async def _run(args: argparse.Namespace) -> None:
+    from app.db import get_async_engine
+
+    engine = get_async_engine()
+    try:
+        await ensure_partitions(engine, args.months_ahead)
+        archived = await apply_retention(
+            engine, args.retention_months, args.archive_dir
+        )
+        log.info("%s partitions archived at %s", len(archived), datetime.now())
+    finally:
+        await engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--retention-months", type=int, required=True)
+    parser.add_argument("--archive-dir", default="archive")
+    parser.add_argument("--months-ahead", type=int, default=3)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_run(args))
+
+
+if __name__ == "__main__":
+    main()
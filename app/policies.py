@@ -0,0 +1,51 @@
+"""Regex policies shared by the input proxy and the output validator."""
+
+# 1.1. Prompt Injection/Jailbreak detection
+PROMPT_INJECTION_PATTERNS = [
+    r"ignore\s+all\s+previous\s+instructions",
+    r"disregard\s+previous\s+instructions",
+    r"pretend\s+to\s+be",
+    r"you are now",
+    r"as an ai language model",
+    r"repeat after me",
+    r"system prompt",
+    r"reveal your instructions",
+    r"forget you are an ai",
+    r"bypass",
+    r"jailbreak",
+    r"write a prompt that",
+    r"act as",
+    r"simulate",
+    r"please provide the system prompt",
+    r"what are your instructions",
+]
+
+# 1.2. PII detection (very basic, can be improved)
+PII_PATTERNS = [
+    r"\b\d{3}-\d{2}-\d{4}\b",  # SSN
+    r"\b\d{16}\b",  # Credit card (very naive)
+    r"\b\d{10,11}\b",  # Phone number
+    r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b",  # Email
+    r"\b\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\b",  # IP address
+]
+
+# 3. Hate speech, abuse, profanity (very basic, can be improved)
+ABUSE_PATTERNS = [
+    r"\b(fuck|shit|bitch|asshole|bastard|idiot|stupid|dumb|nigger|faggot|cunt|retard|whore|slut)\b",
+    r"\b(kill|suicide|die)\b",
+    r"\b(hate|abuse|racist|sexist)\b",
+]
+
+# 4. SQL Injection/XSS/Code Injection
+CODE_INJECTION_PATTERNS = [
+    r"(<script>|</script>)",
+    r"(select\s+\*\s+from|drop\s+table|insert\s+into|delete\s+from|update\s+\w+\s+set)",
+    r"(;--|--\s|/\*|\*/|@@|@|char\(|nchar\(|varchar\(|alter\s+table|create\s+table)",
+    r"(os\.system|subprocess|eval\(|exec\()",
+]
+
+# 5. Warn for suspicious but not strictly forbidden content
+WARN_PATTERNS = [
+    r"\b(secret|password|confidential|private)\b",
+    r"\b(hack|exploit|vulnerability)\b",
+]
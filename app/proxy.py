@@ -1,17 +1,120 @@
+import asyncio
+import hashlib
+import json
 import logging
 import re
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, NamedTuple, Optional
 
 from pydantic_ai import Agent, UnexpectedModelBehavior
 
+from app.batcher import ClassificationBatcher
+from app.cache import TieredCache
 from app.errors import ModelExecutionError
+from app.metrics import metrics
+from app.output_policy import OutputPolicy
+from app.redactor import PIIRedactor
+from app.rule_packs import (
+    ABUSE,
+    CODE_INJECTION,
+    PROMPT_INJECTION,
+    SUSPICIOUS,
+    RuleEngine,
+    RulesBudgetExceeded,
+    get_rule_engine,
+    normalize,
+)
+from app.singleflight import SingleFlight
+from app.usage import PROXY_AGENT, record_run_usage, record_usage
+from app.verdict_cache import NearDuplicateCache
 
 log = logging.getLogger(__name__)
 
+DENY = "deny"
+WARN = "warn"
+MODEL_RULE = "model"
+MODEL_ERROR_RULE = "model_error"
+RULES_BUDGET_RULE = "rules_budget"
+VERDICT_CACHE_RULE = "verdict_cache"
+DEFAULT_RULES_BUDGET_SECONDS = 0.05
+DEFAULT_RULES_OFFLOAD_CHARS = 4096
+DEFAULT_BATCH_MAX_CHARS = 8000
+DEFAULT_BATCH_MAX_ITEMS = 50
+DEFAULT_BATCH_MAX_CONCURRENCY = 4
+BATCH_PROMPT_HEADER = """Valida cada uno de los siguientes mensajes de forma independiente.
+Responde una linea por mensaje con el formato "<numero>: <allow|deny|warn>" y nada mas.
+"""
+BATCH_RESPONSE_PATTERN = re.compile(r"^\W*(\d+)\W+(allow|deny|warn)\b", re.MULTILINE)
+
+
+def message_key(message: str) -> str:
+    """Hash of a message normalized by case and whitespace."""
+    normalized = " ".join(message.lower().split())
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def build_batch_prompt(contents: list[str]) -> str:
+    """Build a prompt to classify many messages, one numbered line per message."""
+    # Messages are JSON encoded so a message can not fake the numbered lines
+    lines = [
+        f"{number}: {json.dumps(content, ensure_ascii=False)}"
+        for number, content in enumerate(contents, start=1)
+    ]
+    return BATCH_PROMPT_HEADER + "\n".join(lines)
+
+
+def parse_batch_response(response: str, size: int) -> list[str]:
+    """Split the agent response of a batch prompt in one action per message.
+
+    Messages without a verdict in the response are denied.
+    """
+    actions = [DENY] * size
+    found = set()
+    for match in BATCH_RESPONSE_PATTERN.finditer(response):
+        number = int(match.group(1))
+        if 1 <= number <= size:
+            actions[number - 1] = match.group(2)
+            found.add(number)
+    if len(found) < size:
+        log.warning("Batch response has %s verdicts for %s messages", len(found), size)
+    return actions
+
+
+@dataclass
+class RulesVerdict:
+    content: str
+    action: Optional[str] = None
+    rule: Optional[str] = None
+    redacted: bool = False
+    # Language of the rule pack that matched or that the message belongs to
+    language: Optional[str] = None
+
+
+class ModerationVerdict(NamedTuple):
+    # Position of the message in the batch
+    position: int
+    action: str
+    rule: Optional[str]
+
 
 @dataclass
 class Proxy:
     agent: Agent
+    output_policy: Optional[OutputPolicy] = None
+    redactor: PIIRedactor = field(default_factory=PIIRedactor)
+    batch_max_chars: int = DEFAULT_BATCH_MAX_CHARS
+    batch_max_items: int = DEFAULT_BATCH_MAX_ITEMS
+    # Prompts of a moderation batch sent to the agent at the same time
+    batch_max_concurrency: int = DEFAULT_BATCH_MAX_CONCURRENCY
+    batcher: Optional[ClassificationBatcher] = None
+    singleflight: Optional[SingleFlight[str]] = None
+    rules_budget_seconds: float = DEFAULT_RULES_BUDGET_SECONDS
+    rules_offload_chars: int = DEFAULT_RULES_OFFLOAD_CHARS
+    rules: RuleEngine = field(default_factory=get_rule_engine)
+    verdict_cache: Optional[NearDuplicateCache] = None
+    # Agent verdicts of exact messages shared with the other nodes
+    shared_verdicts: Optional[TieredCache] = None
 
     async def valid_message(self, message: str) -> bool:
         """Validate if the message is allowed to be processed.
@@ -27,12 +130,34 @@ class Proxy:
                 e,
             )
             return False
+        return await self._is_allowed(policy_action, message)
+
+    async def valid_response(self, message: str) -> bool:
+        """Validate if a response generated by the main agent can be returned.
+        The output policy decides in process, the agent is only consulted
+        when the output policy can not decide.
+        """
+        if self.output_policy is None:
+            return await self.valid_message(message)
+        policy_action = self.output_policy.decide(message)
+        if policy_action is None:
+            try:
+                policy_action = await self._classify(message.lower())
+            except ModelExecutionError as e:
+                log.error(
+                    "Model execution error on deciding policy action for agent response: %s",
+                    e,
+                )
+                return False
+        return await self._is_allowed(policy_action, message)
+
+    async def _is_allowed(self, policy_action: str, message: str) -> bool:
         if policy_action == "deny":
             return False
         elif policy_action == "warn":
             await self.notify_external_service(message)
             return False
-        elif policy_action == "allow":
+        elif policy_action in ("allow", "obfuscate"):
             return True
         else:
             log.warning("Unknown policy action: %s", policy_action)
@@ -47,84 +172,235 @@ class Proxy:
                 - "allow": The request is good and will pass.
                 - "deny": The request is not allowed.
                 - "warn": Warn about the response by the user or LLM.
-                - "obfuscate": Obfuscate PII data.
+                - "obfuscate": PII data was replaced with placeholders, the
+                  request will pass.
         """
-        # Implement policy logic for prompt injection, PII, abuse, etc
+        if self.singleflight is None:
+            return await self._decide_policy_action(message)
+        # Concurrent requests with the same message share the decision. The
+        # exact text is the key: the rules could tell apart two messages
+        # that only differ in case or whitespace
+        return await self.singleflight.do(
+            message, lambda: self._decide_policy_action(message)
+        )
+
+    async def _decide_policy_action(self, message: str) -> str:
+        verdict = await self.scan_rules(message)
+        if verdict.action is not None:
+            return verdict.action
+
+        # A variation of a message already denied or warned gets its verdict
+        cached_action = self._cached_verdict(verdict.content)
+        if cached_action is not None:
+            return cached_action
+
+        # If none of the above, request to agents to decide
+        policy_action = await self._classify(verdict.content)
+        self._cache_verdict(verdict.content, policy_action)
+        if policy_action == "allow" and verdict.redacted:
+            return "obfuscate"
+        return policy_action
 
-        # Lowercase message for easier matching
-        content = message.lower()
+    def _cached_verdict(self, content: str) -> Optional[str]:
+        if self.verdict_cache is None:
+            return None
+        return self.verdict_cache.get(content)
+
+    def _cache_verdict(self, content: str, action: str) -> None:
+        # Only the verdicts that stop a message are reused for similar ones
+        if self.verdict_cache is not None and action in (DENY, WARN):
+            self.verdict_cache.put(content, action)
+
+    async def scan_rules(self, message: str) -> RulesVerdict:
+        """Run the regex stage within the time budget of the proxy.
+
+        Large messages are scanned in a worker thread so the event loop keeps
+        serving other requests. A scan over its budget is denied.
+        """
+        deadline = time.perf_counter() + self.rules_budget_seconds
+        if len(message) < self.rules_offload_chars:
+            return self.evaluate_rules(message, deadline)
+        metrics.increment("proxy.rules.offloaded")
+        try:
+            return await asyncio.wait_for(
+                asyncio.to_thread(self.evaluate_rules, message, deadline),
+                timeout=self.rules_budget_seconds,
+            )
+        except TimeoutError:
+            log.warning("Regex stage over its budget of %ss", self.rules_budget_seconds)
+            metrics.increment("proxy.rules.budget_exceeded")
+            return RulesVerdict(content=message, action=DENY, rule=RULES_BUDGET_RULE)
+
+    def evaluate_rules(
+        self, message: str, deadline: Optional[float] = None
+    ) -> RulesVerdict:
+        """Run the regex stage of the policy over a message.
+
+        The action of the verdict is None when no rule matched and the agent
+        must decide. When the deadline passes between two checks the message
+        is denied.
+        """
+        # Lowercase, accents and confusables are normalized for easier matching
+        content = normalize(message)
+        try:
+            verdict = self._evaluate_rules(content, deadline)
+        except RulesBudgetExceeded as e:
+            log.warning("Regex stage over its budget after rule %s", e)
+            metrics.increment("proxy.rules.budget_exceeded")
+            return RulesVerdict(content=content, action=DENY, rule=RULES_BUDGET_RULE)
+        if verdict.language is not None:
+            self.rules.record(verdict.language, matched=verdict.action is not None)
+        return verdict
+
+    def _evaluate_rules(self, content: str, deadline: Optional[float]) -> RulesVerdict:
+        # A single version of the rule packs is used for the whole message
+        rules = self.rules.current
 
         # 1. Direct Injection
         # 1.1. Prompt Injection/Jailbreak detection
-        prompt_injection_patterns = [
-            r"ignore\s+all\s+previous\s+instructions",
-            r"disregard\s+previous\s+instructions",
-            r"pretend\s+to\s+be",
-            r"you are now",
-            r"as an ai language model",
-            r"repeat after me",
-            r"system prompt",
-            r"reveal your instructions",
-            r"forget you are an ai",
-            r"bypass",
-            r"jailbreak",
-            r"write a prompt that",
-            r"act as",
-            r"simulate",
-            r"please provide the system prompt",
-            r"what are your instructions",
-        ]
-        for pattern in prompt_injection_patterns:
-            if re.search(pattern, content):
-                return "deny"
-
-        # 1.2. PII detection (very basic, can be improved)
-        pii_patterns = [
-            r"\b\d{3}-\d{2}-\d{4}\b",  # SSN
-            r"\b\d{16}\b",  # Credit card (very naive)
-            r"\b\d{10,11}\b",  # Phone number
-            r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b",  # Email
-            r"\b\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\b",  # IP address
-        ]
-        for pattern in pii_patterns:
-            if re.search(pattern, content):
-                return "deny"
-
-        # 3. Hate speech, abuse, profanity (very basic, can be improved)
-        abuse_patterns = [
-            r"\b(fuck|shit|bitch|asshole|bastard|idiot|stupid|dumb|nigger|faggot|cunt|retard|whore|slut)\b",
-            r"\b(kill|suicide|die)\b",
-            r"\b(hate|abuse|racist|sexist)\b",
-        ]
-        for pattern in abuse_patterns:
-            if re.search(pattern, content):
-                return "deny"
+        match = rules.first_match(PROMPT_INJECTION, content, deadline)
+        if match:
+            return RulesVerdict(content, DENY, match.rule, language=match.language)
 
-        # 4. SQL Injection/XSS/Code Injection
-        code_injection_patterns = [
-            r"(<script>|</script>)",
-            r"(select\s+\*\s+from|drop\s+table|insert\s+into|delete\s+from|update\s+\w+\s+set)",
-            r"(;--|--\s|/\*|\*/|@@|@|char\(|nchar\(|varchar\(|alter\s+table|create\s+table)",
-            r"(os\.system|subprocess|eval\(|exec\()",
-        ]
-        for pattern in code_injection_patterns:
-            if re.search(pattern, content):
-                return "deny"
+        # 1.2. PII detection, PII is replaced with placeholders and the
+        # rest of the message is still validated
+        redaction = self.redactor.redact(content)
+        content = redaction.text
 
+        # 3. Hate speech, abuse, profanity
+        # 4. SQL Injection/XSS/Code Injection
         # 5. Warn for suspicious but not strictly forbidden content
-        warn_patterns = [
-            r"\b(secret|password|confidential|private)\b",
-            r"\b(hack|exploit|vulnerability)\b",
+        for action, category in (
+            (DENY, ABUSE),
+            (DENY, CODE_INJECTION),
+            (WARN, SUSPICIOUS),
+        ):
+            match = rules.first_match(category, content, deadline)
+            if match:
+                return RulesVerdict(
+                    content, action, match.rule, language=match.language
+                )
+        return RulesVerdict(
+            content=content,
+            redacted=redaction.redacted,
+            language=rules.detect_language(content),
+        )
+
+    async def moderate_batch(
+        self, messages: list[str]
+    ) -> AsyncGenerator[ModerationVerdict, None]:
+        """Moderate many messages, yielding the verdicts as they are ready.
+
+        The regex stage runs over the whole batch first, the leftovers are
+        packed in as few prompts to the agent as possible.
+        """
+        pending: list[tuple[int, RulesVerdict]] = []
+        for index, message in enumerate(messages):
+            verdict = await self.scan_rules(message)
+            if verdict.action is not None:
+                yield ModerationVerdict(index, verdict.action, verdict.rule)
+                continue
+            cached_action = self._cached_verdict(verdict.content)
+            if cached_action is not None:
+                yield ModerationVerdict(index, cached_action, VERDICT_CACHE_RULE)
+            else:
+                pending.append((index, verdict))
+
+        semaphore = asyncio.Semaphore(self.batch_max_concurrency)
+        tasks = [
+            asyncio.create_task(self._moderate_chunk(chunk, semaphore))
+            for chunk in self._pack_chunks(pending)
         ]
-        for pattern in warn_patterns:
-            if re.search(pattern, content):
-                return "warn"
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                for moderation_verdict in await next_done:
+                    yield moderation_verdict
+        finally:
+            for task in tasks:
+                task.cancel()
 
-        # If none of the above, request to agents to decide
+    def _pack_chunks(
+        self, pending: list[tuple[int, RulesVerdict]]
+    ) -> list[list[tuple[int, RulesVerdict]]]:
+        chunks: list[list[tuple[int, RulesVerdict]]] = []
+        chunk: list[tuple[int, RulesVerdict]] = []
+        chunk_chars = 0
+        for item in pending:
+            item_chars = len(item[1].content)
+            if chunk and (
+                chunk_chars + item_chars > self.batch_max_chars
+                or len(chunk) >= self.batch_max_items
+            ):
+                chunks.append(chunk)
+                chunk, chunk_chars = [], 0
+            chunk.append(item)
+            chunk_chars += item_chars
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    async def _moderate_chunk(
+        self, chunk: list[tuple[int, RulesVerdict]], semaphore: asyncio.Semaphore
+    ) -> list[ModerationVerdict]:
+        try:
+            async with semaphore:
+                actions = await self.classify_batch(
+                    [verdict.content for _, verdict in chunk]
+                )
+        except ModelExecutionError as e:
+            log.error("Model execution error on moderating batch: %s", e)
+            return [
+                ModerationVerdict(index, DENY, MODEL_ERROR_RULE) for index, _ in chunk
+            ]
+        moderation_verdicts = []
+        for (index, verdict), action in zip(chunk, actions):
+            self._cache_verdict(verdict.content, action)
+            if action == "allow" and verdict.redacted:
+                action = "obfuscate"
+            moderation_verdicts.append(ModerationVerdict(index, action, MODEL_RULE))
+        return moderation_verdicts
+
+    async def classify_batch(self, contents: list[str]) -> list[str]:
+        """Classify many messages with a single request to the agent."""
+        if len(contents) == 1:
+            return [await self._classify_with_agent(contents[0])]
+        prompt = build_batch_prompt(contents)
+        response = await self._classify_with_agent(prompt)
+        return parse_batch_response(response, len(contents))
+
+    def obfuscate(self, message: str) -> str:
+        """Replace the PII found in the message with typed placeholders."""
+        redaction = self.redactor.redact(message)
+        if redaction.redacted:
+            log.info("PII redacted from message: %s", dict(redaction.counts))
+        return redaction.text
+
+    async def _classify(self, content: str) -> str:
+        """Classify a message with the agent, once per deployment when the
+        verdicts are shared."""
+        if self.shared_verdicts is None:
+            return await self._classify_uncached(content)
+        return await self.shared_verdicts.get_or_set(
+            message_key(content), lambda: self._classify_uncached(content)
+        )
+
+    async def _classify_uncached(self, content: str) -> str:
+        """Classify a message with the agent, grouped with concurrent
+        classifications when a batcher is configured."""
+        if self.batcher is not None:
+            action = await self.batcher.classify(content)
+            # The batch is shared with other turns, the usage of the message
+            # is estimated with 4 characters per token
+            record_usage(PROXY_AGENT, len(content) // 4, 1)
+            return action
+        return await self._classify_with_agent(content)
+
+    async def _classify_with_agent(self, content: str) -> str:
         try:
             agent_response = await self.agent.run(content)
         except UnexpectedModelBehavior as e:
             raise ModelExecutionError from e
+        record_run_usage(PROXY_AGENT, agent_response)
         response: str = agent_response.output.lower()
         return response
 
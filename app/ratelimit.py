@@ -0,0 +1,217 @@
+import hashlib
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, NamedTuple, Optional, Protocol
+
+import pydantic_core
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.metrics import Metrics, metrics
+
+MAX_TRACKED_CLIENTS = 100_000
+API_KEY_HEADER = "x-api-key"
+
+
+class RateLimit(NamedTuple):
+    """Token bucket of capacity requests refilled at refill_per_second."""
+
+    capacity: int
+    refill_per_second: float
+
+    @classmethod
+    def per_minute(cls, requests: int) -> "RateLimit":
+        return cls(requests, requests / 60)
+
+
+class RateLimitDecision(NamedTuple):
+    allowed: bool
+    remaining: int
+    # Seconds until the next token when denied, until the bucket is full otherwise
+    reset_seconds: float
+
+
+def take_token(
+    tokens: float, updated: float, limit: RateLimit, now: float
+) -> tuple[float, bool]:
+    """Refill the bucket since updated and take a token, return the new tokens."""
+    tokens = min(limit.capacity, tokens + (now - updated) * limit.refill_per_second)
+    if tokens >= 1:
+        return tokens - 1, True
+    return tokens, False
+
+
+def build_decision(tokens: float, allowed: bool, limit: RateLimit) -> RateLimitDecision:
+    if allowed:
+        reset = (limit.capacity - tokens) / limit.refill_per_second
+    else:
+        reset = (1 - tokens) / limit.refill_per_second
+    return RateLimitDecision(allowed, int(tokens), reset)
+
+
+class RateLimitBackend(Protocol):
+    async def take(self, key: str, limit: RateLimit) -> RateLimitDecision: ...
+
+
+class InMemoryRateLimitBackend:
+    """Buckets of this process, the least recently seen clients are evicted."""
+
+    def __init__(self, max_keys: int = MAX_TRACKED_CLIENTS):
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    async def take(self, key: str, limit: RateLimit) -> RateLimitDecision:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens, allowed = limit.capacity - 1.0, True
+            if len(self._buckets) >= self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            tokens, allowed = take_token(bucket[0], bucket[1], limit, now)
+            self._buckets.move_to_end(key)
+        self._buckets[key] = (tokens, now)
+        return build_decision(tokens, allowed, limit)
+
+
+# Refill and take a token in a single atomic statement, supported by postgres
+# and sqlite so sqlite can stand in for the shared database locally
+REFILLED_TOKENS = """CASE
+    WHEN rate_limit_buckets.tokens + (:now - rate_limit_buckets.updated_at) * :rate > :capacity
+    THEN :capacity
+    ELSE rate_limit_buckets.tokens + (:now - rate_limit_buckets.updated_at) * :rate
+END"""
+TAKE_TOKEN_QUERY = f"""
+INSERT INTO rate_limit_buckets (bucket_key, tokens, updated_at, allowed)
+VALUES (:key, :capacity - 1, :now, 1)
+ON CONFLICT (bucket_key) DO UPDATE SET
+    tokens = CASE WHEN {REFILLED_TOKENS} >= 1
+        THEN {REFILLED_TOKENS} - 1 ELSE {REFILLED_TOKENS} END,
+    allowed = CASE WHEN {REFILLED_TOKENS} >= 1 THEN 1 ELSE 0 END,
+    updated_at = :now
+RETURNING tokens, allowed
+"""
+
+
+class DatabaseRateLimitBackend:
+    """Buckets shared by every node through the database.
+
+    Every decision is one round trip, so it is slower than the in memory
+    backend but the limits hold for the clients balanced between nodes.
+    """
+
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+
+    async def take(self, key: str, limit: RateLimit) -> RateLimitDecision:
+        async with self.engine.begin() as conn:
+            result = await conn.execute(
+                text(TAKE_TOKEN_QUERY),
+                {
+                    "key": key,
+                    "now": time.time(),
+                    "rate": limit.refill_per_second,
+                    "capacity": float(limit.capacity),
+                },
+            )
+            tokens, allowed = result.one()
+        return build_decision(tokens, bool(allowed), limit)
+
+
+def hash_api_key(api_key: str) -> str:
+    # The keys are hashed so they are never kept or sent to the backend
+    return hashlib.sha256(api_key.encode()).hexdigest()[:32]
+
+
+def client_key(scope: Scope, api_keys: frozenset[str] = frozenset()) -> str:
+    """Identify the client by its API key when it is one of the hashed
+    api_keys, by its IP otherwise."""
+    api_key = Headers(scope=scope).get(API_KEY_HEADER)
+    if api_key:
+        key_hash = hash_api_key(api_key)
+        # A made up key would give its sender a new bucket on every request
+        if key_hash in api_keys:
+            return "key:" + key_hash
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+
+class RateLimitMiddleware:
+    """Limit the requests per client on the routes of limits.
+
+    Routes without a limit are not counted. The responses get the RateLimit
+    headers and the denied requests a 429 with Retry-After. api_keys are the
+    hashes of the API keys identifying the clients, see client_key. The
+    backend is built by get_backend on the first limited request, so adding
+    the middleware does not open the database.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        limits: dict[str, RateLimit],
+        get_backend: Callable[[], RateLimitBackend] = InMemoryRateLimitBackend,
+        api_keys: frozenset[str] = frozenset(),
+        registry: Metrics = metrics,
+    ):
+        self.app = app
+        self.limits = limits
+        self.api_keys = api_keys
+        self.get_backend = get_backend
+        self._backend: Optional[RateLimitBackend] = None
+        self.metrics = registry
+
+    @property
+    def backend(self) -> RateLimitBackend:
+        if self._backend is None:
+            self._backend = self.get_backend()
+        return self._backend
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        decision = await self.backend.take(
+            f"{client_key(scope, self.api_keys)}:{scope['path']}", limit
+        )
+        headers = [
+            (b"ratelimit-limit", str(limit.capacity).encode()),
+            (b"ratelimit-remaining", str(decision.remaining).encode()),
+            (b"ratelimit-reset", str(math.ceil(decision.reset_seconds)).encode()),
+        ]
+        if not decision.allowed:
+            self.metrics.increment("ratelimit.denied")
+            await self._send_too_many_requests(send, headers, decision)
+            return
+        self.metrics.increment("ratelimit.allowed")
+
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+    @staticmethod
+    async def _send_too_many_requests(
+        send: Send, headers: list[tuple[bytes, bytes]], decision: RateLimitDecision
+    ) -> None:
+        body = pydantic_core.to_json({"detail": "Too Many Requests"})
+        retry_after = str(math.ceil(decision.reset_seconds)).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 429,
+                "headers": headers
+                + [
+                    (b"retry-after", retry_after),
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,68 @@
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+
+from app.regex_engine import compile_pattern
+
+# Quantifiers are bounded so every start position does a bounded amount of
+# work and the whole scan stays linear in the size of the message, also
+# with the re fallback of app.regex_engine.
+PII_PATTERN = compile_pattern(
+    r"(?P<email>\b[A-Za-z0-9._%+-]{1,64}@[A-Za-z0-9.-]{1,253}\.[A-Za-z]{2,24}\b)"
+    r"|(?P<ssn>\b\d{3}-\d{2}-\d{4}\b)"
+    r"|(?P<ip>\b\d{1,3}(?:\.\d{1,3}){3}\b)"
+    r"|(?P<card>\b(?:\d[ -]?){12,18}\d\b)"
+    r"|(?P<phone>\b\d{10,11}\b)"
+)
+
+PLACEHOLDERS = {
+    "email": "[EMAIL]",
+    "ssn": "[SSN]",
+    "ip": "[IP]",
+    "card": "[CARD]",
+    "phone": "[PHONE]",
+}
+
+
+def luhn_valid(digits: str) -> bool:
+    """Validate a card number with the Luhn checksum."""
+    total = 0
+    for position, char in enumerate(reversed(digits)):
+        digit = ord(char) - 48
+        if position % 2:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return total % 10 == 0
+
+
+@dataclass
+class RedactionResult:
+    text: str
+    counts: Counter[str] = field(default_factory=Counter)
+
+    @property
+    def redacted(self) -> bool:
+        return bool(self.counts)
+
+
+class PIIRedactor:
+    """Replace PII with typed placeholders in a single pass over the message."""
+
+    def redact(self, text: str) -> RedactionResult:
+        counts: Counter[str] = Counter()
+
+        def replace(match: re.Match[str]) -> str:
+            kind = match.lastgroup or ""
+            value = match.group()
+            if kind == "card":
+                digits = value.replace(" ", "").replace("-", "")
+                # Long numbers failing the checksum are not cards
+                if not luhn_valid(digits):
+                    return value
+            counts[kind] += 1
+            return PLACEHOLDERS[kind]
+
+        redacted_text = PII_PATTERN.sub(replace, text)
+        return RedactionResult(text=redacted_text, counts=counts)
@@ -0,0 +1,34 @@
+"""Compile the policy patterns with a linear time regex engine.
+
+The patterns are compiled with google-re2, a dependency of the project, and
+with re on the platforms it can not be installed on. RE2 matches in time
+linear in the size of the input and releases the GIL while matching, so a
+scan in a worker thread does not block the event loop. Patterns RE2 does not support
+(backreferences, lookarounds) fall back to re. Note that \\b and \\w are
+ASCII only in RE2.
+"""
+
+import logging
+import re
+
+try:
+    import re2  # type: ignore
+except ImportError:  # No google-re2 wheel for the platform, re is used
+    re2 = None
+
+log = logging.getLogger(__name__)
+
+
+def compile_pattern(pattern: str) -> re.Pattern[str]:
+    if re2 is not None:
+        try:
+            compiled: re.Pattern[str] = re2.compile(pattern)
+            return compiled
+        except re2.error:
+            log.warning("Pattern not supported by re2, using re: %s", pattern)
+    return re.compile(pattern)
+
+
+def is_linear(pattern: re.Pattern[str]) -> bool:
+    """Whether the pattern runs on the linear time engine."""
+    return not isinstance(pattern, re.Pattern)
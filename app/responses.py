@@ -0,0 +1,103 @@
+import gzip
+from typing import Any, Optional
+
+import pydantic_core
+from fastapi import Response
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli  # type: ignore
+except ImportError:  # brotli is optional, gzip is used without it
+    brotli = None
+
+
+class FastJSONResponse(Response):
+    """JSON response serialized straight to bytes by pydantic-core.
+
+    Returning it from an endpoint skips the validation of the response_model.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return pydantic_core.to_json(content)
+
+
+class CompressionMiddleware:
+    """Compress complete responses bigger than minimum_size with brotli or gzip.
+
+    Streamed responses are sent as they are so their chunks are not delayed.
+    The strong ETag of a compressed response is made weak, the compressed
+    bytes are not the ones it was computed from.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, level: int = 5):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = self._select_encoding(
+            Headers(scope=scope).get("accept-encoding", "")
+        )
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Optional[Message] = None
+        started = False
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start_message, started
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if (
+                started
+                or start_message is None
+                or message["type"] != "http.response.body"
+            ):
+                await send(message)
+                return
+            started = True
+            headers = MutableHeaders(raw=start_message["headers"])
+            body = message.get("body", b"")
+            if (
+                message.get("more_body", False)
+                or len(body) < self.minimum_size
+                or "content-encoding" in headers
+            ):
+                await send(start_message)
+                await send(message)
+                return
+            body = self._compress(encoding, body)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            if "accept-encoding" not in headers.get("vary", "").lower():
+                headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag is not None and not etag.startswith("W/"):
+                headers["ETag"] = "W/" + etag
+            await send(start_message)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_compressed)
+
+    @staticmethod
+    def _select_encoding(accept_encoding: str) -> Optional[str]:
+        accepted = {value.split(";")[0].strip() for value in accept_encoding.split(",")}
+        if brotli is not None and "br" in accepted:
+            return "br"
+        if "gzip" in accepted:
+            return "gzip"
+        return None
+
+    def _compress(self, encoding: str, body: bytes) -> bytes:
+        if encoding == "br":
+            compressed: bytes = brotli.compress(body, quality=self.level)
+            return compressed
+        return gzip.compress(body, compresslevel=self.level)
@@ -0,0 +1,283 @@
+"""Rule packs of the regex stage of the proxy, one per language.
+
+A rule pack is a JSON file with its language, version, stopwords used to
+attribute messages to the pack and the patterns of every category:
+
+    {
+        "language": "es",
+        "version": "2025.10.1",
+        "stopwords": ["el", "la", "de"],
+        "rules": {"prompt_injection": ["ignora\\\\s+tus\\\\s+instrucciones"]}
+    }
+
+The patterns are written for normalized text, see normalize. The English
+pack is built from app.policies and a file with the same language replaces
+it. Packs are compiled together and swapped atomically when the files
+change, a scan always uses a single version of the rules.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+import unicodedata
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from app.metrics import Metrics, metrics
+from app.policies import (
+    ABUSE_PATTERNS,
+    CODE_INJECTION_PATTERNS,
+    PROMPT_INJECTION_PATTERNS,
+    WARN_PATTERNS,
+)
+from app.regex_engine import compile_pattern
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RULE_PACKS_DIR = Path(__file__).parent / "rules"
+PROMPT_INJECTION = "prompt_injection"
+ABUSE = "abuse"
+CODE_INJECTION = "code_injection"
+SUSPICIOUS = "suspicious"
+CATEGORIES = (PROMPT_INJECTION, ABUSE, CODE_INJECTION, SUSPICIOUS)
+UNKNOWN_LANGUAGE = "unknown"
+# Words read to attribute a message to a pack
+LANGUAGE_SAMPLE_WORDS = 50
+
+# fmt: off
+ENGLISH_STOPWORDS = [
+    "the", "a", "an", "and", "of", "to", "in", "is", "are", "you", "your",
+    "that", "it", "for", "on", "with", "as", "this", "be", "me", "my", "what",
+]
+# Cyrillic and greek letters used to disguise latin words
+CONFUSABLES = {
+    "\u0430": "a", "\u0432": "b", "\u0435": "e", "\u043a": "k",
+    "\u043c": "m", "\u043d": "h", "\u043e": "o", "\u0440": "p",
+    "\u0441": "c", "\u0442": "t", "\u0443": "y", "\u0445": "x",
+    "\u0456": "i", "\u0458": "j", "\u0455": "s", "\u0501": "d",
+    "\u0261": "g", "\u03bf": "o", "\u03b1": "a", "\u03b9": "i",
+    "\u03c1": "p", "\u03bd": "v", "\u03ba": "k", "\u03c4": "t",
+}
+# fmt: on
+# Soft hyphen, zero width spaces and joiners, word joiner and BOM
+INVISIBLE_CHARACTERS = "\u00ad\u200b\u200c\u200d\u2060\ufeff"
+
+
+def _build_normalization_table() -> dict[int, Optional[str]]:
+    table: dict[int, Optional[str]] = {}
+    for codepoint in [*range(0x3000), *range(0xFF00, 0xFFF0)]:
+        char = chr(codepoint)
+        decomposed = unicodedata.normalize("NFKD", char)
+        base = "".join(c for c in decomposed if not unicodedata.combining(c))
+        normalized = CONFUSABLES.get(base.lower(), base.lower())
+        if normalized != char:
+            table[codepoint] = normalized
+    for char in INVISIBLE_CHARACTERS:
+        table[ord(char)] = None
+    return table
+
+
+NORMALIZATION_TABLE = _build_normalization_table()
+
+
+def normalize(text: str) -> str:
+    """Lowercase the text, strip the accents, map the confusable letters and
+    remove the invisible characters in a single pass."""
+    if text.isascii():
+        return text.lower()
+    return text.translate(NORMALIZATION_TABLE)
+
+
+@dataclass(frozen=True)
+class RulePack:
+    language: str
+    version: str
+    rules: dict[str, list[str]]
+    stopwords: frozenset[str] = frozenset()
+
+    @classmethod
+    def from_file(cls, path: Path) -> "RulePack":
+        data = json.loads(path.read_text(encoding="utf-8"))
+        unknown = set(data["rules"]) - set(CATEGORIES)
+        if unknown:
+            raise ValueError(f"Unknown categories in {path.name}: {unknown}")
+        return cls(
+            language=data["language"],
+            version=str(data["version"]),
+            rules=data["rules"],
+            stopwords=frozenset(normalize(word) for word in data.get("stopwords", [])),
+        )
+
+    @classmethod
+    def builtin(cls) -> "RulePack":
+        return cls(
+            language="en",
+            version="builtin",
+            rules={
+                PROMPT_INJECTION: PROMPT_INJECTION_PATTERNS,
+                ABUSE: ABUSE_PATTERNS,
+                CODE_INJECTION: CODE_INJECTION_PATTERNS,
+                SUSPICIOUS: WARN_PATTERNS,
+            },
+            stopwords=frozenset(ENGLISH_STOPWORDS),
+        )
+
+
+class RuleMatch(NamedTuple):
+    rule: str
+    language: str
+
+
+class RulesBudgetExceeded(Exception):
+    """Raised when the regex stage runs past its deadline."""
+
+
+class CompiledRules:
+    """Immutable compiled version of a set of rule packs."""
+
+    def __init__(self, packs: list[RulePack]):
+        self.packs = packs
+        self._categories: dict[
+            str,
+            tuple[Optional[re.Pattern[str]], list[tuple[str, re.Pattern[str], str]]],
+        ] = {}
+        for category in CATEGORIES:
+            rules = [
+                (f"{category}:{pattern}", compile_pattern(pattern), pack.language)
+                for pack in packs
+                for pattern in pack.rules.get(category, [])
+            ]
+            # Most messages match nothing, a single scan of the combined
+            # patterns rules out the whole category
+            combined = compile_pattern("|".join(f"(?:{r[1].pattern})" for r in rules))
+            self._categories[category] = (combined if rules else None, rules)
+
+    def first_match(
+        self, category: str, content: str, deadline: Optional[float] = None
+    ) -> Optional[RuleMatch]:
+        combined, rules = self._categories[category]
+        if combined is None:
+            return None
+        found = combined.search(content)
+        if deadline is not None and time.perf_counter() > deadline:
+            raise RulesBudgetExceeded(category)
+        if not found:
+            return None
+        for rule, pattern, language in rules:
+            if pattern.search(content):
+                return RuleMatch(rule, language)
+            if deadline is not None and time.perf_counter() > deadline:
+                raise RulesBudgetExceeded(rule)
+        return None
+
+    def detect_language(self, content: str) -> str:
+        """Attribute a message to the pack with most stopwords in it."""
+        words = content.split(maxsplit=LANGUAGE_SAMPLE_WORDS)[:LANGUAGE_SAMPLE_WORDS]
+        best, best_hits = UNKNOWN_LANGUAGE, 0
+        for pack in self.packs:
+            hits = sum(word in pack.stopwords for word in words)
+            if hits > best_hits:
+                best, best_hits = pack.language, hits
+        return best
+
+
+@dataclass
+class RulePackStats:
+    matched: int = 0
+    fallthrough: int = 0
+
+
+class RuleEngine:
+    """Load the rule packs of a directory and reload them when they change.
+
+    Reading current is atomic, a reload compiles the new packs first and
+    keeps the previous rules when a pack is invalid.
+    """
+
+    def __init__(
+        self, directory: Path = DEFAULT_RULE_PACKS_DIR, registry: Metrics = metrics
+    ):
+        self.directory = Path(directory)
+        self.metrics = registry
+        self._signature: tuple = ()
+        self._stats: dict[str, RulePackStats] = {}
+        self._stats_lock = threading.Lock()
+        self.current = CompiledRules([RulePack.builtin()])
+        self.reload()
+
+    def reload(self) -> bool:
+        """Compile the packs again if the files changed, return if they did."""
+        signature = self._directory_signature()
+        if signature == self._signature:
+            return False
+        packs = {"en": RulePack.builtin()}
+        try:
+            for path in sorted(self.directory.glob("*.json")):
+                pack = RulePack.from_file(path)
+                packs[pack.language] = pack
+            compiled = CompiledRules(list(packs.values()))
+        except Exception as e:
+            log.error("Invalid rule packs, keeping the current ones: %s", e)
+            self.metrics.increment("rule_packs.reload_errors")
+            self._signature = signature
+            return False
+        self.current = compiled
+        self._signature = signature
+        self.metrics.increment("rule_packs.reloads")
+        for pack in compiled.packs:
+            log.info("Rule pack %s version %s loaded", pack.language, pack.version)
+        return True
+
+    def record(self, language: str, matched: bool) -> None:
+        """Count a message decided by the rules or falling through to the model."""
+        with self._stats_lock:
+            stats = self._stats.setdefault(language, RulePackStats())
+            if matched:
+                stats.matched += 1
+            else:
+                stats.fallthrough += 1
+            rate = stats.fallthrough / (stats.matched + stats.fallthrough)
+        state = "matched" if matched else "fallthrough"
+        self.metrics.increment(f"rule_packs.{language}.{state}")
+        self.metrics.set_gauge(f"rule_packs.{language}.fallthrough_rate", rate)
+
+    def describe(self) -> list[dict]:
+        with self._stats_lock:
+            stats = {language: vars(s).copy() for language, s in self._stats.items()}
+        return [
+            {
+                "language": pack.language,
+                "version": pack.version,
+                "rules": sum(len(patterns) for patterns in pack.rules.values()),
+                **stats.get(pack.language, vars(RulePackStats())),
+            }
+            for pack in self.current.packs
+        ]
+
+    def _directory_signature(self) -> tuple:
+        if not self.directory.is_dir():
+            return ()
+        return tuple(
+            (path.name, path.stat().st_mtime_ns, path.stat().st_size)
+            for path in sorted(self.directory.glob("*.json"))
+        )
+
+
+@lru_cache(maxsize=1)
+def get_rule_engine(directory: Path = DEFAULT_RULE_PACKS_DIR) -> RuleEngine:
+    return RuleEngine(directory)
+
+
+async def maintain_rule_packs(engine: RuleEngine, interval_seconds: float) -> None:
+    """Reload the rule packs when their files change."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await asyncio.to_thread(engine.reload)
+        except Exception as e:
+            log.error("Error on reloading rule packs: %s", e)
@@ -0,0 +1,30 @@
+import asyncio
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+from app.metrics import Metrics, metrics
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """Share one in-flight call between concurrent callers with the same key."""
+
+    def __init__(self, name: str, registry: Metrics = metrics):
+        self.name = name
+        self.metrics = registry
+        self._calls: dict[Hashable, asyncio.Future[T]] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        call = self._calls.get(key)
+        if call is None:
+            self.metrics.increment(f"{self.name}.calls")
+            call = asyncio.ensure_future(fn())
+            self._calls[key] = call
+            call.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.metrics.increment(f"{self.name}.coalesced")
+        # A caller that is cancelled must not cancel the call of the others
+        return await asyncio.shield(call)
+
+    def __len__(self) -> int:
+        return len(self._calls)
@@ -0,0 +1,61 @@
+"""Warm up of the process before it reports it is ready.
+
+The agents are built before it instead of at import, which also imports
+their model provider, and the database pool and the HTTP connection to the
+model provider are opened so the first requests do not pay for them.
+"""
+
+import asyncio
+import logging
+import time
+
+import httpx
+from pydantic_ai.models import Model
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.db import prewarm_pool
+from app.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+async def prewarm_model_client(client: httpx.AsyncClient, model: Model) -> None:
+    """Open the TLS connection to the model provider with a request that does
+    not run the model, the connection stays in the shared pool."""
+    if not model.base_url:
+        return
+    # Any status means the connection is open, only network errors matter
+    await client.head(model.base_url)
+
+
+async def warm_up(
+    engine: AsyncEngine,
+    models: list[Model],
+    http_client: httpx.AsyncClient,
+    pool_connections: int,
+    timeout_seconds: float,
+) -> None:
+    """Warm the database pool and the model clients within a timeout.
+
+    A failed or slow warm up is logged and the process starts anyway, the
+    connections are then opened by the first requests.
+    """
+    start = time.perf_counter()
+    warmers = {
+        "db_pool": prewarm_pool(engine, pool_connections),
+        **{
+            f"model_{index}": prewarm_model_client(http_client, model)
+            for index, model in enumerate(models)
+        },
+    }
+    results = await asyncio.gather(
+        *(asyncio.wait_for(warmer, timeout_seconds) for warmer in warmers.values()),
+        return_exceptions=True,
+    )
+    for name, result in zip(warmers, results):
+        if isinstance(result, BaseException):
+            log.warning("Warm up of %s failed: %r", name, result)
+            metrics.increment(f"startup.warm_up_errors.{name}")
+    elapsed = time.perf_counter() - start
+    metrics.set_gauge("startup.warm_up_seconds", elapsed)
+    log.info("Warm up finished in %.3fs", elapsed)
@@ -0,0 +1,38 @@
+import re
+import zlib
+
+WORD_PATTERN = re.compile(r"\w+")
+# Messages shorter than this do not compress enough to give a useful score
+MIN_REPETITION_BYTES = 256
+
+
+def words(text: str) -> list[str]:
+    """Split a text in lowercase words, punctuation is ignored."""
+    return WORD_PATTERN.findall(text.lower())
+
+
+def shingle_hashes(tokens: list[str], size: int) -> set[int]:
+    """Return the hashes of every window of `size` consecutive tokens.
+
+    crc32 instead of hash(), which is salted per process, so the similarity
+    of two messages does not change between runs.
+    """
+    if len(tokens) < size:
+        return {zlib.crc32(" ".join(tokens).encode())} if tokens else set()
+    return {
+        zlib.crc32(" ".join(tokens[i : i + size]).encode())
+        for i in range(len(tokens) - size + 1)
+    }
+
+
+def repetition_score(text: str) -> float:
+    """Score between 0 and 1 about how repetitive a text is.
+
+    Uses the compression ratio of the text, a text that repeats the same
+    sentence over and over compresses to a small fraction of its size.
+    zlib runs in linear time so the score is safe for large inputs.
+    """
+    data = text.encode()
+    if len(data) < MIN_REPETITION_BYTES:
+        return 0.0
+    return 1 - len(zlib.compress(data, 1)) / len(data)
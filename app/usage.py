@@ -0,0 +1,305 @@
+"""Token usage and model calls per conversation and per client.
+
+The counters are kept in memory and the increments are flushed to the
+usage_counters table in batches. A chat turn runs inside a UsageScope, the
+agent calls made during the turn are added to its conversation and client
+without passing the scope through every layer.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from datetime import date
+from typing import Any, Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.metrics import Metrics, metrics
+
+log = logging.getLogger(__name__)
+
+MAIN_AGENT = "main"
+PROXY_AGENT = "proxy"
+CONVERSATION_SCOPE = "conversation"
+CLIENT_SCOPE = "client"
+USAGE_SCOPES = (CONVERSATION_SCOPE, CLIENT_SCOPE)
+MAX_TRACKED_KEYS = 100_000
+# Hex characters of the opaque keys reported by top
+REPORTED_KEY_CHARS = 16
+
+# Add the increments to the stored counters, supported by postgres and sqlite
+FLUSH_QUERY = """
+INSERT INTO usage_counters
+    (scope, usage_key, input_tokens, output_tokens, main_calls, proxy_calls, updated_at)
+VALUES
+    (:scope, :usage_key, :input_tokens, :output_tokens, :main_calls, :proxy_calls, :now)
+ON CONFLICT (scope, usage_key) DO UPDATE SET
+    input_tokens = usage_counters.input_tokens + excluded.input_tokens,
+    output_tokens = usage_counters.output_tokens + excluded.output_tokens,
+    main_calls = usage_counters.main_calls + excluded.main_calls,
+    proxy_calls = usage_counters.proxy_calls + excluded.proxy_calls,
+    updated_at = excluded.updated_at
+"""
+COUNTER_COLUMNS = "input_tokens, output_tokens, main_calls, proxy_calls"
+LOAD_QUERY = f"""
+SELECT {COUNTER_COLUMNS} FROM usage_counters
+WHERE scope = :scope AND usage_key = :usage_key
+"""
+TOP_QUERY = f"""
+SELECT usage_key, {COUNTER_COLUMNS} FROM usage_counters
+WHERE scope = :scope
+ORDER BY input_tokens + output_tokens DESC
+LIMIT :limit
+"""
+
+
+@dataclass(slots=True)
+class Usage:
+    input_tokens: int = 0
+    output_tokens: int = 0
+    main_calls: int = 0
+    proxy_calls: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+    def add(self, other: "Usage") -> None:
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.main_calls += other.main_calls
+        self.proxy_calls += other.proxy_calls
+
+
+def client_usage_key(client: str, day: Optional[date] = None) -> str:
+    """The budget of a client is per day, its counters are too."""
+    return f"{(day or date.today()).isoformat()}:{client}"
+
+
+class UsageTracker:
+    """Counters of the conversations and clients with their budgets.
+
+    The totals are a bounded LRU, an evicted or unknown key is loaded from
+    the database when a budget is checked. A budget of 0 is unlimited.
+    """
+
+    def __init__(
+        self,
+        conversation_token_budget: int = 0,
+        client_daily_token_budget: int = 0,
+        engine: Optional[AsyncEngine] = None,
+        max_keys: int = MAX_TRACKED_KEYS,
+        registry: Metrics = metrics,
+    ):
+        self.budgets = {
+            CONVERSATION_SCOPE: conversation_token_budget,
+            CLIENT_SCOPE: client_daily_token_budget,
+        }
+        self.engine = engine
+        self.max_keys = max_keys
+        self.metrics = registry
+        self._totals: OrderedDict[tuple[str, str], Usage] = OrderedDict()
+        # Increments not flushed to the database yet
+        self._pending: dict[tuple[str, str], Usage] = {}
+        # A random key per tracker so the reported keys can not be matched
+        # against hashes of known ids or IPs
+        self._report_key = os.urandom(16)
+
+    def record(
+        self,
+        conversation_id: Optional[uuid.UUID],
+        client: Optional[str],
+        usage: Usage,
+    ) -> None:
+        keys = []
+        if conversation_id is not None:
+            keys.append((CONVERSATION_SCOPE, str(conversation_id)))
+        if client is not None:
+            keys.append((CLIENT_SCOPE, client_usage_key(client)))
+        for key in keys:
+            self._total(key).add(usage)
+            if self.engine is not None:
+                self._pending.setdefault(key, Usage()).add(usage)
+        self.metrics.increment("usage.input_tokens", usage.input_tokens)
+        self.metrics.increment("usage.output_tokens", usage.output_tokens)
+
+    async def exceeded_budget(
+        self, conversation_id: Optional[uuid.UUID], client: Optional[str]
+    ) -> Optional[str]:
+        """Return the scope whose budget is used up, None if both are left."""
+        keys = []
+        if conversation_id is not None:
+            keys.append((CONVERSATION_SCOPE, str(conversation_id)))
+        if client is not None:
+            keys.append((CLIENT_SCOPE, client_usage_key(client)))
+        for scope, key in keys:
+            budget = self.budgets[scope]
+            if budget <= 0:
+                continue
+            usage = await self.get(scope, key)
+            if usage.total_tokens >= budget:
+                self.metrics.increment(f"usage.budget_exceeded.{scope}")
+                return scope
+        return None
+
+    async def get(self, scope: str, key: str) -> Usage:
+        usage = self._totals.get((scope, key))
+        if usage is not None:
+            self._totals.move_to_end((scope, key))
+            return usage
+        # The total is the flushed counters plus the increments still pending
+        usage = await self._load(scope, key)
+        pending = self._pending.get((scope, key))
+        if pending is not None:
+            usage.add(pending)
+        self._put((scope, key), usage)
+        return usage
+
+    async def top(self, scope: str, limit: int) -> list[dict[str, Any]]:
+        """The keys of a scope with more tokens used, from the most to the
+        least, reported as opaque keys (see reported_key)."""
+        if self.engine is None:
+            ranked = sorted(
+                (
+                    (key, usage)
+                    for (key_scope, key), usage in self._totals.items()
+                    if key_scope == scope
+                ),
+                key=lambda item: item[1].total_tokens,
+                reverse=True,
+            )[:limit]
+        else:
+            await self.flush()
+            async with self.engine.connect() as conn:
+                result = await conn.execute(
+                    text(TOP_QUERY), {"scope": scope, "limit": limit}
+                )
+                ranked = [(row[0], Usage(*row[1:])) for row in result]
+        return [
+            {
+                "key": self.reported_key(scope, key),
+                **asdict(usage),
+                "total_tokens": usage.total_tokens,
+            }
+            for key, usage in ranked
+        ]
+
+    def reported_key(self, scope: str, key: str) -> str:
+        """Opaque form of a key: a conversation id gives access to its
+        messages and a client key has the IP or API key of the client. The
+        day of the client keys is kept."""
+        digest = hashlib.blake2b(
+            key.encode(), digest_size=REPORTED_KEY_CHARS // 2, key=self._report_key
+        ).hexdigest()
+        if scope == CLIENT_SCOPE:
+            day, _, _ = key.partition(":")
+            return f"{day}:{digest}"
+        return digest
+
+    async def flush(self) -> int:
+        """Write the pending increments in a single batch, return how many keys."""
+        if self.engine is None or not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        now = time.time()
+        rows = [
+            {"scope": scope, "usage_key": key, "now": now, **asdict(usage)}
+            for (scope, key), usage in pending.items()
+        ]
+        try:
+            async with self.engine.begin() as conn:
+                await conn.execute(text(FLUSH_QUERY), rows)
+        except SQLAlchemyError:
+            # Kept for the next flush, with the increments recorded meanwhile
+            for key, usage in pending.items():
+                self._pending.setdefault(key, Usage()).add(usage)
+            raise
+        self.metrics.increment("usage.flushed_keys", len(rows))
+        return len(rows)
+
+    def _total(self, key: tuple[str, str]) -> Usage:
+        usage = self._totals.get(key)
+        if usage is None:
+            usage = Usage()
+        self._put(key, usage)
+        return usage
+
+    def _put(self, key: tuple[str, str], usage: Usage) -> None:
+        self._totals[key] = usage
+        self._totals.move_to_end(key)
+        while len(self._totals) > self.max_keys:
+            self._totals.popitem(last=False)
+
+    async def _load(self, scope: str, key: str) -> Usage:
+        """Flushed counters of the key, the pending increments are not included."""
+        if self.engine is None:
+            return Usage()
+        try:
+            async with self.engine.connect() as conn:
+                result = await conn.execute(
+                    text(LOAD_QUERY), {"scope": scope, "usage_key": key}
+                )
+                row = result.first()
+        except SQLAlchemyError as e:
+            log.error(f"Database error on loading usage counters: {e}")
+            return Usage()
+        return Usage(*row) if row is not None else Usage()
+
+
+@dataclass
+class UsageScope:
+    """Conversation and client the agent calls of the running turn are for."""
+
+    tracker: UsageTracker
+    client: Optional[str] = None
+    conversation_id: Optional[uuid.UUID] = None
+
+
+usage_scope: ContextVar[Optional[UsageScope]] = ContextVar("usage_scope", default=None)
+
+
+def set_usage_conversation(conversation_id: uuid.UUID) -> None:
+    """Attribute the next calls of the turn to a just created conversation."""
+    scope = usage_scope.get()
+    if scope is not None:
+        scope.conversation_id = conversation_id
+
+
+def record_usage(agent: str, input_tokens: int, output_tokens: int) -> None:
+    """Add an agent call to the conversation and the client of the turn."""
+    scope = usage_scope.get()
+    if scope is None:
+        return
+    usage = Usage(
+        input_tokens=int(input_tokens or 0),
+        output_tokens=int(output_tokens or 0),
+        main_calls=int(agent == MAIN_AGENT),
+        proxy_calls=int(agent == PROXY_AGENT),
+    )
+    scope.tracker.record(scope.conversation_id, scope.client, usage)
+
+
+def record_run_usage(agent: str, result: Any) -> None:
+    """Record the tokens reported in the result of an agent run."""
+    if usage_scope.get() is None:
+        return
+    run_usage = result.usage()
+    record_usage(agent, run_usage.input_tokens, run_usage.output_tokens)
+
+
+async def maintain_usage(tracker: UsageTracker, interval_seconds: float) -> None:
+    """Flush the usage counters periodically."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await tracker.flush()
+        except Exception as e:
+            log.error("Error on flushing usage counters: %s", e)
@@ -0,0 +1,148 @@
+"""Cache of the proxy verdicts that also answers for near-duplicate messages.
+
+Messages are split in word shingles and summarized with a MinHash
+signature. The signature is cut in bands and every band is a key of the
+index, so two messages with a high Jaccard similarity share a band with
+high probability and the lookup only compares a few candidates.
+"""
+
+import random
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from app.metrics import Metrics, metrics
+from app.text_analysis import shingle_hashes, words
+
+# Mersenne prime used by the hash functions of the signature
+MERSENNE_PRIME = (1 << 61) - 1
+HASH_MASK = (1 << 64) - 1
+DEFAULT_SHINGLE_SIZE = 2
+DEFAULT_BANDS = 8
+DEFAULT_ROWS = 4
+# Seed of the hash functions, fixed so the signatures are reproducible
+SIGNATURE_SEED = 1337
+
+
+@dataclass(slots=True)
+class CachedVerdict:
+    action: str
+    signature: tuple[int, ...]
+
+
+class NearDuplicateCache:
+    """Bounded LRU of deny and warn verdicts indexed with MinHash LSH.
+
+    A message with an estimated similarity of at least threshold to a
+    cached message gets its verdict. With the default 8 bands of 4 rows
+    two messages with a similarity of 0.7 share a band 89% of the times
+    and messages with a similarity of 0.3 only 6%.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        threshold: float,
+        shingle_size: int = DEFAULT_SHINGLE_SIZE,
+        bands: int = DEFAULT_BANDS,
+        rows: int = DEFAULT_ROWS,
+        registry: Metrics = metrics,
+    ):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.bands = bands
+        self.rows = rows
+        self.metrics = registry
+        generator = random.Random(SIGNATURE_SEED)
+        self._hashes = [
+            (
+                generator.randrange(1, MERSENNE_PRIME),
+                generator.randrange(MERSENNE_PRIME),
+            )
+            for _ in range(bands * rows)
+        ]
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[int, CachedVerdict] = OrderedDict()
+        self._buckets: dict[tuple[int, tuple[int, ...]], set[int]] = {}
+        self._next_id = 0
+
+    def signature(self, message: str) -> Optional[tuple[int, ...]]:
+        """MinHash signature of the word shingles, None for a message without words."""
+        shingles = [
+            shingle & HASH_MASK
+            for shingle in shingle_hashes(words(message), self.shingle_size)
+        ]
+        if not shingles:
+            return None
+        return tuple(
+            min((a * shingle + b) % MERSENNE_PRIME for shingle in shingles)
+            for a, b in self._hashes
+        )
+
+    def get(self, message: str) -> Optional[str]:
+        """Return the verdict of the most similar cached message, if any is
+        similar enough."""
+        signature = self.signature(message)
+        if signature is None:
+            return None
+        with self._lock:
+            best: Optional[int] = None
+            best_similarity = self.threshold
+            for entry_id in self._candidates(signature):
+                similarity = self._similarity(
+                    signature, self._entries[entry_id].signature
+                )
+                if similarity >= best_similarity:
+                    best, best_similarity = entry_id, similarity
+            if best is None:
+                self.metrics.increment("proxy.verdict_cache.misses")
+                return None
+            self._entries.move_to_end(best)
+            action = self._entries[best].action
+        self.metrics.increment("proxy.verdict_cache.hits")
+        self.metrics.observe("proxy.verdict_cache.similarity", best_similarity)
+        return action
+
+    def put(self, message: str, action: str) -> None:
+        signature = self.signature(message)
+        if signature is None or self.max_entries <= 0:
+            return
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = CachedVerdict(action, signature)
+            for band in self._bands(signature):
+                self._buckets.setdefault(band, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._evict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _candidates(self, signature: tuple[int, ...]) -> set[int]:
+        candidates: set[int] = set()
+        for band in self._bands(signature):
+            candidates.update(self._buckets.get(band, ()))
+        return candidates
+
+    def _bands(self, signature: tuple[int, ...]) -> list[tuple[int, tuple[int, ...]]]:
+        return [
+            (band, signature[band * self.rows : (band + 1) * self.rows])
+            for band in range(self.bands)
+        ]
+
+    def _evict(self) -> None:
+        entry_id, entry = self._entries.popitem(last=False)
+        for band in self._bands(entry.signature):
+            bucket = self._buckets[band]
+            bucket.discard(entry_id)
+            if not bucket:
+                del self._buckets[band]
+        self.metrics.increment("proxy.verdict_cache.evictions")
+
+    @staticmethod
+    def _similarity(first: tuple[int, ...], second: tuple[int, ...]) -> float:
+        """Estimated Jaccard similarity, the share of equal minimums."""
+        return sum(a == b for a, b in zip(first, second)) / len(first)
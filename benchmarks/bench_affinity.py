@@ -0,0 +1,75 @@
+"""Simulate the hit rate of the per process caches with more workers.
+
+Every worker keeps an LRU of the conversations it served, like the verdict
+cache or the debate state. The turns of many conversations are sent to the
+workers at random, as without a dispatcher, or with the rendezvous hashing
+of app.affinity. A worker is restarted halfway and the conversations that
+changed of worker are counted as hops.
+
+Run with: python -m benchmarks.bench_affinity
+"""
+
+import random
+import uuid
+from collections import OrderedDict
+
+from app.affinity import rendezvous_owner
+
+WORKERS = [1, 2, 4, 8, 16, 32, 64]
+CONVERSATIONS = 20_000
+TURNS = 200_000
+# Conversations each worker can keep
+CACHE_ENTRIES = 2_000
+
+
+def simulate(workers: int, affinity: bool, seed: int = 7) -> tuple[float, int]:
+    rng = random.Random(seed)
+    names = [f"worker-{index}" for index in range(workers)]
+    caches: dict[str, OrderedDict[str, None]] = {name: OrderedDict() for name in names}
+    conversations = [
+        str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(CONVERSATIONS)
+    ]
+    # A few conversations are much more active than the rest
+    weights = [1 / (rank + 1) ** 0.8 for rank in range(CONVERSATIONS)]
+    turns = rng.choices(conversations, weights=weights, k=TURNS)
+    hits = hops = 0
+    last_worker: dict[str, str] = {}
+    for turn, conversation_id in enumerate(turns):
+        alive = names
+        if workers > 1 and TURNS // 2 <= turn < TURNS // 2 + TURNS // 20:
+            # The first worker is down for 5% of the turns
+            alive = names[1:]
+        if affinity:
+            worker = rendezvous_owner(conversation_id, alive)
+        else:
+            worker = rng.choice(alive)
+        cache = caches[worker]  # type: ignore[index]
+        if conversation_id in cache:
+            hits += 1
+            cache.move_to_end(conversation_id)
+        else:
+            cache[conversation_id] = None
+            if len(cache) > CACHE_ENTRIES:
+                cache.popitem(last=False)
+        if last_worker.get(conversation_id, worker) != worker:
+            hops += 1
+        last_worker[conversation_id] = worker  # type: ignore[assignment]
+    return hits / TURNS, hops
+
+
+def main() -> None:
+    print(
+        f"{'workers':>8} {'random hit':>11} {'affinity hit':>13}"
+        f" {'random hops':>12} {'affinity hops':>14}"
+    )
+    for workers in WORKERS:
+        random_hit, random_hops = simulate(workers, affinity=False)
+        affinity_hit, affinity_hops = simulate(workers, affinity=True)
+        print(
+            f"{workers:>8} {random_hit:>11.1%} {affinity_hit:>13.1%}"
+            f" {random_hops:>12} {affinity_hops:>14}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Measure the two tier cache with several nodes sharing it.
+
+The lookups of messages follow a Zipf like distribution and are spread at
+random over the nodes. Each node has its own TieredCache, only with its
+local tier or also with a shared tier on a sqlite file standing in for the
+database. The classifications done by the deployment, the hit ratio and the
+average latency of each tier are printed, with the size of the encoded
+verdicts, topics and histories.
+
+Run with: python -m benchmarks.bench_cache
+"""
+
+import asyncio
+import random
+import tempfile
+from pathlib import Path
+
+import pydantic_core
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+
+from app.cache import DatabaseCacheBackend, TieredCache, encode
+from app.entities import CacheEntries  # noqa: F401 registers the table
+from app.metrics import Metrics
+
+NODES = [1, 2, 4, 8]
+MESSAGES = 2_000
+LOOKUPS = 10_000
+LOCAL_ENTRIES = 500
+
+
+async def simulate(nodes: int, shared: bool, db_path: Path, seed: int = 7) -> str:
+    rng = random.Random(seed)
+    registry = Metrics()
+    engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.drop_all)
+        await conn.run_sync(SQLModel.metadata.create_all)
+    backend = DatabaseCacheBackend(engine) if shared else None
+    caches = [
+        TieredCache("bench", backend, local_entries=LOCAL_ENTRIES, registry=registry)
+        for _ in range(nodes)
+    ]
+    weights = [1 / (rank + 1) for rank in range(MESSAGES)]
+    messages = [f"message-{rank}" for rank in range(MESSAGES)]
+    keys = rng.choices(messages, weights, k=LOOKUPS)
+
+    async def classify() -> str:
+        return "allow"
+
+    for key in keys:
+        await rng.choice(caches).get_or_set(key, classify)
+    await engine.dispose()
+    snapshot = registry.snapshot()
+    columns = [f"{nodes:>6} {'yes' if shared else 'no':>7}"]
+    columns.append(f"{snapshot['counters'].get('cache.bench.computations', 0):>8}")
+    for tier in ("local", "shared"):
+        ratio = snapshot["gauges"].get(f"cache.bench.{tier}.hit_ratio", 0.0)
+        seconds = snapshot["summaries"].get(f"cache.bench.{tier}.seconds", {})
+        columns.append(f"{ratio:>10.1%} {seconds.get('avg', 0.0) * 1e6:>9.1f}")
+    return " ".join(columns)
+
+
+async def run() -> None:
+    print(
+        f"{'nodes':>6} {'shared':>7} {'computed':>8} {'local hit':>10}"
+        f" {'local us':>9} {'shared hit':>10} {'shared us':>9}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = Path(directory) / "cache.db"
+        for nodes in NODES:
+            for shared in (False, True):
+                print(await simulate(nodes, shared, db_path))
+    print()
+    values = {
+        "verdict": "allow",
+        "topic": "Volvamos al debate sobre nuestro tema principal: la energia solar",
+        "history": [{"role": "agent", "message": "La energia solar es el futuro " * 10}]
+        * 5,
+    }
+    print(f"{'value':>8} {'json bytes':>11} {'encoded bytes':>14}")
+    for name, value in values.items():
+        json_size = len(pydantic_core.to_json(value))
+        print(f"{name:>8} {json_size:>11} {len(encode(value)):>14}")
+
+
+def main() -> None:
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
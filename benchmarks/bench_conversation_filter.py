@@ -0,0 +1,46 @@
+"""Measure the conversation filter: memory, false positives and lookup time.
+
+Every filter is filled up to its capacity with random ids and queried with
+other random ids, the share of them found is the false positive rate.
+
+Run with: python -m benchmarks.bench_conversation_filter
+"""
+
+import time
+import uuid
+
+from app.conversation_filter import BloomFilter
+
+CAPACITIES = [10_000, 100_000, 1_000_000]
+FALSE_POSITIVE_RATES = [0.01, 0.001]
+LOOKUPS = 100_000
+
+
+def main() -> None:
+    print(
+        f"{'capacity':>10} {'target':>7} {'hashes':>6} {'MiB':>6}"
+        f" {'measured':>9} {'add us':>7} {'lookup us':>10}"
+    )
+    for capacity in CAPACITIES:
+        for rate in FALSE_POSITIVE_RATES:
+            bloom = BloomFilter(capacity, rate)
+            ids = [uuid.uuid4() for _ in range(capacity)]
+            start = time.perf_counter()
+            for conversation_id in ids:
+                bloom.add(conversation_id)
+            add_time = (time.perf_counter() - start) / capacity
+            unknown = [uuid.uuid4() for _ in range(LOOKUPS)]
+            start = time.perf_counter()
+            false_positives = sum(
+                conversation_id in bloom for conversation_id in unknown
+            )
+            lookup_time = (time.perf_counter() - start) / LOOKUPS
+            print(
+                f"{capacity:>10} {rate:>7.3f} {bloom.hashes:>6}"
+                f" {bloom.size_bytes / 2**20:>6.2f} {false_positives / LOOKUPS:>9.4f}"
+                f" {add_time * 1e6:>7.2f} {lookup_time * 1e6:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
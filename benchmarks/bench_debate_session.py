@@ -0,0 +1,172 @@
+"""Compare the latency per turn of POST /api/chat/ and of a debate session.
+
+The app runs in process on a sqlite database with a stand in for the model
+that answers after a fixed latency, so the difference is what each path
+does around the model: the REST path reloads the history and parses the
+stored model messages on every turn, the session keeps them in memory.
+
+Run with: python -m benchmarks.bench_debate_session [--model-ms 0] [--turns 50]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import Any, AsyncIterator
+from unittest.mock import AsyncMock
+
+# Settings needed to import the app, the environment overrides them
+for name, value in {
+    "GOOGLE_API_KEY": "bench",
+    "PORT": "8000",
+    "HOST": "127.0.0.1",
+    "LOG_LEVEL": "WARNING",
+    "DB_HOST": "localhost",
+    "DB_PORT": "5432",
+    "DB_USER": "bench",
+    "DB_PASSWORD": "bench",
+    "DB_NAME": "bench",
+    "RATE_LIMIT_PER_MINUTE": "{}",
+}.items():
+    os.environ.setdefault(name, value)
+
+from fastapi.testclient import TestClient  # noqa: E402
+from pydantic_ai.messages import (  # noqa: E402
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    ModelResponse,
+    TextPart,
+    UserPromptPart,
+)
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine  # noqa: E402
+from sqlmodel import SQLModel  # noqa: E402
+
+from app.conversation_filter import ConversationFilter  # noqa: E402
+from app.depends import (  # noqa: E402
+    get_adapter,
+    get_conversation_filter,
+    get_proxy,
+    get_usage_tracker,
+)
+from app.main import app  # noqa: E402
+from app.messages_adapters import MessagesAdapters  # noqa: E402
+from app.proxy import Proxy  # noqa: E402
+from app.usage import UsageTracker  # noqa: E402
+
+OUTPUT = "La energia solar es cada vez mas barata y limpia. " * 20
+MESSAGE = "No estoy de acuerdo, dame otro argumento"
+
+
+class ModelStandIn:
+    """Answers after a fixed latency with the model messages of a real run."""
+
+    def __init__(self, latency_seconds: float):
+        self.latency_seconds = latency_seconds
+
+    def _result(self, message: str) -> SimpleNamespace:
+        new_messages = [
+            ModelRequest(parts=[UserPromptPart(content=message)]),
+            ModelResponse(parts=[TextPart(content=OUTPUT)]),
+        ]
+
+        async def stream_text(delta: bool) -> AsyncIterator[str]:
+            for chunk in OUTPUT.split(". "):
+                yield chunk + ". "
+
+        return SimpleNamespace(
+            output=OUTPUT,
+            new_messages=lambda: new_messages,
+            new_messages_json=lambda: ModelMessagesTypeAdapter.dump_json(new_messages),
+            usage=lambda: SimpleNamespace(input_tokens=100, output_tokens=100),
+            stream_text=stream_text,
+        )
+
+    async def run(self, message: str, message_history: list) -> SimpleNamespace:
+        await asyncio.sleep(self.latency_seconds)
+        return self._result(message)
+
+    @asynccontextmanager
+    async def run_stream(
+        self, message: str, message_history: list
+    ) -> AsyncIterator[SimpleNamespace]:
+        await asyncio.sleep(self.latency_seconds)
+        yield self._result(message)
+
+
+def build_client(db_path: str, latency_seconds: float) -> TestClient:
+    engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+
+    async def create_tables() -> None:
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+
+    asyncio.run(create_tables())
+    model = ModelStandIn(latency_seconds)
+    proxy_agent = AsyncMock()
+    proxy_agent.run.return_value.output = "allow"
+    usage = UsageTracker()
+    conversations = ConversationFilter()
+    app.dependency_overrides[get_adapter] = lambda: MessagesAdapters(
+        AsyncSession(engine, expire_on_commit=False), model  # type: ignore[arg-type]
+    )
+    app.dependency_overrides[get_proxy] = lambda: Proxy(proxy_agent)
+    app.dependency_overrides[get_usage_tracker] = lambda: usage
+    app.dependency_overrides[get_conversation_filter] = lambda: conversations
+    return TestClient(app)
+
+
+def rest_turns(client: TestClient, turns: int) -> list[float]:
+    response = client.post("/api/chat/", json={"message": MESSAGE})
+    conversation_id = response.json()["conversation_id"]
+    timings = []
+    for _ in range(turns):
+        start = time.perf_counter()
+        response = client.post(
+            "/api/chat/", json={"message": MESSAGE, "conversation_id": conversation_id}
+        )
+        response.raise_for_status()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def session_turns(client: TestClient, turns: int) -> list[float]:
+    timings = []
+    with client.websocket_connect("/api/chat/ws") as websocket:
+        websocket.receive_json()
+        for _ in range(turns + 1):
+            start = time.perf_counter()
+            websocket.send_json({"type": "message", "message": MESSAGE})
+            frame: dict[str, Any] = {}
+            while frame.get("type") not in ("message", "error"):
+                frame = websocket.receive_json()
+            timings.append(time.perf_counter() - start)
+    # The first turn creates the conversation, like the first REST request
+    return timings[1:]
+
+
+def report(name: str, timings: list[float]) -> None:
+    quantiles = statistics.quantiles(timings, n=20)
+    print(
+        f"{name:<10} {statistics.median(timings) * 1000:>8.2f}"
+        f" {quantiles[18] * 1000:>8.2f}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-ms", type=float, default=0.0)
+    parser.add_argument("--turns", type=int, default=50)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        client = build_client(f"{directory}/bench.sqlite", args.model_ms / 1000)
+        print(f"{'path':<10} {'p50 ms':>8} {'p95 ms':>8}")
+        report("rest", rest_turns(client, args.turns))
+        report("websocket", session_turns(client, args.turns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Measure the overhead of the rate limiter per request.
+
+Run with: python -m benchmarks.bench_ratelimit
+"""
+
+import asyncio
+import time
+
+from app.metrics import Metrics
+from app.ratelimit import InMemoryRateLimitBackend, RateLimit, RateLimitMiddleware
+
+ITERATIONS = 200_000
+CLIENTS = [1, 1_000, 100_000]
+
+
+async def noop_app(scope: dict, receive: object, send: object) -> None:
+    return None
+
+
+async def bench(middleware: RateLimitMiddleware, clients: int) -> float:
+    scopes = [
+        {
+            "type": "http",
+            "path": "/api/chat/",
+            "headers": [],
+            "client": (f"10.0.{i // 256 % 256}.{i % 256}-{i}", 1234),
+        }
+        for i in range(clients)
+    ]
+    start = time.perf_counter()
+    for i in range(ITERATIONS):
+        await middleware(scopes[i % clients], None, None)  # type: ignore
+    return (time.perf_counter() - start) / ITERATIONS * 1e6
+
+
+async def main() -> None:
+    print(f"{'clients':>8} {'app only (us)':>14} {'limited (us)':>13}")
+    for clients in CLIENTS:
+        limits = {"/api/chat/": RateLimit(ITERATIONS, 1000.0)}
+        unlimited = RateLimitMiddleware(noop_app, {}, registry=Metrics())
+        limited = RateLimitMiddleware(
+            noop_app, limits, get_backend=InMemoryRateLimitBackend, registry=Metrics()
+        )
+        baseline = await bench(unlimited, clients)
+        overhead = await bench(limited, clients)
+        print(f"{clients:>8} {baseline:>14.2f} {overhead:>13.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
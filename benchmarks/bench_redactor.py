@@ -0,0 +1,40 @@
+"""Benchmark the PII redactor on large messages.
+
+Run with: python -m benchmarks.bench_redactor
+"""
+
+import time
+
+from app.redactor import PIIRedactor
+
+SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+SAMPLE = (
+    "Hablemos del debate, mi correo es test@example.com y mi tarjeta "
+    "4111 1111 1111 1111, llamame al 5512345678 desde la IP 192.168.1.1. "
+)
+# Worst case for the email pattern: a very long word without separators
+ADVERSARIAL = "a"
+
+
+def bench(redactor: PIIRedactor, text: str) -> float:
+    start = time.perf_counter()
+    redactor.redact(text)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    redactor = PIIRedactor()
+    print(f"{'size':>12} {'sample (s)':>12} {'MB/s':>8} {'adversarial (s)':>16}")
+    for size in SIZES:
+        sample = (SAMPLE * (size // len(SAMPLE) + 1))[:size]
+        adversarial = ADVERSARIAL * size
+        sample_time = bench(redactor, sample)
+        adversarial_time = bench(redactor, adversarial)
+        print(
+            f"{size:>12} {sample_time:>12.4f} {size / sample_time / 1e6:>8.1f}"
+            f" {adversarial_time:>16.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Fuzz the policy patterns and report the worst scan time per input size.
+
+Every pattern of the regex stage is searched on random inputs built from the
+fragments the patterns look for, plus hand written worst cases. The worst
+time per KB stays flat when the scan time grows linearly with the size.
+Runs with re and, when google-re2 is installed, with RE2.
+
+Run with: python -m benchmarks.bench_regex
+"""
+
+import random
+import re
+import time
+from typing import Callable
+
+from app.policies import (
+    ABUSE_PATTERNS,
+    CODE_INJECTION_PATTERNS,
+    PROMPT_INJECTION_PATTERNS,
+    WARN_PATTERNS,
+)
+from app.redactor import PII_PATTERN
+
+try:
+    import re2  # type: ignore
+except ImportError:
+    re2 = None
+
+SIZES = [10_000, 100_000, 1_000_000]
+SAMPLES = 20
+PATTERNS = (
+    PROMPT_INJECTION_PATTERNS
+    + ABUSE_PATTERNS
+    + CODE_INJECTION_PATTERNS
+    + WARN_PATTERNS
+    + [PII_PATTERN.pattern]
+)
+FRAGMENTS = [
+    "update",
+    "set",
+    "select",
+    "from",
+    "ignore",
+    "all",
+    "previous",
+    "kill",
+    " ",
+    "  ",
+    "\t",
+    "\n",
+    "a",
+    "x1",
+    "@",
+    ".",
+    "-",
+    "_",
+    "%",
+    "1",
+    "12",
+    "123",
+    "(",
+    "*",
+    ";",
+    "--",
+    "/*",
+    "é",
+    "ñ",
+]
+WORST_CASES: dict[str, Callable[[int], str]] = {
+    "whitespace_after_keyword": lambda size: "update " + " " * size,
+    "long_word_after_keyword": lambda size: "update " + "a" * size,
+    "email_without_domain": lambda size: ("a" * 60 + "@") * (size // 61),
+    "email_long_domain": lambda size: "a@" + "b." * (size // 2),
+    "digits_with_separators": lambda size: "1 " * (size // 2),
+}
+
+
+def fuzz_inputs(size: int, rng: random.Random) -> list[str]:
+    inputs = [build(size)[:size] for build in WORST_CASES.values()]
+    for _ in range(SAMPLES):
+        fragments: list[str] = []
+        length = 0
+        while length < size:
+            fragment = rng.choice(FRAGMENTS)
+            fragments.append(fragment)
+            length += len(fragment)
+        inputs.append("".join(fragments)[:size])
+    return inputs
+
+
+def worst_scan(patterns: list, inputs: list[str]) -> float:
+    worst = 0.0
+    for content in inputs:
+        start = time.perf_counter()
+        for pattern in patterns:
+            pattern.search(content)
+        worst = max(worst, time.perf_counter() - start)
+    return worst
+
+
+def main() -> None:
+    engines: dict[str, Callable[[str], object]] = {"re": re.compile}
+    if re2 is not None:
+        engines["re2"] = re2.compile
+    rng = random.Random(42)
+    inputs_by_size = {size: fuzz_inputs(size, rng) for size in SIZES}
+    print(f"{'engine':>6} {'size':>10} {'worst (ms)':>11} {'us per KB':>10}")
+    for name, compile_pattern in engines.items():
+        patterns = [compile_pattern(pattern) for pattern in PATTERNS]
+        for size, inputs in inputs_by_size.items():
+            worst = worst_scan(patterns, inputs)
+            print(
+                f"{name:>6} {size:>10} {worst * 1000:>11.2f}"
+                f" {worst * 1e6 / (size / 1000):>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
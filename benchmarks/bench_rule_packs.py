@@ -0,0 +1,72 @@
+"""Measure how many model calls the rule packs save on the attack dataset.
+
+Every prompt of dataset_security_api.csv is evaluated by the regex stage
+with only the builtin English rules and with the rule packs of app/rules.
+The prompts without a rule match fall through to the proxy agent. Benign
+debate messages are evaluated too, to watch for false positives.
+
+Run with: python -m benchmarks.bench_rule_packs
+"""
+
+import csv
+import tempfile
+import time
+from pathlib import Path
+from unittest.mock import Mock
+
+from app.metrics import Metrics
+from app.proxy import Proxy
+from app.rule_packs import DEFAULT_RULE_PACKS_DIR, RuleEngine
+
+DATASET = Path(__file__).parent.parent / "dataset_security_api.csv"
+BENIGN_MESSAGES = [
+    "Quiero debatir sobre la energia nuclear, tu defiendes que es segura.",
+    "No estoy de acuerdo, las renovables son mas baratas a largo plazo.",
+    "¿Qué opinas de la educación pública frente a la privada?",
+    "Dame un ejemplo de un país que haya reducido sus emisiones.",
+    "Creo que el teletrabajo mejora la productividad de las empresas.",
+    "Hablemos de la inteligencia artificial en la medicina.",
+    "Tus argumentos no me convencen, dame datos y estadisticas.",
+    "¿Cuál es la mejor manera de combatir la desinformación?",
+    "Let's debate whether social media does more harm than good.",
+    "El transporte público debería ser gratuito en las ciudades.",
+]
+
+
+def evaluate(proxy: Proxy, messages: list[str]) -> tuple[list[str], float]:
+    start = time.perf_counter()
+    verdicts = [proxy.evaluate_rules(message) for message in messages]
+    elapsed = (time.perf_counter() - start) / len(messages)
+    return [verdict.rule or "" for verdict in verdicts], elapsed
+
+
+def main() -> None:
+    with DATASET.open(encoding="utf-8") as dataset:
+        attacks = [row["prompt"] for row in csv.DictReader(dataset)]
+    with tempfile.TemporaryDirectory() as empty_dir:
+        engines = {
+            "builtin": RuleEngine(Path(empty_dir), registry=Metrics()),
+            "packs": RuleEngine(DEFAULT_RULE_PACKS_DIR, registry=Metrics()),
+        }
+        print(
+            f"{'rules':>8} {'attacks to model':>17} {'benign denied':>14} {'us/msg':>7}"
+        )
+        for name, engine in engines.items():
+            proxy = Proxy(agent=Mock(), rules=engine)
+            attack_rules, elapsed = evaluate(proxy, attacks)
+            benign_rules, _ = evaluate(proxy, BENIGN_MESSAGES)
+            fallthrough = sum(not rule for rule in attack_rules)
+            false_positives = [rule for rule in benign_rules if rule]
+            print(
+                f"{name:>8} {fallthrough:>10}/{len(attacks):<6}"
+                f" {len(false_positives):>14} {elapsed * 1e6:>7.1f}"
+            )
+            for rule in false_positives:
+                print(f"{'':>8} false positive: {rule}")
+            for language, stats in engine._stats.items():
+                rate = stats.fallthrough / (stats.matched + stats.fallthrough)
+                print(f"{'':>8} pack {language}: fallthrough rate {rate:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Measure the CPU time to serialize a chat response.
+
+Compares the validation of ResponseModel plus the response_model round trip
+of FastAPI against the plain payload serialized by FastJSONResponse.
+
+Run with: python -m benchmarks.bench_serialization
+"""
+
+import time
+import uuid
+from typing import Any, Callable
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+from app.entities import Messages
+from app.messages_adapters import MessagesAdapters
+from app.models import MessageModel, ResponseModel
+from app.responses import FastJSONResponse
+
+ITERATIONS = 5000
+HISTORY_LIMITS = [5, 50, 500]
+RESPONSE_ADAPTER = TypeAdapter(ResponseModel)
+
+
+def bench(serialize: Callable[[], Any]) -> float:
+    start = time.process_time()
+    for _ in range(ITERATIONS):
+        serialize()
+    return (time.process_time() - start) / ITERATIONS * 1e6
+
+
+def main() -> None:
+    adapter = MessagesAdapters(None, None)  # type: ignore
+    conversation_id = uuid.uuid4()
+    message = MessageModel(message="Dame un argumento a favor de la energia solar")
+    agent_response = "La energia solar es cada vez mas barata. " * 20
+    print(f"{'history':>8} {'before (us)':>12} {'after (us)':>12}")
+    for history_limit in HISTORY_LIMITS:
+        history = [
+            Messages(role="agent", content=agent_response) for _ in range(history_limit)
+        ]
+
+        def before() -> bytes:
+            # What FastAPI does with a ResponseModel and response_model
+            model = adapter.convert_agent_model_to_response(
+                conversation_id, message, agent_response, history, history_limit
+            )
+            validated = RESPONSE_ADAPTER.validate_python(model)
+            content = RESPONSE_ADAPTER.dump_python(validated, mode="json")
+            return JSONResponse(jsonable_encoder(content)).body
+
+        def after() -> bytes:
+            payload = adapter.build_response_payload(
+                conversation_id, message, agent_response, history, history_limit
+            )
+            return FastJSONResponse(payload).body
+
+        assert (
+            before()
+            == JSONResponse(
+                jsonable_encoder(TypeAdapter(Any).validate_json(after()))
+            ).body
+        )
+        print(f"{history_limit:>8} {bench(before):>12.1f} {bench(after):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
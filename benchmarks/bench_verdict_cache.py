@@ -0,0 +1,88 @@
+"""Precision and recall of the near-duplicate verdict cache.
+
+The first half of the prompts of dataset_security_api.csv are cached as
+denied. Variants of them (whitespace, punctuation, case and a few words
+changed) must reuse the verdict, variants of the other half and benign
+debate messages must not.
+
+Run with: python -m benchmarks.bench_verdict_cache
+"""
+
+import csv
+import random
+import time
+from pathlib import Path
+
+from app.metrics import Metrics
+from app.verdict_cache import NearDuplicateCache
+
+DATASET = Path(__file__).parent.parent / "dataset_security_api.csv"
+THRESHOLDS = [0.5, 0.6, 0.7, 0.8, 0.9]
+VARIANTS_PER_PROMPT = 20
+FILLER_ENTRIES = 10_000
+FILLER_WORDS = ["tema", "debate", "energia", "ciudad", "datos", "modelo", "agua"]
+BENIGN_MESSAGES = [
+    "Quiero debatir sobre la energia nuclear, tu defiendes que es segura.",
+    "No estoy de acuerdo, las renovables son mas baratas a largo plazo.",
+    "¿Qué opinas de la educación pública frente a la privada?",
+    "Dame un ejemplo de un país que haya reducido sus emisiones.",
+    "Creo que el teletrabajo mejora la productividad de las empresas.",
+    "Hablemos de la inteligencia artificial en la medicina.",
+    "Tus argumentos no me convencen, dame datos y estadisticas.",
+    "¿Cuál es la mejor manera de combatir la desinformación?",
+    "Let's debate whether social media does more harm than good.",
+    "El transporte público debería ser gratuito en las ciudades.",
+]
+
+
+def variant(prompt: str, generator: random.Random) -> str:
+    """Vary the spacing, punctuation and case and change up to two words."""
+    words = prompt.split()
+    for _ in range(generator.randint(0, 2)):
+        position = generator.randrange(len(words))
+        words[position] = generator.choice(["por favor", "ahora", "tambien", ""])
+    separators = [" ", "  ", " \n", " ... "]
+    text = "".join(word + generator.choice(separators) for word in words)
+    return text.upper() if generator.random() < 0.2 else text + "!!"
+
+
+def main() -> None:
+    with DATASET.open(encoding="utf-8") as dataset:
+        prompts = [row["prompt"] for row in csv.DictReader(dataset)]
+    generator = random.Random(42)
+    cached, unseen = prompts[: len(prompts) // 2], prompts[len(prompts) // 2 :]
+    positives = [
+        variant(p, generator) for p in cached for _ in range(VARIANTS_PER_PROMPT)
+    ]
+    negatives = [
+        variant(p, generator) for p in unseen for _ in range(VARIANTS_PER_PROMPT)
+    ] + BENIGN_MESSAGES
+
+    print(f"{'threshold':>9} {'precision':>10} {'recall':>7} {'benign hits':>12}")
+    for threshold in THRESHOLDS:
+        cache = NearDuplicateCache(len(prompts), threshold, registry=Metrics())
+        for prompt in cached:
+            cache.put(prompt, "deny")
+        true_positives = sum(cache.get(message) is not None for message in positives)
+        false_positives = sum(cache.get(message) is not None for message in negatives)
+        benign_hits = sum(cache.get(message) is not None for message in BENIGN_MESSAGES)
+        hits = true_positives + false_positives
+        precision = true_positives / hits if hits else 1.0
+        print(
+            f"{threshold:>9} {precision:>10.2%} {true_positives / len(positives):>7.2%}"
+            f" {benign_hits:>12}"
+        )
+
+    cache = NearDuplicateCache(FILLER_ENTRIES, 0.7, registry=Metrics())
+    for _ in range(FILLER_ENTRIES):
+        filler = " ".join(generator.choices(FILLER_WORDS, k=12))
+        cache.put(f"{filler} {generator.random()}", "deny")
+    start = time.perf_counter()
+    for message in positives:
+        cache.get(message)
+    elapsed = (time.perf_counter() - start) / len(positives)
+    print(f"lookup with {len(cache)} entries: {elapsed * 1e6:.1f} us/msg")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 import os
 import uuid
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Awaitable
+from typing import Any, AsyncIterator, Awaitable
 from unittest.mock import AsyncMock, MagicMock, Mock
 
 import pytest
@@ -24,11 +25,23 @@ os.environ["DB_PASSWORD"] = "test"
 os.environ["DB_NAME"] = "test"
 
 
-from app.depends import get_adapter, get_proxy
+from app.conversation_filter import ConversationFilter
+from app.depends import (
+    get_adapter,
+    get_conversation_filter,
+    get_engine,
+    get_idempotency_store,
+    get_job_runner,
+    get_proxy,
+    get_usage_tracker,
+)
 from app.entities import Conversations, Messages
+from app.idempotency import IdempotencyStore
+from app.jobs import JobRunner
 from app.main import app
 from app.messages_adapters import MessagesAdapters
 from app.models import MessageModel
+from app.usage import UsageTracker
 
 
 @pytest_asyncio.fixture(name="async_engine")
@@ -48,25 +61,48 @@ async def messages_adapters(async_engine: AsyncSession) -> MessagesAdapters:
     main_agent = AsyncMock()
     main_agent.run.return_value = Mock()
     main_agent.run.return_value.output = "Mock main agent response"
+    main_agent.run.return_value.usage.return_value = Mock(
+        input_tokens=10, output_tokens=5
+    )
     # Use the correct format that matches sample_model_response
     main_agent.run.return_value.new_messages_json.return_value = b'[{"parts":[{"content":"Mock main agent response","timestamp":"2025-09-03T01:43:49.759895Z","part_kind":"text"}],"usage":{"input_tokens":10,"output_tokens":5},"model_name":"test-model","timestamp":"2025-09-03T01:43:50.635280Z","kind":"response","provider_name":"test-provider","provider_details":{"finish_reason":"STOP"},"provider_response_id":"test-id"}]'
     return MessagesAdapters(async_engine, main_agent)
 
 
+@pytest.fixture
+def proxy_agent() -> AsyncMock:
+    """Proxy agent allowing every message, with the usage of a real run"""
+    proxy_agent = AsyncMock()
+    proxy_agent.run.return_value = Mock(output="allow")
+    proxy_agent.run.return_value.usage.return_value = Mock(
+        input_tokens=4, output_tokens=1
+    )
+    return proxy_agent
+
+
 @pytest_asyncio.fixture(name="client_fixture")
-async def client_fixture(messages_adapters: MessagesAdapters) -> TestClient:
+async def client_fixture(
+    messages_adapters: MessagesAdapters, proxy_agent: AsyncMock
+) -> TestClient:
     def get_adapter_override() -> MessagesAdapters:
         return messages_adapters
 
     def get_proxy_override() -> Proxy:
-        proxy_agent = AsyncMock()
-        proxy_agent.run.return_value = AsyncMock()
-        proxy_agent.run.return_value.output = "allow"
         proxy_overrided = Proxy(proxy_agent)
         return proxy_overrided
 
     app.dependency_overrides[get_adapter] = get_adapter_override
     app.dependency_overrides[get_proxy] = get_proxy_override
+    app.dependency_overrides[get_engine] = lambda: messages_adapters.async_session.bind
+    idempotency_store = IdempotencyStore(max_entries=100, ttl_seconds=60)
+    app.dependency_overrides[get_idempotency_store] = lambda: idempotency_store
+    usage_tracker = UsageTracker()
+    app.dependency_overrides[get_usage_tracker] = lambda: usage_tracker
+    conversation_filter = ConversationFilter(capacity=1000)
+    app.dependency_overrides[get_conversation_filter] = lambda: conversation_filter
+    # Not started, the jobs stay queued
+    job_runner = JobRunner()
+    app.dependency_overrides[get_job_runner] = lambda: job_runner
     client = TestClient(app)
     yield client
     app.dependency_overrides.clear()
@@ -145,3 +181,34 @@ def mock_proxy_interface() -> AsyncMock:
 def sample_model_response() -> str:
     """Create a sample model response for testing"""
     return '[{"parts":[{"content":"un chiste nuevo","timestamp":"2025-09-03T01:43:49.759895Z","part_kind":"user-prompt"}],"instructions":null,"kind":"request"},{"parts":[{"content":"¡Claro que sí, Pancho! Aquí va otro chiste fresco para ti:\\n\\n¿Qué le dice un jardinero a otro?\\n\\n\\"¿Te has dado cuenta de que ya ha habido **Pancho**s árboles que hemos plantado?\\"\\n\\n¡Espero que te guste, Pancho!","part_kind":"text"}],"usage":{"input_tokens":171,"cache_write_tokens":0,"cache_read_tokens":0,"output_tokens":63,"input_audio_tokens":0,"cache_audio_read_tokens":0,"output_audio_tokens":0,"details":{"text_prompt_tokens":171}},"model_name":"gemini-2.5-flash-lite","timestamp":"2025-09-03T01:43:50.635280Z","kind":"response","provider_name":"google-gla","provider_details":{"finish_reason":"STOP"},"provider_response_id":"Vp23aMHrJMGtz7IPp_vayQo"}]'
+
+
+class StreamingAgent:
+    """Agent double that streams its output in chunks."""
+
+    def __init__(self, chunks: list[str]):
+        self.chunks = chunks
+        self.histories: list[list[Any]] = []
+
+    @asynccontextmanager
+    async def run_stream(
+        self, message: str, message_history: list[Any]
+    ) -> AsyncIterator[Mock]:
+        self.histories.append(list(message_history))
+
+        async def stream_text(delta: bool) -> AsyncIterator[str]:
+            for chunk in self.chunks:
+                yield chunk
+
+        result = Mock()
+        result.stream_text = stream_text
+        result.new_messages.return_value = [f"request: {message}", "response"]
+        result.new_messages_json.return_value = b"[]"
+        result.usage.return_value = Mock(input_tokens=10, output_tokens=5)
+        yield result
+
+
+@pytest.fixture
+def streaming_agent() -> type[StreamingAgent]:
+    """Agent class whose run_stream yields the chunks it is created with"""
+    return StreamingAgent
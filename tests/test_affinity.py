@@ -0,0 +1,213 @@
+import json
+import uuid
+from typing import AsyncIterator
+
+import httpx
+import pytest
+
+from app.affinity import (
+    AffinityDispatcher,
+    Worker,
+    WorkerPool,
+    conversation_key,
+    rendezvous_owner,
+)
+from app.jobs import new_job_id
+from app.metrics import Metrics
+
+
+def streamed_json(status_code: int, content: dict) -> httpx.Response:
+    # Not read yet like the responses of a real worker, which the dispatcher
+    # streams to the client
+    return httpx.Response(
+        status_code,
+        headers={"content-type": "application/json"},
+        stream=httpx.ByteStream(json.dumps(content).encode()),
+    )
+
+
+def fake_worker(name: str) -> Worker:
+    """Worker answering with its name and the X-Forwarded-For it got, and a
+    job id with its index for the queued jobs."""
+    index = int(name.rsplit("-", 1)[1])
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.method == "POST" and request.url.path == "/api/chat/jobs":
+            return streamed_json(202, {"job_id": str(new_job_id(index))})
+        return streamed_json(
+            200,
+            {
+                "worker": name,
+                "forwarded_for": request.headers.get_list("x-forwarded-for"),
+            },
+        )
+
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(handler), base_url="http://worker"
+    )
+    return Worker(name=name, socket_path="", client=client, alive=True)
+
+
+def dispatcher_client(
+    workers: list[Worker], registry: Metrics, max_body_bytes: int = 1024
+) -> httpx.AsyncClient:
+    dispatcher = AffinityDispatcher(
+        WorkerPool(workers, registry=registry),
+        max_body_bytes=max_body_bytes,
+        registry=registry,
+    )
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=dispatcher), base_url="http://test"
+    )
+
+
+class TestRendezvousOwner:
+    """Test the rendezvous_owner function implementation"""
+
+    def test_only_keys_of_stopped_worker_move(self) -> None:
+        """Test a stopped worker moves its keys only, and they come back"""
+        # Arrange
+        workers = [f"worker-{index}" for index in range(8)]
+        keys = [str(uuid.uuid4()) for _ in range(2000)]
+        owners = {key: rendezvous_owner(key, workers) for key in keys}
+
+        # Act
+        without = {key: rendezvous_owner(key, workers[1:]) for key in keys}
+        back = {key: rendezvous_owner(key, workers) for key in keys}
+
+        # Assert
+        moved = [key for key in keys if owners[key] != without[key]]
+        assert all(owners[key] == "worker-0" for key in moved)
+        assert 150 < len(moved) < 350
+        assert back == owners
+        assert rendezvous_owner(keys[0], []) is None
+
+
+class TestConversationKey:
+    """Test the conversation_key function implementation"""
+
+    def test_conversation_in_path_query_or_body(self) -> None:
+        """Test the conversation id is taken from where each route has it"""
+        # Arrange
+        conversation_id = str(uuid.uuid4())
+        body = json.dumps({"message": "Hola", "conversation_id": conversation_id})
+
+        # Act
+        from_path = conversation_key(
+            {"path": f"/api/conversations/{conversation_id}/messages"}, b""
+        )
+        from_query = conversation_key(
+            {
+                "path": "/api/chat/ws",
+                "query_string": f"conversation_id={conversation_id}".encode(),
+            },
+            b"",
+        )
+        from_body = conversation_key({"path": "/api/chat/"}, body.encode())
+        first_turn = conversation_key({"path": "/api/chat/"}, b'{"message": "Hola"}')
+        invalid = conversation_key({"path": "/api/chat/"}, b"{not json")
+        other_route = conversation_key({"path": "/api/moderate/batch"}, body.encode())
+
+        # Assert
+        assert from_path == from_query == from_body == conversation_id
+        assert first_turn is None
+        assert invalid is None
+        assert other_route is None
+
+
+class TestAffinityDispatcher:
+    """Test the AffinityDispatcher class implementation"""
+
+    @pytest.mark.asyncio
+    async def test_conversation_sticks_to_worker(self) -> None:
+        """Test the turns of a conversation reach the same worker, with the
+        X-Forwarded-For of the dispatcher only"""
+        # Arrange
+        registry = Metrics()
+        workers = [fake_worker(f"worker-{index}") for index in range(4)]
+        conversation_id = str(uuid.uuid4())
+        body = {"message": "Sigamos", "conversation_id": conversation_id}
+
+        # Act
+        async with dispatcher_client(workers, registry) as client:
+            served = {
+                (await client.post("/api/chat/", json=body)).json()["worker"]
+                for _ in range(10)
+            }
+            spoofed = await client.post(
+                "/api/chat/", json=body, headers={"X-Forwarded-For": "203.0.113.7"}
+            )
+            first_turns = {
+                (await client.post("/api/chat/", json={"message": "Hola"})).json()[
+                    "worker"
+                ]
+                for _ in range(4)
+            }
+
+        # Assert
+        assert len(served) == 1
+        assert len(first_turns) == 4
+        assert spoofed.json()["forwarded_for"] == ["127.0.0.1"]
+        counters = registry.snapshot()["counters"]
+        assert counters["affinity.routed"] == 11
+        assert counters["affinity.unrouted"] == 4
+        assert "affinity.hops" not in counters
+
+    @pytest.mark.asyncio
+    async def test_rebalance_counts_hops_and_keeps_jobs(self) -> None:
+        """Test a stopped worker moves its conversations, counted as hops,
+        and the jobs are sent to the worker that queued them, even by a
+        restarted dispatcher"""
+        # Arrange
+        registry = Metrics()
+        workers = [fake_worker(f"worker-{index}") for index in range(2)]
+        conversation_id = str(uuid.uuid4())
+        body = {"message": "Sigamos", "conversation_id": conversation_id}
+
+        async with dispatcher_client(workers, registry) as client:
+            owner = (await client.post("/api/chat/", json=body)).json()["worker"]
+            job = (await client.post("/api/chat/jobs", json=body)).json()
+
+            # Act
+            by_name = {worker.name: worker for worker in workers}
+            other = next(name for name in by_name if name != owner)
+            by_name[other].alive = False
+            async with dispatcher_client(workers, Metrics()) as restarted:
+                job_worker = await restarted.get(f"/api/chat/jobs/{job['job_id']}")
+            by_name[other].alive = True
+            by_name[owner].alive = False
+            moved = (await client.post("/api/chat/", json=body)).json()["worker"]
+            for worker in workers:
+                worker.alive = False
+            unavailable = await client.post("/api/chat/", json=body)
+
+        # Assert
+        assert job_worker.json()["worker"] == owner
+        assert moved == other
+        assert registry.snapshot()["counters"]["affinity.hops"] == 1
+        assert unavailable.status_code == 503
+
+    @pytest.mark.asyncio
+    async def test_body_over_limit_rejected(self) -> None:
+        """Test a body bigger than the limit is answered with a 413 by the
+        dispatcher, whether it is declared or streamed"""
+        # Arrange
+        registry = Metrics()
+        workers = [fake_worker("worker-0")]
+
+        async def chunks() -> AsyncIterator[bytes]:
+            for _ in range(8):
+                yield b"x" * 64
+
+        # Act
+        async with dispatcher_client(workers, registry, max_body_bytes=256) as client:
+            declared = await client.post("/api/chat/", content=b"x" * 257)
+            streamed = await client.post("/api/chat/", content=chunks())
+            within = await client.post("/api/chat/", json={"message": "Hola"})
+
+        # Assert
+        assert declared.status_code == streamed.status_code == 413
+        assert within.json()["worker"] == "worker-0"
+        counters = registry.snapshot()["counters"]
+        assert counters["affinity.too_large"] == 2
+        assert counters["affinity.requests.worker-0"] == 1
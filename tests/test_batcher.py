@@ -0,0 +1,78 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+
+from app.batcher import ClassificationBatcher
+from app.metrics import Metrics
+
+
+class TestClassificationBatcher:
+    """Test the ClassificationBatcher class implementation"""
+
+    @pytest.fixture
+    def registry(self) -> Metrics:
+        """Create an isolated metrics registry"""
+        return Metrics()
+
+    @pytest.mark.asyncio
+    async def test_classify_groups_concurrent_calls(self, registry: Metrics) -> None:
+        """Test concurrent classifications are sent in a single batch"""
+        # Arrange
+        classify_batch = AsyncMock(return_value=["allow", "deny", "warn"])
+        batcher = ClassificationBatcher(
+            classify_batch,
+            window_seconds=0.01,
+            max_items=10,
+            instruction_tokens=100,
+            registry=registry,
+        )
+
+        # Act
+        results = await asyncio.gather(
+            batcher.classify("uno"), batcher.classify("dos"), batcher.classify("tres")
+        )
+
+        # Assert
+        assert results == ["allow", "deny", "warn"]
+        classify_batch.assert_called_once_with(["uno", "dos", "tres"])
+        snapshot = registry.snapshot()
+        assert snapshot["summaries"]["proxy.batch.size"]["max"] == 3
+        assert snapshot["counters"]["proxy.batch.tokens_saved"] == 200
+
+    @pytest.mark.asyncio
+    async def test_classify_flushes_on_max_items(self, registry: Metrics) -> None:
+        """Test a batch is sent as soon as max_items are pending"""
+        # Arrange
+        classify_batch = AsyncMock(
+            side_effect=lambda contents: ["allow"] * len(contents)
+        )
+        batcher = ClassificationBatcher(
+            classify_batch, window_seconds=10, max_items=2, registry=registry
+        )
+
+        # Act
+        results = await asyncio.wait_for(
+            asyncio.gather(batcher.classify("uno"), batcher.classify("dos")), 1
+        )
+
+        # Assert
+        assert results == ["allow", "allow"]
+        classify_batch.assert_called_once_with(["uno", "dos"])
+
+    @pytest.mark.asyncio
+    async def test_classify_propagates_errors(self, registry: Metrics) -> None:
+        """Test every waiting caller receives the error of the batch"""
+        # Arrange
+        classify_batch = AsyncMock(side_effect=RuntimeError("Model failed"))
+        batcher = ClassificationBatcher(
+            classify_batch, window_seconds=0.01, max_items=10, registry=registry
+        )
+
+        # Act
+        results = await asyncio.gather(
+            batcher.classify("uno"), batcher.classify("dos"), return_exceptions=True
+        )
+
+        # Assert
+        assert all(isinstance(result, RuntimeError) for result in results)
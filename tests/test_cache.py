@@ -0,0 +1,186 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel
+
+from app.cache import (
+    DatabaseCacheBackend,
+    InMemoryCacheBackend,
+    TieredCache,
+    decode,
+    encode,
+)
+from app.entities import CacheEntries  # noqa: F401 registers the table
+from app.metrics import Metrics
+
+
+class TestEncoding:
+    """Test the encode and decode functions implementation"""
+
+    def test_round_trip_compresses_large_values(self) -> None:
+        """Test the values are decoded back and the large ones compressed"""
+        # Arrange
+        small = "allow"
+        large = {"topic": "energia solar " * 100, "turns": list(range(10))}
+
+        # Act
+        small_data = encode(small)
+        large_data = encode(large)
+
+        # Assert
+        assert small_data == b'j"allow"'
+        assert large_data[:1] == b"z"
+        assert len(large_data) < len("energia solar " * 100)
+        assert decode(small_data) == small
+        assert decode(large_data) == large
+
+
+class TestInMemoryCacheBackend:
+    """Test the InMemoryCacheBackend class implementation"""
+
+    @pytest.mark.asyncio
+    async def test_evicts_least_recent_and_expired(self) -> None:
+        """Test the least recently used key is evicted and expired ones miss"""
+        # Arrange
+        backend = InMemoryCacheBackend(max_entries=2)
+        expiring = InMemoryCacheBackend()
+        await backend.set("a", 1, 60)
+        await backend.set("b", 2, 60)
+
+        # Act
+        await backend.get("a")
+        await backend.set("c", 3, 60)
+        await expiring.set("a", 1, 0)
+
+        # Assert
+        assert await backend.get("a") == 1
+        assert await backend.get("b") is None
+        assert await expiring.get("a") is None
+        assert await backend.add("a", 4, 60) is False
+        assert await backend.add("b", 4, 60) is True
+
+
+class TestDatabaseCacheBackend:
+    """Test the DatabaseCacheBackend class implementation"""
+
+    @pytest.mark.asyncio
+    async def test_entries_shared_and_added_once(
+        self, async_engine: AsyncSession
+    ) -> None:
+        """Test two backends on the same database share the entries, and only
+        one adds a key until it expires"""
+        # Arrange
+        first_node = DatabaseCacheBackend(async_engine.bind)
+        second_node = DatabaseCacheBackend(async_engine.bind)
+
+        # Act
+        await first_node.set("verdicts:a", b'j"deny"', 60)
+        shared = await second_node.get("verdicts:a")
+        first_add = await first_node.add("lock", b"1", 60)
+        second_add = await second_node.add("lock", b"1", 60)
+        await first_node.set("expired", b"1", -1)
+        expired_add = await second_node.add("expired", b"2", 60)
+        await first_node.set("old", b"1", -1)
+        purged = await second_node.purge_expired()
+
+        # Assert
+        assert shared == b'j"deny"'
+        assert (first_add, second_add, expired_add) == (True, False, True)
+        assert await first_node.get("expired") == b"2"
+        assert purged == 1
+
+
+class TestTieredCache:
+    """Test the TieredCache class implementation"""
+
+    @pytest.mark.asyncio
+    async def test_read_path_reports_each_tier(
+        self, async_engine: AsyncSession
+    ) -> None:
+        """Test a value set by a node is read from the shared tier by another
+        one and then from its local tier, with the metrics of each tier"""
+        # Arrange
+        registry = Metrics()
+        shared = DatabaseCacheBackend(async_engine.bind)
+        first_node = TieredCache("topics", shared, registry=Metrics())
+        second_node = TieredCache("topics", shared, registry=registry)
+        await first_node.set("conversation", "energia solar")
+
+        # Act
+        values = [
+            await second_node.get("conversation"),
+            await second_node.get("conversation"),
+            await second_node.get("unknown"),
+        ]
+
+        # Assert
+        assert values == ["energia solar", "energia solar", None]
+        snapshot = registry.snapshot()
+        assert snapshot["counters"]["cache.topics.local.hits"] == 1
+        assert snapshot["counters"]["cache.topics.local.misses"] == 2
+        assert snapshot["counters"]["cache.topics.shared.hits"] == 1
+        assert snapshot["counters"]["cache.topics.shared.misses"] == 1
+        assert snapshot["gauges"]["cache.topics.shared.hit_ratio"] == 0.5
+        assert snapshot["summaries"]["cache.topics.shared.seconds"]["count"] == 2
+
+    @pytest.mark.asyncio
+    async def test_get_or_set_computes_once(self, tmp_path) -> None:
+        """Test concurrent misses of two nodes compute the value once"""
+        # Arrange
+        # A pool of its own: the connections of the shared test engine are
+        # one, so the rollback of a read would undo a concurrent write
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'db.sqlite'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        registry = Metrics()
+        shared = DatabaseCacheBackend(engine)
+        nodes = [TieredCache("verdicts", shared, registry=registry) for _ in range(2)]
+        calls = 0
+
+        async def compute() -> str:
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.1)
+            return "warn"
+
+        # Act
+        with patch("app.cache.LOCK_POLL_SECONDS", 0.01):
+            values = await asyncio.gather(
+                *(node.get_or_set("message", compute) for node in nodes * 5)
+            )
+
+        # Assert
+        assert values == ["warn"] * 10
+        assert calls == 1
+        counters = registry.snapshot()["counters"]
+        assert counters["cache.verdicts.computations"] == 1
+        assert counters["cache.verdicts.stampede_waits"] == 1
+        await engine.dispose()
+
+    @pytest.mark.asyncio
+    async def test_shared_errors_count_as_misses(self) -> None:
+        """Test an unavailable shared backend does not fail the lookups"""
+        # Arrange
+        registry = Metrics()
+
+        class BrokenBackend:
+            async def fail(self, *args: object) -> None:
+                raise ConnectionError("down")
+
+            get = set = add = delete = fail
+
+        cache = TieredCache(
+            "topics", BrokenBackend(), registry=registry  # type: ignore[arg-type]
+        )
+
+        async def compute() -> str:
+            return "energia solar"
+
+        # Act
+        value = await cache.get_or_set("conversation", compute)
+
+        # Assert
+        assert value == "energia solar"
+        assert registry.snapshot()["counters"]["cache.topics.shared.errors"] == 3
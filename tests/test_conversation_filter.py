@@ -0,0 +1,112 @@
+import uuid
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel
+
+from app.conversation_filter import BloomFilter, ConversationFilter
+from app.entities import Conversations
+from app.metrics import Metrics
+
+
+class TestBloomFilter:
+    """Test the BloomFilter class implementation"""
+
+    def test_sized_for_capacity_and_rate(self) -> None:
+        """Test the filter is sized with the optimal bits and hashes"""
+        # Act
+        bloom = BloomFilter(capacity=1_000_000, false_positive_rate=0.01)
+
+        # Assert
+        assert bloom.hashes == 7
+        assert bloom.size_bytes == pytest.approx(1.14 * 2**20, rel=0.01)
+
+    def test_no_false_negatives(self) -> None:
+        """Test every added id is found and few unknown ids are"""
+        # Arrange
+        bloom = BloomFilter(capacity=1000, false_positive_rate=0.01)
+        added = [uuid.uuid4() for _ in range(1000)]
+
+        # Act
+        for conversation_id in added:
+            bloom.add(conversation_id)
+
+        # Assert
+        assert all(conversation_id in bloom for conversation_id in added)
+        false_positives = sum(uuid.uuid4() in bloom for _ in range(10_000))
+        assert false_positives < 300
+        assert bloom.expected_false_positive_rate() == pytest.approx(0.01, rel=0.2)
+
+
+class TestConversationFilter:
+    """Test the ConversationFilter class implementation"""
+
+    @pytest.mark.asyncio
+    async def test_rebuild_refresh_and_add(self, tmp_path) -> None:
+        """Test the filter loads the stored conversations, the new ones of
+        other processes and the ones added by this process"""
+        # Arrange
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'db.sqlite'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        stored, other_node = Conversations(), Conversations()
+        # Read before the commits, which expire the attributes
+        stored_id, other_node_id = stored.conversation_id, other_node.conversation_id
+        created_here = uuid.uuid4()
+        async with AsyncSession(engine) as session:
+            session.add(stored)
+            await session.commit()
+        conversations = ConversationFilter(capacity=100, registry=Metrics())
+
+        # Act
+        assert conversations.might_exist(uuid.uuid4())
+        await conversations.rebuild(engine)
+        async with AsyncSession(engine) as session:
+            session.add(other_node)
+            await session.commit()
+        await conversations.refresh(engine)
+        conversations.add(created_here)
+
+        # Assert
+        assert conversations.ready
+        assert conversations.might_exist(stored_id)
+        assert conversations.might_exist(other_node_id)
+        assert conversations.might_exist(created_here)
+        assert not conversations.might_exist(uuid.uuid4())
+        await engine.dispose()
+
+    @pytest.mark.asyncio
+    async def test_exists_refreshes_on_misses(self, tmp_path) -> None:
+        """Test a miss refreshes a filter not refreshed for a while, which
+        finds a conversation created by another process, and is a definite
+        rejection otherwise"""
+        # Arrange
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'db.sqlite'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        registry = Metrics()
+        conversations = ConversationFilter(
+            capacity=100, miss_refresh_seconds=60, registry=registry
+        )
+        await conversations.rebuild(engine)
+        other_node = Conversations()
+        other_node_id = other_node.conversation_id
+        async with AsyncSession(engine) as session:
+            session.add(other_node)
+            await session.commit()
+
+        # Act
+        just_refreshed = await conversations.exists(engine, other_node_id)
+        conversations.miss_refresh_seconds = 0
+        found = await conversations.exists(engine, other_node_id)
+        conversations.miss_refresh_seconds = 60
+        unknown = await conversations.exists(engine, uuid.uuid4())
+
+        # Assert
+        assert (just_refreshed, found, unknown) == (False, True, False)
+        assert conversations.might_exist(other_node_id)
+        counters = registry.snapshot()["counters"]
+        assert counters["conversation_filter.miss_refreshes"] == 1
+        assert counters["conversation_filter.late_ids"] == 1
+        assert counters["conversation_filter.rejected"] == 2
+        await engine.dispose()
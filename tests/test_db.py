@@ -0,0 +1,83 @@
+import uuid
+from unittest.mock import MagicMock
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.db import PRIMARY_TARGET, ReplicaRouter, instrument_engine, prewarm_pool
+from app.metrics import metrics
+
+
+class TestReplicaRouter:
+    """Test the ReplicaRouter class implementation"""
+
+    @pytest.fixture
+    def primary(self) -> MagicMock:
+        return MagicMock(name="primary")
+
+    @pytest.fixture
+    def replicas(self) -> list[MagicMock]:
+        return [MagicMock(name="replica_0"), MagicMock(name="replica_1")]
+
+    def test_read_target_round_robin_replicas(
+        self, primary: MagicMock, replicas: list[MagicMock]
+    ) -> None:
+        """Test reads are balanced between the replicas"""
+        router = ReplicaRouter(primary, replicas, pin_seconds=5)
+
+        targets = [router.read_target(uuid.uuid4())[0] for _ in range(3)]
+
+        assert targets == ["replica_0", "replica_1", "replica_0"]
+
+    def test_read_target_pinned_after_write(
+        self, primary: MagicMock, replicas: list[MagicMock]
+    ) -> None:
+        """Test a conversation reads from the primary after writing"""
+        router = ReplicaRouter(primary, replicas, pin_seconds=5)
+        conversation_id = uuid.uuid4()
+
+        router.mark_write(conversation_id)
+
+        assert router.read_target(conversation_id) == (PRIMARY_TARGET, primary)
+        assert router.read_target(uuid.uuid4())[0] == "replica_0"
+
+    def test_read_target_pin_expires(
+        self, primary: MagicMock, replicas: list[MagicMock]
+    ) -> None:
+        """Test a conversation goes back to the replicas after the pin expires"""
+        router = ReplicaRouter(primary, replicas, pin_seconds=0)
+        conversation_id = uuid.uuid4()
+
+        router.mark_write(conversation_id)
+
+        assert router.read_target(conversation_id)[0] == "replica_0"
+
+    def test_read_target_without_replicas(self, primary: MagicMock) -> None:
+        """Test every read goes to the primary without replicas"""
+        router = ReplicaRouter(primary, [], pin_seconds=5)
+
+        assert router.read_target(uuid.uuid4()) == (PRIMARY_TARGET, primary)
+
+    @pytest.mark.asyncio
+    async def test_instrument_engine_records_latency(self) -> None:
+        """Test the latency of the queries is recorded per target"""
+        engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+        instrument_engine(engine, "test_target")
+
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+        await engine.dispose()
+
+        summary = metrics.snapshot()["summaries"]["db.query_seconds.test_target"]
+        assert summary["count"] >= 1
+
+    @pytest.mark.asyncio
+    async def test_prewarm_pool_keeps_connections(self, tmp_path) -> None:
+        """Test the warmed connections stay open in the pool"""
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'db.sqlite'}")
+
+        await prewarm_pool(engine, connections=3)
+
+        assert engine.pool.checkedin() == 3
+        await engine.dispose()
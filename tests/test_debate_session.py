@@ -0,0 +1,262 @@
+import asyncio
+import json
+from typing import Any, Optional
+from unittest.mock import AsyncMock
+
+import pytest
+from fastapi import WebSocketDisconnect, status
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.conversation_filter import ConversationFilter
+from app.debate_session import DebateSession, SessionConnection
+from app.entities import Messages
+from app.messages_adapters import MessagesAdapters
+from app.metrics import Metrics
+from app.models import MessageModel
+from app.proxy import Proxy
+
+
+class FakeWebSocket:
+    """WebSocket double fed with the frames of the client."""
+
+    def __init__(self, frames: Optional[list[dict]] = None, send_delay: float = 0):
+        self.received: asyncio.Queue[str] = asyncio.Queue()
+        for frame in frames or []:
+            self.received.put_nowait(json.dumps(frame))
+        self.sent: list[dict] = []
+        self.send_delay = send_delay
+        self.close_code: Optional[int] = None
+
+    async def receive_text(self) -> str:
+        return await self.received.get()
+
+    async def send_text(self, data: str) -> None:
+        await asyncio.sleep(self.send_delay)
+        self.sent.append(json.loads(data))
+
+    async def close(self, code: int) -> None:
+        self.close_code = code
+
+
+def allow_proxy() -> Proxy:
+    proxy_agent = AsyncMock()
+    proxy_agent.run.return_value.output = "allow"
+    return Proxy(proxy_agent)
+
+
+class TestDebateSession:
+    """Test the DebateSession class implementation"""
+
+    @pytest.mark.asyncio
+    async def test_turns_keep_history_in_memory(
+        self, async_engine: AsyncSession, streaming_agent: type
+    ) -> None:
+        """Test the following turns reuse the model history of the session
+        and only write their new messages"""
+        # Arrange
+        agent = streaming_agent(["La energia ", "solar ", "gana"])
+        adapters = MessagesAdapters(async_engine, agent)  # type: ignore[arg-type]
+        adapters.get_history_messages = AsyncMock()  # type: ignore[method-assign]
+        session = DebateSession(adapters, allow_proxy(), ConversationFilter())
+        frames: list[dict] = []
+
+        async def send(frame: dict) -> None:
+            frames.append(frame)
+
+        # Act
+        await session.turn("Debatamos sobre energia solar", send)
+        await session.turn("No estoy de acuerdo", send)
+
+        # Assert
+        deltas = [frame["text"] for frame in frames if frame["type"] == "delta"]
+        messages = [frame for frame in frames if frame["type"] == "message"]
+        assert "".join(deltas) == "La energia solar gana" * 2
+        assert messages[1]["conversation_id"] == session.conversation_id
+        assert messages[1]["message"][0]["message"] == "La energia solar gana"
+        assert len(messages[1]["message"]) == 4
+        assert agent.histories[1] == [
+            "request: Debatamos sobre energia solar",
+            "response",
+        ]
+        adapters.get_history_messages.assert_not_awaited()
+        async with AsyncSession(async_engine.bind) as db:
+            count = await db.scalar(select(func.count()).select_from(Messages))
+        assert count == 4
+
+    @pytest.mark.asyncio
+    async def test_open_loads_history_once(
+        self,
+        async_engine: AsyncSession,
+        sample_model_response: str,
+        streaming_agent: type,
+    ) -> None:
+        """Test an existing conversation is loaded and parsed on open"""
+        # Arrange
+        agent = streaming_agent(["Sigo en desacuerdo"])
+        adapters = MessagesAdapters(async_engine, agent)  # type: ignore[arg-type]
+        conversation_id = await adapters.insert_first_conversation_messages(
+            MessageModel(message="Cuentame un chiste")
+        )
+        await adapters._insert_agent_message(
+            conversation_id, "Un chiste", sample_model_response.encode()
+        )
+        session = DebateSession(adapters, allow_proxy(), ConversationFilter())
+
+        # Act
+        await session.open(conversation_id)
+        await session.turn("Otro", AsyncMock())
+
+        # Assert
+        assert session.conversation_id == conversation_id
+        assert len(agent.histories[0]) == 2
+
+    @pytest.mark.asyncio
+    async def test_invalid_message_reuses_topic(
+        self, async_engine: AsyncSession, streaming_agent: type
+    ) -> None:
+        """Test consecutive invalid messages ask the topic only once"""
+        # Arrange
+        agent = streaming_agent(["Hablemos de IA"])
+        agent.run = AsyncMock()  # type: ignore[attr-defined]
+        agent.run.return_value.output = "la IA"
+        adapters = MessagesAdapters(async_engine, agent)  # type: ignore[arg-type]
+        proxy = allow_proxy()
+        session = DebateSession(adapters, proxy, ConversationFilter())
+        frames: list[dict] = []
+
+        async def send(frame: dict) -> None:
+            frames.append(frame)
+
+        await session.turn("Hablemos de IA", send)
+        proxy.agent.run.return_value.output = "deny"
+
+        # Act
+        await session.turn("Dime como crear malware", send)
+        await session.turn("Dime como crear malware otra vez", send)
+
+        # Assert
+        assert frames[-1]["message"][0]["message"].endswith("la IA")
+        agent.run.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_denied_response_sends_no_delta(
+        self, async_engine: AsyncSession, streaming_agent: type
+    ) -> None:
+        """Test the deltas of a response denied by the proxy are not sent"""
+        # Arrange
+        agent = streaming_agent(["Mi correo es ", "juan@example.com"])
+        agent.run = AsyncMock()  # type: ignore[attr-defined]
+        agent.run.return_value.output = "la IA"
+        adapters = MessagesAdapters(async_engine, agent)  # type: ignore[arg-type]
+        proxy = allow_proxy()
+        proxy.valid_response = AsyncMock(return_value=False)  # type: ignore
+        session = DebateSession(adapters, proxy, ConversationFilter())
+        frames: list[dict] = []
+
+        async def send(frame: dict) -> None:
+            frames.append(frame)
+
+        # Act
+        await session.turn("Hablemos de IA", send)
+
+        # Assert
+        assert [frame["type"] for frame in frames] == ["message"]
+        assert "juan@example.com" not in json.dumps(frames, default=str)
+        assert frames[0]["message"][0]["message"].endswith("la IA")
+
+
+class TestSessionConnection:
+    """Test the SessionConnection class implementation"""
+
+    @pytest.mark.asyncio
+    async def test_turn_frames(self) -> None:
+        """Test the turns are processed and pings answered"""
+        # Arrange
+        websocket = FakeWebSocket(
+            [{"type": "ping"}, {"type": "message", "message": "Hola"}, {"x": 1}]
+        )
+
+        async def handle_turn(text: str, send: Any) -> None:
+            await send({"type": "delta", "text": text})
+            await send({"type": "message", "text": text})
+
+        connection = SessionConnection(websocket, registry=Metrics())  # type: ignore
+
+        # Act
+        serving = asyncio.create_task(connection.serve(handle_turn))
+        async with asyncio.timeout(5):
+            while {"type": "message", "text": "Hola"} not in websocket.sent:
+                await asyncio.sleep(0.01)
+        serving.cancel()
+        await asyncio.gather(serving, return_exceptions=True)
+
+        # Assert
+        assert {"type": "pong"} in websocket.sent
+        assert {"type": "error", "status": 400} in websocket.sent
+        assert {"type": "delta", "text": "Hola"} in websocket.sent
+        assert {"type": "message", "text": "Hola"} in websocket.sent
+
+    @pytest.mark.asyncio
+    async def test_deltas_coalesced_for_slow_client(self) -> None:
+        """Test the deltas are merged while the outbox is full"""
+        # Arrange
+        websocket = FakeWebSocket(send_delay=0.01)
+        registry = Metrics()
+        connection = SessionConnection(
+            websocket, send_queue_frames=2, registry=registry  # type: ignore
+        )
+        writer = asyncio.create_task(connection._write())
+
+        # Act
+        for index in range(20):
+            await connection.send({"type": "delta", "text": str(index % 10)})
+        await connection.send({"type": "message"})
+        await asyncio.sleep(0.2)
+        writer.cancel()
+
+        # Assert
+        deltas = [frame["text"] for frame in websocket.sent[:-1]]
+        assert "".join(deltas) == "0123456789" * 2
+        assert len(deltas) < 20
+        assert websocket.sent[-1] == {"type": "message"}
+        assert registry.snapshot()["counters"]["ws.deltas_coalesced"] > 0
+
+    @pytest.mark.asyncio
+    async def test_idle_client_disconnected(self) -> None:
+        """Test a client that sends no message is disconnected"""
+        # Arrange
+        websocket = FakeWebSocket()
+        registry = Metrics()
+        connection = SessionConnection(
+            websocket,  # type: ignore[arg-type]
+            heartbeat_seconds=0.01,
+            idle_timeout_seconds=0.05,
+            registry=registry,
+        )
+        # The client answers the pings
+        connection._last_received = float("inf")
+
+        # Act
+        await asyncio.wait_for(connection.serve(AsyncMock()), 1)
+
+        # Assert
+        assert websocket.close_code == status.WS_1000_NORMAL_CLOSURE
+        assert {"type": "ping"} in websocket.sent
+        assert registry.snapshot()["counters"]["ws.idle_disconnects"] == 1
+
+    @pytest.mark.asyncio
+    async def test_disconnect_ends_session(self) -> None:
+        """Test the session ends when the client leaves"""
+        # Arrange
+        websocket = FakeWebSocket()
+        websocket.receive_text = AsyncMock(  # type: ignore[method-assign]
+            side_effect=WebSocketDisconnect(1000)
+        )
+        connection = SessionConnection(websocket)  # type: ignore[arg-type]
+
+        # Act
+        await asyncio.wait_for(connection.serve(AsyncMock()), 1)
+
+        # Assert
+        assert websocket.close_code is None
@@ -0,0 +1,77 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+from app.export import EXPORT_COLUMNS, stream_export
+from app.messages_adapters import MessagesAdapters
+from app.models import MessageModel
+
+
+class TestExport:
+    """Test the streaming export of conversations"""
+
+    @pytest_asyncio.fixture
+    async def populated_adapters(
+        self, messages_adapters: MessagesAdapters
+    ) -> MessagesAdapters:
+        """Create two conversations with three messages in total"""
+        conversation_id = await messages_adapters.insert_first_conversation_messages(
+            MessageModel(message="Message 1")
+        )
+        await messages_adapters.insert_message(
+            MessageModel(message="Message 2"), conversation_id
+        )
+        await messages_adapters.insert_first_conversation_messages(
+            MessageModel(message="Message 3")
+        )
+        return messages_adapters
+
+    @pytest.mark.asyncio
+    async def test_stream_export_ndjson_in_chunks(
+        self, populated_adapters: MessagesAdapters
+    ) -> None:
+        """Test rows are exported as NDJSON in chunks of chunk_size"""
+        # Arrange
+        engine = populated_adapters.async_session.bind
+
+        # Act
+        chunks = [chunk async for chunk in stream_export(engine, chunk_size=2)]
+
+        # Assert
+        assert len(chunks) == 2
+        rows = [json.loads(line) for line in b"".join(chunks).splitlines()]
+        assert [row["content"] for row in rows] == [
+            "Message 1",
+            "Message 2",
+            "Message 3",
+        ]
+        assert list(rows[0]) == EXPORT_COLUMNS
+
+    @pytest.mark.asyncio
+    async def test_stream_export_csv_with_time_range(
+        self, populated_adapters: MessagesAdapters
+    ) -> None:
+        """Test the CSV export has a header and respects the time range"""
+        # Arrange
+        engine = populated_adapters.async_session.bind
+        tomorrow = datetime.now() + timedelta(days=1)
+
+        # Act
+        chunks = [chunk async for chunk in stream_export(engine, "csv", since=tomorrow)]
+
+        # Assert
+        rows = list(csv.reader(io.StringIO(b"".join(chunks).decode())))
+        assert rows == [EXPORT_COLUMNS]
+
+    @pytest.mark.asyncio
+    async def test_stream_export_unknown_format(
+        self, messages_adapters: MessagesAdapters
+    ) -> None:
+        """Test ValueError is raised for unknown formats"""
+        with pytest.raises(ValueError):
+            async for _ in stream_export(messages_adapters.async_session.bind, "xml"):
+                pass
@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.errors import IdempotencyKeyConflictError
+from app.idempotency import IdempotencyStore, request_fingerprint
+from app.metrics import Metrics
+
+
+class TestIdempotencyStore:
+    """Test the IdempotencyStore class implementation"""
+
+    @pytest.mark.asyncio
+    async def test_do_replays_stored_response(self) -> None:
+        """Test a repeated key returns the stored response without running again"""
+        # Arrange
+        registry = Metrics()
+        store = IdempotencyStore(max_entries=10, ttl_seconds=60, registry=registry)
+        calls = 0
+
+        async def send_turn() -> tuple[int, bytes]:
+            nonlocal calls
+            calls += 1
+            return 200, b'{"conversation_id": "1"}'
+
+        # Act
+        first, first_replayed = await store.do("key", "hash", send_turn)
+        second, second_replayed = await store.do("key", "hash", send_turn)
+
+        # Assert
+        assert calls == 1
+        assert second.body == first.body
+        assert (first_replayed, second_replayed) == (False, True)
+        assert registry.counters == {
+            "idempotency.executed": 1,
+            "idempotency.replayed": 1,
+        }
+
+    @pytest.mark.asyncio
+    async def test_do_attaches_to_in_flight_request(self) -> None:
+        """Test concurrent requests with the same key share the execution"""
+        # Arrange
+        registry = Metrics()
+        store = IdempotencyStore(max_entries=10, ttl_seconds=60, registry=registry)
+        calls = 0
+
+        async def slow_turn() -> tuple[int, bytes]:
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return 200, b"{}"
+
+        # Act
+        results = await asyncio.gather(
+            *(store.do("key", "hash", slow_turn) for _ in range(3))
+        )
+
+        # Assert
+        assert calls == 1
+        assert [replayed for _, replayed in results] == [False, True, True]
+        assert registry.counters["idempotency.attached"] == 2
+
+    @pytest.mark.asyncio
+    async def test_do_key_reused_with_another_request(self) -> None:
+        """Test a key sent with another request raises a conflict"""
+        # Arrange
+        store = IdempotencyStore(max_entries=10, ttl_seconds=60, registry=Metrics())
+
+        async def send_turn() -> tuple[int, bytes]:
+            return 200, b"{}"
+
+        await store.do("key", request_fingerprint(b"first"), send_turn)
+
+        # Act & Assert
+        with pytest.raises(IdempotencyKeyConflictError):
+            await store.do("key", request_fingerprint(b"second"), send_turn)
+
+    @pytest.mark.asyncio
+    async def test_do_failed_request_is_not_stored(self) -> None:
+        """Test a request that fails can be retried with the same key"""
+        # Arrange
+        store = IdempotencyStore(max_entries=10, ttl_seconds=60, registry=Metrics())
+        responses = [(500, b"error"), (200, b"{}")]
+
+        async def flaky_turn() -> tuple[int, bytes]:
+            return responses.pop(0)
+
+        # Act
+        first, _ = await store.do("key", "hash", flaky_turn)
+        second, replayed = await store.do("key", "hash", flaky_turn)
+
+        # Assert
+        assert first.status_code == 500
+        assert second.status_code == 200
+        assert replayed is False
+
+    @pytest.mark.asyncio
+    async def test_do_evicts_least_recently_used(self) -> None:
+        """Test the store keeps at most max_entries responses"""
+        # Arrange
+        store = IdempotencyStore(max_entries=2, ttl_seconds=60, registry=Metrics())
+
+        async def send_turn() -> tuple[int, bytes]:
+            return 200, b"{}"
+
+        # Act
+        for key in ["a", "b", "c"]:
+            await store.do(key, "hash", send_turn)
+
+        # Assert
+        assert list(store._responses) == ["b", "c"]
+
+    @pytest.mark.asyncio
+    async def test_do_persists_responses(self, async_engine: AsyncSession) -> None:
+        """Test another store with the same database replays the response"""
+        # Arrange
+        engine = async_engine.bind
+        first_store = IdempotencyStore(10, 60, engine=engine, registry=Metrics())
+        second_store = IdempotencyStore(10, 60, engine=engine, registry=Metrics())
+
+        async def send_turn() -> tuple[int, bytes]:
+            return 200, b'{"message": "hola"}'
+
+        async def unexpected_turn() -> tuple[int, bytes]:
+            raise AssertionError("the request must be replayed")
+
+        await first_store.do("key", "hash", send_turn)
+
+        # Act
+        stored, replayed = await second_store.do("key", "hash", unexpected_turn)
+
+        # Assert
+        assert replayed is True
+        assert stored.body == b'{"message": "hola"}'
+        assert await second_store.purge_expired() == 0
@@ -0,0 +1,187 @@
+import asyncio
+
+import pytest
+
+from app.errors import JobQueueFullError
+from app.jobs import (
+    CANCELLED,
+    EXPIRED,
+    FAILED,
+    QUEUED,
+    SUCCEEDED,
+    JobRunner,
+    job_worker_index,
+    new_job_id,
+)
+from app.metrics import Metrics
+
+
+def respond(status_code: int = 200, body: bytes = b'{"ok": true}', delay: float = 0):
+    async def fn() -> tuple[int, bytes]:
+        await asyncio.sleep(delay)
+        return status_code, body
+
+    return fn
+
+
+class TestJobRunner:
+    """Test the JobRunner class implementation"""
+
+    @pytest.mark.asyncio
+    async def test_jobs_run_by_priority(self) -> None:
+        """Test the queued jobs run by priority, then by submission"""
+        # Arrange
+        runner = JobRunner(workers=1, registry=Metrics())
+        order = []
+
+        def track(name: str):
+            async def fn() -> tuple[int, bytes]:
+                order.append(name)
+                return 200, b"{}"
+
+            return fn
+
+        jobs = [
+            runner.submit(track("low"), "low", 10),
+            runner.submit(track("normal"), "normal", 10),
+            runner.submit(track("high"), "high", 10),
+            runner.submit(track("high 2"), "high", 10),
+        ]
+
+        # Act
+        runner.start()
+        await asyncio.gather(*(job.wait_finished(1) for job in jobs))
+        await runner.stop()
+
+        # Assert
+        assert order == ["high", "high 2", "normal", "low"]
+        assert jobs[0].describe()["result"] == {}
+        assert all(job.status == SUCCEEDED for job in jobs)
+
+    @pytest.mark.asyncio
+    async def test_job_results_and_failures(self) -> None:
+        """Test the result of a job, failed with an error status or exception"""
+        # Arrange
+        registry = Metrics()
+        runner = JobRunner(workers=2, registry=registry)
+
+        async def broken() -> tuple[int, bytes]:
+            raise RuntimeError("boom")
+
+        runner.start()
+
+        # Act
+        succeeded = runner.submit(respond(), "normal", 10)
+        conflict = runner.submit(respond(409, b'{"detail": "Conflict"}'), "normal", 10)
+        error = runner.submit(broken, "normal", 10)
+        for job in (succeeded, conflict, error):
+            await job.wait_finished(1)
+        await runner.stop()
+
+        # Assert
+        assert succeeded.describe()["result"] == {"ok": True}
+        assert conflict.status == FAILED
+        assert conflict.describe()["status_code"] == 409
+        assert error.status == FAILED
+        assert error.status_code == 500
+        snapshot = registry.snapshot()
+        assert snapshot["counters"]["jobs.failed"] == 2
+        assert snapshot["summaries"]["jobs.latency_seconds"]["count"] == 3
+        assert snapshot["gauges"]["jobs.queue_depth"] == 0
+
+    @pytest.mark.asyncio
+    async def test_deadline_expires_job(self) -> None:
+        """Test a job not finished by its deadline expires"""
+        # Arrange
+        runner = JobRunner(workers=1, registry=Metrics())
+        runner.start()
+
+        # Act
+        running = runner.submit(respond(delay=1), "normal", 0.05)
+        queued = runner.submit(respond(), "normal", 0.01)
+        await running.wait_finished(1)
+        await queued.wait_finished(1)
+        await runner.stop()
+
+        # Assert
+        assert running.status == EXPIRED
+        assert queued.status == EXPIRED
+        assert queued.started_at is None
+
+    @pytest.mark.asyncio
+    async def test_cancel_queued_and_running_jobs(self) -> None:
+        """Test a queued job is skipped and a running one stopped"""
+        # Arrange
+        runner = JobRunner(workers=1, registry=Metrics())
+        running = runner.submit(respond(delay=1), "normal", 10)
+        queued = runner.submit(respond(), "normal", 10)
+        runner.start()
+        await running.wait(QUEUED, 1)
+
+        # Act
+        cancelled_queued = runner.cancel(queued)
+        cancelled_running = runner.cancel(running)
+        await running.wait_finished(1)
+
+        # Assert
+        assert cancelled_queued and cancelled_running
+        assert queued.status == CANCELLED
+        assert running.status == CANCELLED
+        assert not runner.cancel(running)
+        await runner.stop()
+
+    @pytest.mark.asyncio
+    async def test_stop_waits_for_running_jobs(self) -> None:
+        """Test stop returns once the running jobs have ended"""
+        # Arrange
+        runner = JobRunner(workers=1, registry=Metrics())
+        ended = []
+
+        async def fn() -> tuple[int, bytes]:
+            try:
+                await asyncio.sleep(10)
+            finally:
+                # A cleanup that still awaits, like a database write
+                await asyncio.sleep(0.01)
+                ended.append(True)
+            return 200, b"{}"
+
+        job = runner.submit(fn, "normal", 10)
+        runner.start()
+        await job.wait(QUEUED, 1)
+
+        # Act
+        await runner.stop()
+
+        # Assert
+        assert ended == [True]
+
+    def test_bounded_queue_and_finished_jobs(self) -> None:
+        """Test a full queue rejects jobs and old finished jobs are forgotten"""
+        # Arrange
+        runner = JobRunner(max_queued=2, max_finished=1, registry=Metrics())
+        first = runner.submit(respond(), "normal", 10)
+        second = runner.submit(respond(), "normal", 10)
+
+        # Act
+        with pytest.raises(JobQueueFullError):
+            runner.submit(respond(), "normal", 10)
+        runner.cancel(first)
+        runner.cancel(second)
+
+        # Assert
+        assert runner.get(first.job_id) is None
+        assert runner.get(second.job_id) is second
+
+    def test_job_ids_carry_worker_index(self) -> None:
+        """Test the jobs of a dispatcher worker have its index in their id"""
+        # Arrange
+        runner = JobRunner(worker_index=5, registry=Metrics())
+
+        # Act
+        job = runner.submit(respond(), "normal", 10)
+
+        # Assert
+        assert job_worker_index(job.job_id) == 5
+        assert job.job_id.version == 4
+        assert job_worker_index(new_job_id(300)) == 300
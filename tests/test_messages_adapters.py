@@ -1,4 +1,5 @@
 import uuid
+from datetime import datetime, timedelta
 from unittest.mock import AsyncMock, Mock
 
 import pytest
@@ -9,8 +10,10 @@ from sqlalchemy import select
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.db import ReplicaRouter
 from app.entities import Conversations, Messages
 from app.errors import DatabaseError, ModelExecutionError, NoMessagesFoundError
+from app.fast_repository import MessageRow
 from app.messages_adapters import MessagesAdapters
 from app.models import MessageHistoryModel, MessageModel, ResponseModel
 
@@ -256,6 +259,33 @@ class TestMessagesAdapters:
         # Assert
         assert len(result) == len(expected_messages)
 
+    @pytest.mark.asyncio
+    async def test_get_history_messages_first_message_before_conversation(
+        self, messages_adapters: MessagesAdapters
+    ) -> None:
+        """Test the first message of a conversation inserted before the
+        conversation itself, like the older rows, is still read"""
+        # Arrange
+        adapter = messages_adapters
+        started = datetime.now()
+        conversation = Conversations(insert_datetime=started)
+        first_message = Messages(
+            conversation_id=conversation.conversation_id,
+            content="Hablemos de energia solar",
+            role="user-prompt",
+            insert_datetime=started - timedelta(seconds=2),
+        )
+        adapter.async_session.add_all([conversation, first_message])
+        await adapter.async_session.commit()
+
+        # Act
+        history = await adapter.get_history_messages(conversation.conversation_id)
+        page, _ = await adapter.get_messages_page(conversation.conversation_id, 10)
+
+        # Assert
+        assert [message.content for message in history] == ["Hablemos de energia solar"]
+        assert [message["message"] for message in page] == ["Hablemos de energia solar"]
+
     @pytest.mark.asyncio
     async def test_get_history_messages_database_error(
         self, messages_adapters: MessagesAdapters
@@ -352,3 +382,129 @@ class TestMessagesAdapters:
         assert result.message[1].role == "user-prompt"
         assert result.message[2].role == "user-prompt"
         assert result.message[2].message == "Message 1"
+
+    @pytest.mark.asyncio
+    async def test_get_messages_page_keyset_pagination(
+        self, messages_adapters: MessagesAdapters
+    ) -> None:
+        """Test pages are returned from newest to oldest following the cursor"""
+        # Arrange
+        adapter = messages_adapters
+        conversation_id = await adapter.insert_first_conversation_messages(
+            MessageModel(message="Message 0")
+        )
+        for number in range(1, 5):
+            await adapter.insert_message(
+                MessageModel(message=f"Message {number}"), conversation_id
+            )
+
+        # Act
+        first_page, cursor = await adapter.get_messages_page(conversation_id, 3)
+        second_page, last_cursor = await adapter.get_messages_page(
+            conversation_id, 3, cursor
+        )
+
+        # Assert
+        assert [m["message"] for m in first_page] == [
+            "Message 4",
+            "Message 3",
+            "Message 2",
+        ]
+        assert [m["message"] for m in second_page] == ["Message 1", "Message 0"]
+        assert last_cursor is None
+
+    @pytest.mark.asyncio
+    async def test_get_messages_page_selected_fields(
+        self, messages_adapters: MessagesAdapters
+    ) -> None:
+        """Test only the requested fields are returned"""
+        # Arrange
+        adapter = messages_adapters
+        conversation_id = await adapter.insert_first_conversation_messages(
+            MessageModel(message="Message 0")
+        )
+
+        # Act
+        page, _ = await adapter.get_messages_page(
+            conversation_id, 10, fields=["role", "metadata_response"]
+        )
+
+        # Assert
+        assert page == [{"role": "user-prompt", "metadata_response": None}]
+
+    @pytest.mark.asyncio
+    async def test_get_messages_page_conversation_not_found(
+        self, messages_adapters: MessagesAdapters
+    ) -> None:
+        """Test NoMessagesFoundError is raised for an unknown conversation"""
+        with pytest.raises(NoMessagesFoundError):
+            await messages_adapters.get_messages_page(uuid.uuid4(), 10)
+
+    @pytest.mark.asyncio
+    async def test_get_messages_page_invalid_cursor(
+        self, messages_adapters: MessagesAdapters
+    ) -> None:
+        """Test ValueError is raised for an invalid cursor"""
+        with pytest.raises(ValueError):
+            await messages_adapters.get_messages_page(uuid.uuid4(), 10, "not-a-cursor")
+
+    @pytest.mark.asyncio
+    async def test_get_history_messages_read_your_writes(
+        self, messages_adapters: MessagesAdapters
+    ) -> None:
+        """Test a conversation that wrote reads from the primary"""
+        # Arrange
+        adapter = messages_adapters
+        replica = Mock()
+        adapter.router = ReplicaRouter(
+            adapter.async_session.bind, [replica], pin_seconds=5
+        )
+
+        # Act
+        conversation_id = await adapter.insert_first_conversation_messages(
+            MessageModel(message="Message 1")
+        )
+        result = await adapter.get_history_messages(conversation_id)
+
+        # Assert
+        assert [m.content for m in result] == ["Message 1"]
+
+    @pytest.mark.asyncio
+    async def test_fast_repository_delegation(
+        self, messages_adapters: MessagesAdapters
+    ) -> None:
+        """Test the hot queries use the asyncpg repository when configured"""
+        # Arrange
+        adapter = messages_adapters
+        conversation_id = uuid.uuid4()
+        row = MessageRow(
+            uuid.uuid4(), conversation_id, "user-prompt", "Hola", None, datetime.now()
+        )
+        adapter.repository = AsyncMock()
+        adapter.repository.get_history.return_value = [row]
+        adapter.repository.insert_first_conversation.return_value = conversation_id
+
+        # Act
+        inserted_id = await adapter.insert_first_conversation_messages(
+            MessageModel(message="Hola")
+        )
+        await adapter.insert_message(MessageModel(message="Adios"), conversation_id)
+        history = await adapter.get_history_messages(conversation_id)
+
+        # Assert
+        assert inserted_id == conversation_id
+        adapter.repository.insert_message.assert_called_once_with(
+            conversation_id, "user-prompt", "Adios"
+        )
+        assert history == [row]
+
+    @pytest.mark.asyncio
+    async def test_fast_repository_no_messages_found(
+        self, messages_adapters: MessagesAdapters
+    ) -> None:
+        """Test NoMessagesFoundError is raised when the repository finds no rows"""
+        messages_adapters.repository = AsyncMock()
+        messages_adapters.repository.get_history.return_value = []
+
+        with pytest.raises(NoMessagesFoundError):
+            await messages_adapters.get_history_messages(uuid.uuid4())
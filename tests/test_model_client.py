@@ -0,0 +1,53 @@
+import httpx
+import pytest
+
+from app.metrics import Metrics
+from app.model_client import InstrumentedTransport
+
+
+class FakePoolTransport(httpx.AsyncBaseTransport):
+    """Transport that opens a connection only on the first request"""
+
+    def __init__(self) -> None:
+        self.connected = False
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if not self.connected:
+            trace = request.extensions["trace"]
+            await trace("connection.connect_tcp.complete", {})
+            await trace("connection.start_tls.complete", {})
+            self.connected = True
+        return httpx.Response(200)
+
+
+class TestInstrumentedTransport:
+    """Test the InstrumentedTransport class implementation"""
+
+    @pytest.mark.asyncio
+    async def test_connection_reuse_metrics(self) -> None:
+        """Test the requests that reuse a pooled connection are reported"""
+        # Arrange
+        registry = Metrics()
+        transport = InstrumentedTransport(FakePoolTransport(), registry)
+        events = []
+
+        async def previous_trace(event_name: str, info: dict) -> None:
+            events.append(event_name)
+
+        # Act
+        async with httpx.AsyncClient(transport=transport) as client:
+            for _ in range(4):
+                await client.get(
+                    "https://model.test/", extensions={"trace": previous_trace}
+                )
+
+        # Assert
+        snapshot = registry.snapshot()
+        assert snapshot["counters"]["model_http.requests"] == 4
+        assert snapshot["counters"]["model_http.connections_opened"] == 1
+        assert snapshot["counters"]["model_http.tls_handshakes"] == 1
+        assert snapshot["gauges"]["model_http.connection_reuse_ratio"] == 0.75
+        assert events == [
+            "connection.connect_tcp.complete",
+            "connection.start_tls.complete",
+        ]
@@ -0,0 +1,66 @@
+from datetime import date
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from app.partitions import (
+    add_months,
+    apply_retention,
+    ensure_partitions,
+    expired_partitions,
+    partition_month,
+    partition_name,
+)
+
+
+class TestPartitions:
+    """Test the management of the messages partitions"""
+
+    def test_add_months_across_years(self) -> None:
+        """Test months are added and subtracted across years"""
+        assert add_months(date(2025, 11, 1), 3) == date(2026, 2, 1)
+        assert add_months(date(2025, 1, 1), -1) == date(2024, 12, 1)
+
+    def test_partition_name_round_trip(self) -> None:
+        """Test the month of a partition is recovered from its name"""
+        assert partition_name(date(2025, 3, 1)) == "messages_p202503"
+        assert partition_month("messages_p202503") == date(2025, 3, 1)
+        assert partition_month("messages_default") is None
+
+    def test_expired_partitions(self) -> None:
+        """Test only partitions fully older than the retention are expired"""
+        names = [
+            "messages_default",
+            "messages_p202503",
+            "messages_p202504",
+            "messages_p202505",
+        ]
+
+        expired = expired_partitions(names, date(2025, 10, 15), retention_months=6)
+
+        assert expired == ["messages_p202503"]
+
+    @pytest.mark.asyncio
+    async def test_partitions_skipped_on_other_databases(
+        self, messages_adapters
+    ) -> None:
+        """Test partitions are only managed on postgres"""
+        engine = messages_adapters.async_session.bind
+
+        await ensure_partitions(engine, months_ahead=3)
+        archived = await apply_retention(engine, 6, "archive")
+
+        assert archived == []
+
+    @pytest.mark.asyncio
+    async def test_partitions_skipped_on_unpartitioned_table(self) -> None:
+        """Test a messages table created before the partitioning is left as is"""
+        conn = AsyncMock()
+        conn.dialect.name = "postgresql"
+        conn.execute.return_value = MagicMock(scalar=MagicMock(return_value="r"))
+        engine = MagicMock()
+        engine.begin.return_value.__aenter__.return_value = conn
+
+        await ensure_partitions(engine, months_ahead=3)
+
+        conn.execute.assert_awaited_once()
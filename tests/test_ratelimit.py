@@ -0,0 +1,193 @@
+from typing import Callable
+
+import fastapi
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.metrics import Metrics
+from app.ratelimit import (
+    DatabaseRateLimitBackend,
+    InMemoryRateLimitBackend,
+    RateLimit,
+    RateLimitBackend,
+    RateLimitMiddleware,
+    hash_api_key,
+)
+
+
+def build_client(
+    limits: dict[str, RateLimit],
+    api_keys: frozenset[str] = frozenset(),
+    get_backend: Callable[[], RateLimitBackend] = InMemoryRateLimitBackend,
+) -> TestClient:
+    app = fastapi.FastAPI()
+
+    @app.post("/limited")
+    async def limited() -> dict:
+        return {"ok": True}
+
+    @app.get("/free")
+    async def free() -> dict:
+        return {"ok": True}
+
+    app.add_middleware(
+        RateLimitMiddleware,
+        limits=limits,
+        get_backend=get_backend,
+        api_keys=api_keys,
+        registry=Metrics(),
+    )
+    return TestClient(app)
+
+
+class TestInMemoryRateLimitBackend:
+    """Test the InMemoryRateLimitBackend class implementation"""
+
+    @pytest.mark.asyncio
+    async def test_take_refills_over_time(
+        self, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        """Test the bucket denies when empty and refills with the time"""
+        # Arrange
+        now = 100.0
+        monkeypatch.setattr("app.ratelimit.time.monotonic", lambda: now)
+        backend = InMemoryRateLimitBackend()
+        limit = RateLimit(capacity=2, refill_per_second=1)
+
+        # Act
+        first = await backend.take("client", limit)
+        second = await backend.take("client", limit)
+        denied = await backend.take("client", limit)
+        now += 1
+        refilled = await backend.take("client", limit)
+
+        # Assert
+        assert [first.allowed, second.allowed, denied.allowed] == [True, True, False]
+        assert denied.reset_seconds == pytest.approx(1)
+        assert refilled.allowed is True
+        assert refilled.remaining == 0
+
+    @pytest.mark.asyncio
+    async def test_take_evicts_least_recent_clients(self) -> None:
+        """Test the backend tracks at most max_keys clients"""
+        # Arrange
+        backend = InMemoryRateLimitBackend(max_keys=2)
+        limit = RateLimit.per_minute(10)
+
+        # Act
+        for key in ["a", "b", "c"]:
+            await backend.take(key, limit)
+
+        # Assert
+        assert list(backend._buckets) == ["b", "c"]
+
+
+class TestDatabaseRateLimitBackend:
+    """Test the DatabaseRateLimitBackend class implementation"""
+
+    @pytest.mark.asyncio
+    async def test_take_shares_buckets(self, async_engine: AsyncSession) -> None:
+        """Test two backends on the same database share the bucket"""
+        # Arrange
+        limit = RateLimit(capacity=2, refill_per_second=0.001)
+        first_node = DatabaseRateLimitBackend(async_engine.bind)
+        second_node = DatabaseRateLimitBackend(async_engine.bind)
+
+        # Act
+        decisions = [
+            await first_node.take("client", limit),
+            await second_node.take("client", limit),
+            await first_node.take("client", limit),
+        ]
+
+        # Assert
+        assert [decision.allowed for decision in decisions] == [True, True, False]
+        assert [decision.remaining for decision in decisions] == [1, 0, 0]
+
+
+class TestRateLimitMiddleware:
+    """Test the RateLimitMiddleware class implementation"""
+
+    def test_limited_route_adds_headers_and_denies(self) -> None:
+        """Test the limited route gets the headers and a 429 when exhausted"""
+        # Arrange
+        client = build_client({"/limited": RateLimit(2, 0.5)})
+
+        # Act
+        responses = [client.post("/limited") for _ in range(3)]
+
+        # Assert
+        assert [response.status_code for response in responses] == [200, 200, 429]
+        assert responses[0].headers["RateLimit-Limit"] == "2"
+        assert responses[0].headers["RateLimit-Remaining"] == "1"
+        assert responses[2].headers["Retry-After"] == "2"
+        assert responses[2].json() == {"detail": "Too Many Requests"}
+
+    def test_clients_are_limited_by_api_key(self) -> None:
+        """Test every known API key has its own bucket"""
+        # Arrange
+        client = build_client(
+            {"/limited": RateLimit(1, 0.1)},
+            frozenset({hash_api_key("first"), hash_api_key("second")}),
+        )
+
+        # Act
+        first = client.post("/limited", headers={"X-API-Key": "first"})
+        second = client.post("/limited", headers={"X-API-Key": "second"})
+        repeated = client.post("/limited", headers={"X-API-Key": "first"})
+
+        # Assert
+        assert first.status_code == 200
+        assert second.status_code == 200
+        assert repeated.status_code == 429
+
+    def test_unknown_api_keys_are_limited_by_ip(self) -> None:
+        """Test rotating made up API keys does not get new buckets"""
+        # Arrange
+        client = build_client(
+            {"/limited": RateLimit(1, 0.1)}, frozenset({hash_api_key("known")})
+        )
+
+        # Act
+        first = client.post("/limited", headers={"X-API-Key": "made-up-1"})
+        second = client.post("/limited", headers={"X-API-Key": "made-up-2"})
+        known = client.post("/limited", headers={"X-API-Key": "known"})
+
+        # Assert
+        assert first.status_code == 200
+        assert second.status_code == 429
+        assert known.status_code == 200
+
+    def test_route_without_limit(self) -> None:
+        """Test the routes without a limit are not counted"""
+        # Arrange
+        client = build_client({"/limited": RateLimit(1, 0.1)})
+
+        # Act
+        responses = [client.get("/free") for _ in range(3)]
+
+        # Assert
+        assert all(response.status_code == 200 for response in responses)
+        assert "RateLimit-Limit" not in responses[0].headers
+
+    def test_backend_built_on_first_limited_request(self) -> None:
+        """Test the backend is built once, by the first limited request"""
+        # Arrange
+        built: list[RateLimitBackend] = []
+
+        def get_backend() -> RateLimitBackend:
+            built.append(InMemoryRateLimitBackend())
+            return built[-1]
+
+        client = build_client({"/limited": RateLimit(1, 0.1)}, get_backend=get_backend)
+
+        # Act
+        client.get("/free")
+        before = len(built)
+        responses = [client.post("/limited") for _ in range(2)]
+
+        # Assert
+        assert before == 0
+        assert len(built) == 1
+        assert [response.status_code for response in responses] == [200, 429]
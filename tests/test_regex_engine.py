@@ -0,0 +1,42 @@
+import re
+
+import pytest
+
+from app.regex_engine import compile_pattern, is_linear
+
+
+class TestCompilePattern:
+    """Test the compile_pattern function implementation"""
+
+    def test_compile_pattern_matches_like_re(self) -> None:
+        """Test a compiled pattern finds the same matches as re"""
+        # Arrange
+        pattern = r"update\s+\w+\s+set"
+        content = "please update users set admin = 1"
+
+        # Act
+        compiled = compile_pattern(pattern)
+
+        # Assert
+        assert compiled.search(content).group() == re.search(pattern, content).group()
+        assert compiled.search("update " * 1000) is None
+
+    def test_compile_pattern_unsupported_falls_back_to_re(self) -> None:
+        """Test a pattern with a backreference is compiled with re"""
+        # Act
+        compiled = compile_pattern(r"(ab)\1")
+
+        # Assert
+        assert not is_linear(compiled)
+        assert compiled.search("xxababxx")
+
+    def test_compile_pattern_uses_re2(self) -> None:
+        """Test the supported patterns run on RE2 when it is installed"""
+        # Arrange
+        pytest.importorskip("re2")
+
+        # Act
+        compiled = compile_pattern(r"\b(kill|die)\b")
+
+        # Assert
+        assert is_linear(compiled)
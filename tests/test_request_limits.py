@@ -0,0 +1,64 @@
+from typing import Iterator
+
+import fastapi
+from fastapi.testclient import TestClient
+
+from app.models import MessageModel
+from app.request_limits import BodySizeLimitMiddleware
+
+
+def build_client(max_body_bytes: int) -> TestClient:
+    app = fastapi.FastAPI()
+
+    @app.post("/echo")
+    async def echo(message: MessageModel) -> dict:
+        return {"length": len(message.message)}
+
+    app.add_middleware(BodySizeLimitMiddleware, max_body_bytes=max_body_bytes)
+    return TestClient(app)
+
+
+class TestBodySizeLimitMiddleware:
+    """Test the BodySizeLimitMiddleware class implementation"""
+
+    def test_body_under_limit(self) -> None:
+        """Test a body under the limit reaches the endpoint"""
+        # Arrange
+        client = build_client(max_body_bytes=100)
+
+        # Act
+        response = client.post("/echo", json={"message": "hola"})
+
+        # Assert
+        assert response.status_code == 200
+        assert response.json() == {"length": 4}
+
+    def test_declared_content_length_over_limit(self) -> None:
+        """Test a Content-Length over the limit is rejected without reading it"""
+        # Arrange
+        client = build_client(max_body_bytes=100)
+
+        # Act
+        response = client.post("/echo", json={"message": "a" * 200})
+
+        # Assert
+        assert response.status_code == 413
+
+    def test_streamed_body_over_limit(self) -> None:
+        """Test a body without Content-Length is rejected while it is received"""
+        # Arrange
+        client = build_client(max_body_bytes=100)
+
+        def chunks() -> Iterator[bytes]:
+            yield b'{"message": "'
+            for _ in range(10):
+                yield b"a" * 50
+            yield b'"}'
+
+        # Act
+        response = client.post(
+            "/echo", content=chunks(), headers={"Content-Type": "application/json"}
+        )
+
+        # Assert
+        assert response.status_code == 413
@@ -0,0 +1,91 @@
+import uuid
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+from app.responses import CompressionMiddleware, FastJSONResponse
+
+
+class TestResponses:
+    """Test the fast JSON response and the compression middleware"""
+
+    @pytest.fixture
+    def client(self) -> TestClient:
+        """Create an app with a small, a big and a streamed response"""
+        app = FastAPI()
+        app.add_middleware(CompressionMiddleware, minimum_size=100)
+
+        @app.get("/small")
+        async def small() -> FastJSONResponse:
+            return FastJSONResponse({"message": "hola"})
+
+        @app.get("/big")
+        async def big() -> FastJSONResponse:
+            return FastJSONResponse({"message": ["hola"] * 100})
+
+        @app.get("/tagged")
+        async def tagged() -> FastJSONResponse:
+            return FastJSONResponse(
+                {"message": ["hola"] * 100},
+                headers={"ETag": '"page"', "Vary": "Accept-Encoding"},
+            )
+
+        @app.get("/stream")
+        async def stream() -> StreamingResponse:
+            async def chunks():
+                yield b"a" * 200
+                yield b"b" * 200
+
+            return StreamingResponse(chunks())
+
+        return TestClient(app)
+
+    def test_fast_json_response_render(self) -> None:
+        """Test uuids and non ascii characters are serialized"""
+        conversation_id = uuid.uuid4()
+
+        response = FastJSONResponse({"conversation_id": conversation_id, "m": "ñ"})
+
+        assert response.body == (
+            f'{{"conversation_id":"{conversation_id}","m":"ñ"}}'.encode()
+        )
+
+    def test_compress_big_response(self, client: TestClient) -> None:
+        """Test big responses are compressed with gzip"""
+        response = client.get("/big", headers={"Accept-Encoding": "gzip"})
+
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert response.json() == {"message": ["hola"] * 100}
+
+    def test_small_response_not_compressed(self, client: TestClient) -> None:
+        """Test responses smaller than minimum_size are not compressed"""
+        response = client.get("/small", headers={"Accept-Encoding": "gzip"})
+
+        assert "content-encoding" not in response.headers
+        assert response.json() == {"message": "hola"}
+
+    def test_not_accepted_encoding(self, client: TestClient) -> None:
+        """Test responses are not compressed when the client does not accept it"""
+        response = client.get("/big", headers={"Accept-Encoding": "identity"})
+
+        assert "content-encoding" not in response.headers
+
+    def test_streamed_response_not_compressed(self, client: TestClient) -> None:
+        """Test streamed responses are sent as they are"""
+        response = client.get("/stream", headers={"Accept-Encoding": "gzip"})
+
+        assert "content-encoding" not in response.headers
+        assert response.content == b"a" * 200 + b"b" * 200
+
+    def test_compressed_response_etag_is_weak(self, client: TestClient) -> None:
+        """Test the ETag of a compressed response is weak, and kept as it is
+        for an identity one"""
+        compressed = client.get("/tagged", headers={"Accept-Encoding": "gzip"})
+        identity = client.get("/tagged", headers={"Accept-Encoding": "identity"})
+
+        assert compressed.headers["etag"] == 'W/"page"'
+        assert compressed.headers["vary"] == "Accept-Encoding"
+        assert identity.headers["etag"] == '"page"'
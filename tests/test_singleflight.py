@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from app.metrics import Metrics
+from app.singleflight import SingleFlight
+
+
+class TestSingleFlight:
+    """Test the SingleFlight class implementation"""
+
+    @pytest.mark.asyncio
+    async def test_do_coalesces_concurrent_calls(self) -> None:
+        """Test concurrent calls with the same key run the function once"""
+        # Arrange
+        registry = Metrics()
+        singleflight: SingleFlight[str] = SingleFlight("test", registry)
+        calls = 0
+
+        async def slow_call() -> str:
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "deny"
+
+        # Act
+        results = await asyncio.gather(
+            *(singleflight.do("key", slow_call) for _ in range(5))
+        )
+
+        # Assert
+        assert results == ["deny"] * 5
+        assert calls == 1
+        assert registry.counters == {"test.calls": 1, "test.coalesced": 4}
+        assert len(singleflight) == 0
+
+    @pytest.mark.asyncio
+    async def test_do_different_keys(self) -> None:
+        """Test calls with different keys are not coalesced"""
+        # Arrange
+        singleflight: SingleFlight[str] = SingleFlight("test", Metrics())
+
+        async def echo(value: str) -> str:
+            await asyncio.sleep(0)
+            return value
+
+        # Act
+        results = await asyncio.gather(
+            singleflight.do("a", lambda: echo("a")),
+            singleflight.do("b", lambda: echo("b")),
+        )
+
+        # Assert
+        assert results == ["a", "b"]
+
+    @pytest.mark.asyncio
+    async def test_do_cancelled_caller_does_not_cancel_others(self) -> None:
+        """Test cancelling one caller keeps the shared call running"""
+        # Arrange
+        singleflight: SingleFlight[str] = SingleFlight("test", Metrics())
+
+        async def slow_call() -> str:
+            await asyncio.sleep(0.02)
+            return "allow"
+
+        first = asyncio.create_task(singleflight.do("key", slow_call))
+        second = asyncio.create_task(singleflight.do("key", slow_call))
+        await asyncio.sleep(0)
+
+        # Act
+        first.cancel()
+
+        # Assert
+        assert await second == "allow"
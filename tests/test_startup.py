@@ -0,0 +1,27 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from app.metrics import metrics
+from app.startup import warm_up
+
+
+class TestWarmUp:
+    """Test the warm_up function implementation"""
+
+    @pytest.mark.asyncio
+    async def test_warm_up_failure_does_not_stop_startup(self) -> None:
+        """Test a failed warm up is recorded and the startup continues"""
+        # Arrange
+        model = MagicMock(base_url=None)
+
+        # Act
+        failing_pool = AsyncMock(side_effect=OSError("refused"))
+        with patch("app.startup.prewarm_pool", failing_pool):
+            await warm_up(MagicMock(), [model], MagicMock(), 2, timeout_seconds=1)
+
+        # Assert
+        snapshot = metrics.snapshot()
+        assert snapshot["counters"]["startup.warm_up_errors.db_pool"] >= 1
+        assert "startup.warm_up_errors.model_0" not in snapshot["counters"]
+        assert "startup.warm_up_seconds" in snapshot["gauges"]
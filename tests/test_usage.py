@@ -0,0 +1,118 @@
+import uuid
+
+import pytest
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+
+from app.metrics import Metrics
+from app.usage import (
+    CLIENT_SCOPE,
+    CONVERSATION_SCOPE,
+    MAIN_AGENT,
+    PROXY_AGENT,
+    Usage,
+    UsageScope,
+    UsageTracker,
+    client_usage_key,
+    record_usage,
+    usage_scope,
+)
+
+
+class TestUsageTracker:
+    """Test the UsageTracker class implementation"""
+
+    @pytest.mark.asyncio
+    async def test_record_usage_of_the_scope(self) -> None:
+        """Test the calls of a turn are added to its conversation and client"""
+        # Arrange
+        tracker = UsageTracker(registry=Metrics())
+        conversation_id = uuid.uuid4()
+        usage_scope.set(UsageScope(tracker, "ip:1.2.3.4", conversation_id))
+
+        # Act
+        record_usage(MAIN_AGENT, 100, 20)
+        record_usage(PROXY_AGENT, 30, 1)
+
+        # Assert
+        conversation = await tracker.get(CONVERSATION_SCOPE, str(conversation_id))
+        client = await tracker.get(CLIENT_SCOPE, client_usage_key("ip:1.2.3.4"))
+        assert conversation == Usage(130, 21, main_calls=1, proxy_calls=1)
+        assert client == conversation
+
+    @pytest.mark.asyncio
+    async def test_exceeded_budget(self) -> None:
+        """Test the scope whose budget is used up is returned"""
+        # Arrange
+        tracker = UsageTracker(
+            conversation_token_budget=100,
+            client_daily_token_budget=1000,
+            registry=Metrics(),
+        )
+        conversation_id = uuid.uuid4()
+
+        # Act
+        tracker.record(conversation_id, "ip:1.2.3.4", Usage(90, 5, main_calls=1))
+        before = await tracker.exceeded_budget(conversation_id, "ip:1.2.3.4")
+        tracker.record(conversation_id, "ip:1.2.3.4", Usage(5, 0, proxy_calls=1))
+        after = await tracker.exceeded_budget(conversation_id, "ip:1.2.3.4")
+
+        # Assert
+        assert before is None
+        assert after == CONVERSATION_SCOPE
+        assert await tracker.exceeded_budget(uuid.uuid4(), "ip:1.2.3.4") is None
+
+    @pytest.mark.asyncio
+    async def test_top_in_memory(self) -> None:
+        """Test the top consumers are sorted by tokens and reported with
+        opaque keys"""
+        # Arrange
+        tracker = UsageTracker(registry=Metrics())
+        small, big = uuid.uuid4(), uuid.uuid4()
+        tracker.record(small, None, Usage(10, 1))
+        tracker.record(big, "ip:1.2.3.4", Usage(500, 50))
+
+        # Act
+        top = await tracker.top(CONVERSATION_SCOPE, limit=1)
+        clients = await tracker.top(CLIENT_SCOPE, limit=1)
+
+        # Assert
+        assert [(row["key"], row["total_tokens"]) for row in top] == [
+            (tracker.reported_key(CONVERSATION_SCOPE, str(big)), 550)
+        ]
+        assert str(big) not in top[0]["key"]
+        day, _, digest = clients[0]["key"].partition(":")
+        assert day == client_usage_key("ip:1.2.3.4").partition(":")[0]
+        assert len(digest) == 16 and "1.2.3.4" not in digest
+
+    @pytest.mark.asyncio
+    async def test_flush_and_load_from_database(self, tmp_path) -> None:
+        """Test the increments are flushed in a batch and evicted counters
+        are loaded back for the budgets"""
+        # Arrange
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'db.sqlite'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        tracker = UsageTracker(
+            conversation_token_budget=100, engine=engine, max_keys=1, registry=Metrics()
+        )
+        conversation_id = uuid.uuid4()
+        tracker.record(conversation_id, None, Usage(60, 10, main_calls=1))
+
+        # Act
+        flushed = await tracker.flush()
+        tracker.record(conversation_id, None, Usage(30, 0, proxy_calls=1))
+        # Evicts the counters of the conversation
+        tracker.record(uuid.uuid4(), None, Usage(1, 1))
+        exceeded = await tracker.exceeded_budget(conversation_id, None)
+        await tracker.flush()
+        top = await tracker.top(CONVERSATION_SCOPE, limit=1)
+
+        # Assert
+        assert flushed == 1
+        assert exceeded == CONVERSATION_SCOPE
+        assert top[0]["key"] == tracker.reported_key(
+            CONVERSATION_SCOPE, str(conversation_id)
+        )
+        assert (top[0]["input_tokens"], top[0]["proxy_calls"]) == (90, 1)
+        await engine.dispose()